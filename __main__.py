@@ -7,21 +7,39 @@
 
 import argparse
 import codecs
+import concurrent.futures
+import contextlib
+import io
 import os
 import shutil
-import subprocess
+import signal
 import sys
-import tempfile
 import zipfile
 import unicodedata
 
 from datetime import datetime
 from lib.epubqcheck import qcheck
-from lib.epubqcheck import find_opf
+from lib import checkcache
+from lib import mobicache
+from lib import fontcache
+from lib import fontstore
+from lib import timings
 from lib.epubqfix import qfix
-from lib.epubqfix import rename_files
+from lib.epubqfix import rename_book
+from lib.catalog import Catalog
+from lib.watcher import DirectoryWatcher
+from lib.server import serve
 from lib.fix_name_author import fix_name_author
-from lib.azkfix import to_azk
+from lib.fix_name_author import fix_name_author_csv
+from lib.azkfix import finish_azk
+from lib.azkfix import prepare_azk
+from lib.epubcheckrunner import EpubCheckRunner
+from lib.epubcheckrunner import extract_epubcheck
+from lib.epubcheckrunner import find_epubcheck_zip
+from lib.epubcheckrunner import java_major_version
+from lib.scheduler import Job
+from lib.scheduler import run_jobs
+from lib.atomicio import AtomicOutput
 
 __license__ = 'GNU Affero GPL v3'
 __copyright__ = '2014, Robert Błaut listy@blaut.biz'
@@ -60,6 +78,11 @@ parser.add_argument('--author', nargs='?', metavar='Surname, First Name',
 parser.add_argument('--title', nargs='?', metavar='Title',
                     const='no_title',
                     help='set new book title (only with -i')
+parser.add_argument('--metadata-csv', nargs='?', metavar='FILE',
+                    default=None,
+                    help='set authors and titles of many books from CSV file '
+                    'with "file", "author" and "title" columns (file paths '
+                    'relative to directory)')
 parser.add_argument('--font-dir', nargs='?', metavar='DIR', default=None,
                     help='path to directory with user fonts stored')
 parser.add_argument('--replace-font-family', nargs='?', metavar='old,new',
@@ -71,15 +94,50 @@ parser.add_argument("-a", "--alter", help="alternative output display",
 parser.add_argument("-n", "--rename", help="rename .epub files to "
                     "'author - title.epub'",
                     action="store_true")
+parser.add_argument("--catalog", help="print catalog of EPUB files with "
+                    "metadata and conversion state",
+                    action="store_true")
 parser.add_argument("-t", "--prepare-send-to-kindle", help="copy MOH files to "
                     "'title.epub' (Send to Kindle friendly)",
                     action="store_true")
+parser.add_argument("--font-report",
+                    help="report fonts embedded in more than one book with "
+                    "the books using them and the number of duplicated bytes",
+                    action="store_true")
+parser.add_argument("--font-store", nargs='?', metavar='DIR',
+                    const=fontstore.FONT_STORE_PATH, default=None,
+                    help="copy fonts found by --font-report to "
+                    "content-addressed store DIR and use fonts from it, "
+                    "matched by contents or font names, with -e "
+                    "(default: %s)"
+                    % fontstore.FONT_STORE_PATH)
+parser.add_argument("--timings", nargs='?', metavar='FILE', const=True,
+                    help="print time spent in every fix stage and counters "
+                    "per book and write them as JSON to FILE (default: "
+                    "eQT-timings-DATE.json in the EPUB directory; "
+                    "updated after every book with --watch) (only with -e)")
 parser.add_argument("-q", "--qcheck", help="validate files with qcheck "
                     "internal tool",
                     action="store_true")
 parser.add_argument("-p", "--epubcheck", help="validate epub files with "
                     " EpubCheck 4 tool",
                     action="store_true")
+parser.add_argument("--no-check-cache",
+                    help="do not replay cached qcheck results for unchanged "
+                    "files (only with -q)",
+                    action="store_true")
+parser.add_argument("--no-font-cache",
+                    help="do not read or store font metadata in the on-disk "
+                    "cache (fonts are still parsed once per run)",
+                    action="store_true")
+parser.add_argument("-j", "--jobs", nargs='?', type=int, metavar="NUMBER",
+                    default=None,
+                    help="number of external tools run at the same time "
+                    "(default: number of CPUs) (only with -p, -k or -z)")
+parser.add_argument("--timeout", nargs='?', type=float, metavar="SECONDS",
+                    default=None,
+                    help="kill external tool after number of seconds "
+                    "(only with -p, -k or -z)")
 parser.add_argument("--list-fonts",
                     help="list all fonts in EPUB (only with -q)",
                     action="store_true")
@@ -123,8 +181,13 @@ parser.add_argument("--remove-fonts",
                     help="remove all embedded font files "
                     "(only with -e)",
                     action="store_true")
+parser.add_argument("--subset-fonts",
+                    help="reduce embedded TrueType fonts to characters used "
+                    "in the book (only with -e)",
+                    action="store_true")
 parser.add_argument("-k", "--kindlegen", help="convert _moh.epub files to"
-                    " .mobi with kindlegen", action="store_true")
+                    " .mobi with kindlegen (unchanged files are skipped)",
+                    action="store_true")
 parser.add_argument("-z", "--azk", help="convert _moh.mobi files to"
                     " .azk with azkcreator", action="store_true")
 parser.add_argument("-d", "--huffdic", help="tell kindlegen to use huffdic "
@@ -141,9 +204,28 @@ parser.add_argument("--fix-missing-container",
 parser.add_argument('--book-margin', nargs='?', metavar='NUMBER',
                     help='Add left and right book margin to reset CSS file '
                     '(only with -e)')
+parser.add_argument("--watch", help="after processing keep watching "
+                    "directory and process new or changed EPUB files with "
+                    "the selected options", action="store_true")
+parser.add_argument("--debounce", nargs='?', type=float, metavar="SECONDS",
+                    default=2.0,
+                    help="process a file only after it has not changed for "
+                    "number of seconds (default: 2) (only with --watch)")
+parser.add_argument("--serve", nargs='?', type=int, metavar="PORT",
+                    const=8765, default=None,
+                    help="run local HTTP service for qcheck and qfix on "
+                    "127.0.0.1 (default port: 8765); uploaded files are "
+                    "stored in directory. Runs -q and/or -e if given, "
+                    "otherwise both")
+parser.add_argument("--queue-size", nargs='?', type=int, metavar="NUMBER",
+                    default=16,
+                    help="number of uploaded files waiting for processing "
+                    "before new ones are rejected (only with --serve)")
 args = parser.parse_args()
 uni_dir = args.directory
 tmpSend2KindDir = '_TEMP_SendToKindle'
+# set on first write, so --watch keeps updating the same timings report
+timings_path = None
 
 
 class Logger(object):
@@ -161,7 +243,7 @@ class Logger(object):
         pass 
 
 
-def main():
+def warn_ignored_options():
     if args.alter and not args.qcheck:
         print('* WARNING! -a was ignored because it works only with -q.')
     if args.huffdic and not args.kindlegen:
@@ -178,42 +260,91 @@ def main():
               'with -e.')
     if args.replace_font_files and not args.epub:
         print('* WARNING! -t was ignored because it works only with -e.')
+    if args.subset_fonts and not args.epub:
+        print('* WARNING! --subset-fonts was ignored because it works only '
+              'with -e.')
     if not args.skip_justify and not args.epub:
         print('* WARNING! --skip-justify was ignored because it works only '
               'with -e.')
     if args.left and not args.epub:
         print('* WARNING! --left was ignored because it works only with -e.')
-    if args.log == '1':
-        st = datetime.now().strftime('%Y%m%d%H%M%S')
-        sys.stdout = Logger(os.path.join(uni_dir, 'eQT-' + st + '.log'))
-    elif args.log != '1' and args.log is not None:
-        st = datetime.now().strftime('%Y%m%d%H%M%S')
-        sys.stdout = Logger(os.path.join(args.log, 'eQT-' + st + '.log'))
+    if args.debounce != 2.0 and not args.watch:
+        print('* WARNING! --debounce was ignored because it works only '
+              'with --watch.')
+    if args.font_store and not (args.font_report or args.epub):
+        print('* WARNING! --font-store was ignored because it works only '
+              'with --font-report or -e.')
+    if args.timings and not args.epub:
+        print('* WARNING! --timings was ignored because it works only '
+              'with -e.')
+    if args.no_check_cache and not args.qcheck:
+        print('* WARNING! --no-check-cache was ignored because it works only '
+              'with -q.')
+
+
+def main(ind_path=None):
+    if ind_path is None:
+        warn_ignored_options()
+        if args.log == '1':
+            st = datetime.now().strftime('%Y%m%d%H%M%S')
+            sys.stdout = Logger(os.path.join(uni_dir, 'eQT-' + st + '.log'))
+        elif args.log != '1' and args.log is not None:
+            st = datetime.now().strftime('%Y%m%d%H%M%S')
+            sys.stdout = Logger(os.path.join(args.log, 'eQT-' + st + '.log'))
     ind_file = ind_root = None
-    if args.individual == 'nonr':
+    fontcache.use_disk = not args.no_font_cache
+    timings.enabled = bool(args.timings and args.epub)
+    if args.font_store:
+        fontstore.store_dir = args.font_store
+    catalog = None
+    if ind_path is None and (args.individual is not None or args.catalog or
+                             args.rename):
+        # only the main process uses the catalog, --watch workers do not
+        catalog = Catalog()
+    if ind_path is not None:
+        # single file from --watch mode
+        ind_root, ind_file = os.path.split(ind_path)
+    elif args.individual == 'nonr':
         print('')
         print('**********************************************')
         print('*** Listing EPUB files for individual mode ***')
         print('**********************************************')
         print('')
-        counter = 0
-        for root, dirs, files in os.walk(uni_dir):
-            for f in files:
-                if f.lower().endswith('.epub') and not f.lower().endswith(
-                        '_moh.epub'):
-                    print(counter, os.path.join(root, f))
-                    counter += 1
+        for counter, path in enumerate(catalog.refresh(uni_dir, scan=False)):
+            print(counter, path)
+        catalog.close()
         return 0
     elif args.individual != 'nonr' and args.individual is not None:
-        counter = 0
-        for root, dirs, files in os.walk(uni_dir):
-            for f in files:
-                if f.lower().endswith('.epub') and not f.lower().endswith(
-                        '_moh.epub'):
-                    if counter == int(args.individual):
-                        ind_file = f
-                        ind_root = root
-                    counter += 1
+        path = catalog.select(uni_dir, int(args.individual))
+        if path is not None:
+            ind_root, ind_file = os.path.split(path)
+    if args.catalog and ind_path is None:
+        print('')
+        print('******************************************')
+        print('*** Catalog of EPUB files...           ***')
+        print('******************************************')
+        print('')
+        catalog.refresh(uni_dir)
+        print('nr', 'language', 'moh', 'mobi', 'author - title', 'file',
+              sep='\t')
+        for counter, book in enumerate(catalog.books(uni_dir)):
+            print(counter, book['language'] or '-',
+                  'yes' if book['has_moh'] else 'no',
+                  'yes' if book['has_mobi'] else 'no',
+                  ' & '.join(book['creators']) + ' - ' +
+                  (book['title'] or ''),
+                  book['path'], sep='\t')
+        print('')
+        print('* Catalog: %d book(s), %d (re)scanned, %d removed' % (
+            len(catalog.listing(uni_dir)), catalog.stats['scanned'],
+            catalog.stats['removed']))
+    if args.font_report and ind_path is None:
+        print('')
+        print('******************************************')
+        print('*** Report of fonts in EPUB files...   ***')
+        print('******************************************')
+        print('')
+        fontstore.font_report(uni_dir, args.font_store)
     if (
             (args.author or args.title) and args.individual != 'nonr' and
             args.individual is not None
@@ -224,6 +355,12 @@ def main():
         print('******************************************')
         print('')
         fix_name_author(ind_root, ind_file, args.author, args.title)
+    if args.metadata_csv and ind_path is None:
+        print('')
+        print('******************************************')
+        print('*** Processing authors and titles...   ***')
+        print('******************************************')
+        fix_name_author_csv(uni_dir, args.metadata_csv)
 
     if args.rename:
         print('')
@@ -231,28 +368,30 @@ def main():
         print('*** Renaming EPUBs to "author - title" ***')
         print('******************************************')
         print('')
+        if ind_path is not None:
+            books = [Catalog.read_book(ind_path)]
+        elif ind_file:
+            books = [catalog.book(os.path.join(ind_root, ind_file))]
+        else:
+            catalog.refresh(uni_dir)
+            books = catalog.books(uni_dir)
         counter = 0
-        if ind_file:
+        for book in books:
             counter += 1
-            fdec = ind_file
-            epbzf = zipfile.ZipFile(os.path.join(ind_root, ind_file))
-            opf_root, opf_path = find_opf(epbzf)
-            rename_files(opf_path, ind_root, epbzf, ind_file, fdec)
-        else:
-            for root, dirs, files in os.walk(uni_dir):
-                for f in files:
-                    fdec = f
-                    if f.lower().endswith('.epub') and not f.lower().endswith(
-                            '_moh.epub'):
-                        counter += 1
-                        try:
-                            epbzf = zipfile.ZipFile(os.path.join(root, f))
-                        except zipfile.BadZipfile as e:
-                            print('! CRITICAL! Problem with file "%s": %s' % (
-                                f, e))
-                            continue
-                        opf_root, opf_path = find_opf(epbzf)
-                        rename_files(opf_path, root, epbzf, f, fdec)
+            if book['opf_path'] is None:
+                print('! CRITICAL! Problem with file "%s": %s' % (
+                    book['name'], book['error']))
+                continue
+            new_name = rename_book(book['title'], book['creators'],
+                                   book['root'], book['name'], book['name'])
+            if new_name is not None:
+                if catalog is not None:
+                    catalog.move(book['path'],
+                                 os.path.join(book['root'], new_name))
+                if book['name'] == ind_file:
+                    ind_file = new_name
+        if catalog is not None:
+            catalog.db.commit()
         if counter == 0:
             print('* NO epub files for renaming found!')
 
@@ -275,93 +414,80 @@ def main():
         counter = 0
         if ind_file:
             counter += 1
-            qcheck(ind_root, ind_file_m, args.alter, args.mod, args.list_fonts)
+            qcheck(ind_root, ind_file_m, args.alter, args.mod, args.list_fonts,
+                   not args.no_check_cache)
         else:
             for root, dirs, files in os.walk(uni_dir):
                 for f in files:
                     if f.lower().endswith(fe) and not f.lower().endswith(nfe):
                         counter += 1
-                        qcheck(root, f, args.alter, args.mod, args.list_fonts)
+                        qcheck(root, f, args.alter, args.mod, args.list_fonts,
+                               not args.no_check_cache)
         if counter == 0:
             print('')
             print('* NO epub files for checking found!')
+        elif not args.no_check_cache:
+            print('')
+            print('* qcheck cache: %d file(s) replayed, %d file(s) '
+                  're-validated' % (checkcache.stats['hits'],
+                                    checkcache.stats['checked']))
 
     if args.epubcheck:
-
-        def epubchecker(echp_temp, root, f, epubcheckstr, epubcheckjar):
-            epubchecker_path = os.path.join(
-                echp_temp,
-                epubcheckstr, epubcheckjar
-            )
-            jp = subprocess.Popen([
-                'java', '-Djava.awt.headless=true', '-jar',
-                '%s' % epubchecker_path,
-                '%s' % os.path.join(root, f)
-            ], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                universal_newlines=True)
-            jpout, jperr = jp.communicate()
-            if jperr:
-                print(f + ': PROBLEMS FOUND...')
-                print('*** Details... ***')
-                print(jperr)
-            else:
-                print(f + ': OK!')
-                print('')
-
-        for e in os.listdir(os.path.join(args.tools)):
-            if e.startswith('epubcheck-5.'):
-                epubcheckstr = os.path.splitext(e)[0]
-                break
-            else:
-                epubcheckstr = ''
-        epubcheckjar = 'epubcheck.jar'
+        epubcheck_zip = find_epubcheck_zip(args.tools)
+        if epubcheck_zip is None:
+            sys.exit('EpubCheck 5.x ZIP file not found '
+                     'in directory: "' + args.tools + '" Giving up...')
+        epubcheckstr = os.path.splitext(os.path.basename(epubcheck_zip))[0]
 
         print('')
         print('***********************************************')
         print('*** Checking with ' + epubcheckstr + ' tool ***')
         print('***********************************************')
-        try:
-            subprocess.Popen(
-                ['java', '-version'],
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-        except FileNotFoundError:
+        if java_major_version() is None:
             sys.exit('Java is NOT installed. Giving up...')
         try:
-            echpzipfile = zipfile.ZipFile(os.path.join(args.tools,
-                                          epubcheckstr + '.zip'))
-        except FileNotFoundError:
-            sys.exit(epubcheckstr + 'EpubCheck 5.x ZIP file not found '
-                     'in directory: "' + args.tools + '" Giving up...')
-        echp_temp = tempfile.mkdtemp(suffix='', prefix='quiris-tmp-')
-        echpzipfile.extractall(echp_temp)
+            epubcheck_jar = extract_epubcheck(epubcheck_zip)
+        except (IOError, OSError, zipfile.BadZipfile) as e:
+            sys.exit('Unable to extract EpubCheck: ' + str(e) +
+                     ' Giving up...')
         if args.mod:
             fe = '_moh.epub'
             nfe = '_org.epub'
         else:
             fe = '.epub'
             nfe = '_moh.epub'
-        counter = 0
-
+        epub_paths = []
         if ind_file:
-            counter += 1
             if os.path.exists(os.path.join(ind_root, ind_file_m)):
-                epubchecker(echp_temp, ind_root, ind_file_m, epubcheckstr,
-                            epubcheckjar)
+                epub_paths.append(os.path.join(ind_root, ind_file_m))
             else:
                 print('File "%s" not found...' % ind_file_m)
         else:
             for root, dirs, files in os.walk(uni_dir):
                 for f in files:
                     if f.lower().endswith(fe) and not f.lower().endswith(nfe):
-                        counter += 1
-                        epubchecker(echp_temp, root, f, epubcheckstr,
-                                    epubcheckjar)
-        for p in os.listdir(os.path.join(echp_temp, os.pardir)):
-            if 'quiris-tmp-' in p:
-                if os.path.isdir(os.path.join(echp_temp, os.pardir, p)):
-                    shutil.rmtree(os.path.join(echp_temp, os.pardir, p))
-        if counter == 0:
+                        epub_paths.append(os.path.join(root, f))
+        runner = EpubCheckRunner(epubcheck_jar, jobs=args.jobs,
+                                 timeout=args.timeout)
+        checks = runner.run_all(epub_paths)
+        for path, result in checks:
+            f = os.path.basename(path)
+            if result.error is not None:
+                # drop the queued checks instead of waiting for them
+                checks.close()
+                sys.exit('Unable to run Java: ' + str(result.error) +
+                         ' Giving up...')
+            if result.timed_out:
+                print(f + ': TIMED OUT...')
+                print('')
+            elif result.stderr:
+                print(f + ': PROBLEMS FOUND...')
+                print('*** Details... ***')
+                print(result.stderr)
+            else:
+                print(f + ': OK!')
+                print('')
+        if not epub_paths and not ind_file:
             print('')
             print('* NO epub files for checking found!')
 
@@ -371,10 +497,11 @@ def main():
         print('*** Fixing with internal qfix tool...  ***')
         print('******************************************')
         counter = 0
-        try:
-            shutil.rmtree(os.path.join(uni_dir, tmpSend2KindDir))
-        except FileNotFoundError:
-            pass
+        if ind_path is None:
+            try:
+                shutil.rmtree(os.path.join(uni_dir, tmpSend2KindDir))
+            except FileNotFoundError:
+                pass
         if ind_file:
             counter += 1
             qfix(ind_root, ind_file, args.force, args.replace_font_files,
@@ -382,7 +509,8 @@ def main():
                  args.skip_justify, args.left, args.myk_fix,
                  args.remove_colors, args.remove_fonts, args.font_dir,
                  args.fix_missing_container, args.book_margin,
-                 args.skip_hyphenate_headers, args.replace_font_family)
+                 args.skip_hyphenate_headers, args.replace_font_family,
+                 args.subset_fonts)
         else:
             for root, dirs, files in os.walk(uni_dir):
                 for f in files:
@@ -397,7 +525,7 @@ def main():
                              args.remove_fonts, args.font_dir,
                              args.fix_missing_container,
                              args.book_margin, args.skip_hyphenate_headers,
-                             args.replace_font_family)
+                             args.replace_font_family, args.subset_fonts)
         if counter == 0:
             print('')
             print('* NO epub files for fixing found!')
@@ -408,64 +536,121 @@ def main():
         print('*** Converting with kindlegen tool...  ***')
         print('******************************************')
 
-        def to_mobi(root, f, cover_html_found, error_found):
+        if sys.platform == 'win32':
+            kgapp = 'kindlegen.exe'
+        else:
+            kgapp = 'kindlegen'
+        if os.path.isfile(os.path.join(args.tools, kgapp)):
+            kgpath = os.path.join(args.tools, kgapp)
+        else:
+            kgpath = shutil.which(kgapp)
+        if kgpath is None:
+            sys.exit('ERROR! Kindlegen not found in directory: "' +
+                     args.tools + '" Giving up...')
+
+        def mobi_job(root, f):
             newmobifile = os.path.splitext(f)[0] + '.mobi'
+            epub_path = os.path.join(root, f)
+            mobi_path = os.path.join(root, newmobifile)
+            report = None
             if not args.force:
-                if os.path.isfile(os.path.join(root, newmobifile)):
-                    print('* Skipping previously generated _moh file: ' +
-                          newmobifile)
-                    return 0
+                report = mobicache.lookup(epub_path, mobi_path, compression,
+                                          kgversion)
+            if report is not None:
+                return f, report, None
+            # kindlegen writes next to the source, under the given name
+            output = AtomicOutput(mobi_path, '.mobi')
+            return f, None, Job([
+                kgpath,
+                '-dont_append_source',
+                compression,
+                epub_path,
+                '-o',
+                os.path.basename(output.path)
+            ], (epub_path, mobi_path, output))
+
+        def print_mobi_report(f, report):
+            for ln in report['lines']:
+                print(' ', ln)
+            if not report['cover_html_found'] and not report['error_found']:
+                print('')
+                print('* WARNING: Probably duplicated covers generated '
+                      'in file: ' + os.path.splitext(f)[0] + '.mobi')
+
+        def print_mobi_result(f, result):
             print('')
             print('* Kindlegen: Converting file: ' + f)
-            if sys.platform == 'win32':
-                kgapp = 'kindlegen.exe'
-            else:
-                kgapp = 'kindlegen'
-            try:
-                proc = subprocess.Popen([
-                    os.path.join(args.tools, kgapp),
-                    '-dont_append_source',
-                    compression,
-                    os.path.join(root, f)
-                ], stdout=subprocess.PIPE).communicate()[0]
-            except OSError:
-                try:
-                    proc = subprocess.Popen([
-                        os.path.join(kgapp),
-                        '-dont_append_source',
-                        compression,
-                        os.path.join(root, f)
-                    ], stdout=subprocess.PIPE).communicate()[0]
-                except FileNotFoundError:
-                    sys.exit('ERROR! Kindlegen not found in directory: "' +
-                             args.tools + '" Giving up...')
-            for ln in str(proc, 'utf-8').splitlines():
-                if 'Warning' in ln and 'W14029' not in ln:
-                    print(' ', ln)
-                if 'Error' in ln:
+            if result.error is not None:
+                sys.exit('ERROR! Unable to run kindlegen: ' +
+                         str(result.error) + ' Giving up...')
+            report = mobicache.parse_output(
+                str(result.stdout, 'utf-8', 'replace')
+            )
+            errors = str(result.stderr, 'utf-8', 'replace').strip()
+            if result.timed_out:
+                for ln in report['lines']:
                     print(' ', ln)
-                    error_found = True
-                if ('I1052' in ln):
-                    cover_html_found = True
-            if not cover_html_found and not error_found:
-                print('')
-                print('* WARNING: Probably duplicated covers generated '
-                      'in file: ' + newmobifile)
+                if errors:
+                    print(errors)
+                print('* ERROR! Kindlegen timed out for file: ' + f)
+                return
+            if result.returncode != 0 and not result.stdout.strip():
+                if errors:
+                    print(errors)
+                print('* ERROR! Kindlegen failed with exit code %d for '
+                      'file: %s' % (result.returncode, f))
+                return
+            print_mobi_report(f, report)
+            if errors:
+                print(errors)
+            return report
 
         compression = '-c2' if args.huffdic else '-c1'
+        kgversion = mobicache.kindlegen_version(kgpath)
         counter = 0
-        cover_html_found = error_found = False
+        entries = []
         if ind_file:
             counter += 1
-            to_mobi(ind_root, os.path.splitext(ind_file)[0] + '_moh.epub',
-                    cover_html_found, error_found)
+            entries.append(mobi_job(
+                ind_root, os.path.splitext(ind_file)[0] + '_moh.epub'
+            ))
         else:
             for root, dirs, files in os.walk(uni_dir):
                 for f in files:
-                    cover_html_found = error_found = False
                     if f.lower().endswith('_moh.epub'):
                         counter += 1
-                        to_mobi(root, f, cover_html_found, error_found)
+                        entries.append(mobi_job(root, f))
+        results = run_jobs([job for f, report, job in entries
+                            if job is not None], args.jobs, args.timeout)
+        for f, report, job in entries:
+            if job is None:
+                mobicache.stats['hits'] += 1
+                print('* Skipping unchanged _moh file: ' +
+                      os.path.splitext(f)[0] + '.mobi')
+                print_mobi_report(f, report)
+                continue
+            job, result = next(results)
+            if result.error is not None:
+                # print_mobi_result gives up, drop the queued conversions
+                results.close()
+            mobicache.stats['converted'] += 1
+            report = print_mobi_result(f, result)
+            epub_path, mobi_path, output = job.data
+            if (report is not None and not report['error_found'] and
+                    os.path.isfile(output.path)):
+                output.commit()
+                mobicache.store(epub_path, mobi_path, compression, kgversion,
+                                report)
+            else:
+                if report is not None and not report['error_found']:
+                    print('* ERROR! Kindlegen did not create file: ' +
+                          os.path.basename(mobi_path))
+                output.discard()
+        if counter:
+            print('')
+            print('* kindlegen cache: %d file(s) reused, %d file(s) '
+                  'converted' % (mobicache.stats['hits'],
+                                 mobicache.stats['converted']))
         if counter == 0:
             print('')
             print('* NO *_moh.epub files for converting found!')
@@ -477,16 +662,22 @@ def main():
         print('***********************************************')
 
         counter = 0
+        prepared = []
         if ind_file:
             counter += 1
-            to_azk(ind_root, os.path.splitext(ind_file)[0] + '_moh.mobi',
-                   args.force)
+            prepared.append(prepare_azk(
+                ind_root, os.path.splitext(ind_file)[0] + '_moh.mobi',
+                args.force
+            ))
         else:
             for root, dirs, files in os.walk(uni_dir):
                 for f in files:
                     if f.lower().endswith('_moh.mobi'):
                         counter += 1
-                        to_azk(root, f, args.force)
+                        prepared.append(prepare_azk(root, f, args.force))
+        prepared = [p for p in prepared if p is not None]
+        for job, result in run_jobs(prepared, args.jobs, args.timeout):
+            finish_azk(job, result)
         if counter == 0:
             print('')
             print('* NO *_moh.mobi files for converting found!')
@@ -532,6 +723,15 @@ def main():
         if counter == 0:
             print('* NO MOH files for copy and rename found!')
 
+    summary = fontcache.summary()
+    if summary is not None and ind_path is None:
+        print('')
+        print('* ' + summary)
+    if timings.enabled and timings.books and ind_path is None:
+        write_timings()
+        print('* Timings of %d book(s) written to: %s' % (
+            len(timings.books), timings_path))
+
     if len(sys.argv) == 2:
         parser.print_help()
         print("* * *")
@@ -540,5 +740,97 @@ def main():
     return 0
 
 
+def write_timings():
+    ''' Write JSON report of timings of all books processed so far '''
+    global timings_path
+    if timings_path is None:
+        if args.timings is True:
+            st = datetime.now().strftime('%Y%m%d%H%M%S')
+            timings_path = os.path.join(uni_dir, 'eQT-timings-' + st + '.json')
+        else:
+            timings_path = args.timings
+    timings.write_report(timings_path)
+
+
+def process_watched(path):
+    '''
+    Worker: run selected phases for one file and return its output and
+    timings of the book (empty list without --timings)
+    '''
+    out = io.StringIO()
+    # worker processes are reused, keep only timings of this file
+    del timings.books[:]
+    try:
+        with contextlib.redirect_stdout(out):
+            main(path)
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            out.write('%s\n' % e.code)
+    except Exception as e:
+        out.write('! CRITICAL! Processing file "%s" failed: %r\n' % (path, e))
+    return out.getvalue(), list(timings.books)
+
+
+def watch(watcher):
+    jobs = args.jobs or os.cpu_count() or 1
+    print('')
+    print('******************************************')
+    print('*** Watching for new EPUB files...     ***')
+    print('******************************************')
+    print('* Directory: "%s" (%s, %d job(s)). Press Ctrl+C to stop.' % (
+        watcher.directory, watcher.mode, jobs))
+    queue = []
+    running = {}
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=signal.signal,
+            initargs=(signal.SIGINT, signal.SIG_IGN)) as pool:
+        try:
+            while True:
+                for path in watcher.poll(1.0 if running else None):
+                    if path not in queue:
+                        queue.append(path)
+                # a file changed again while processed waits for its turn
+                for path in [p for p in queue if p not in running]:
+                    if len(running) >= jobs:
+                        break
+                    queue.remove(path)
+                    print('* %s: processing "%s"' % (
+                        datetime.now().strftime('%H:%M:%S'), path))
+                    running[path] = pool.submit(process_watched, path)
+                for path, future in list(running.items()):
+                    if future.done():
+                        del running[path]
+                        output, books = future.result()
+                        sys.stdout.write(output)
+                        sys.stdout.flush()
+                        if books:
+                            # the report covers the initial run and every
+                            # watched book, rewritten after each of them
+                            timings.books.extend(books)
+                            write_timings()
+        except KeyboardInterrupt:
+            print('')
+            print('* Watching stopped.')
+            if timings_path is not None:
+                print('* Timings of %d book(s) written to: %s' % (
+                    len(timings.books), timings_path))
+        finally:
+            watcher.close()
+    return 0
+
+
 if __name__ == '__main__':
+    if args.serve is not None:
+        stages = [s for s, on in (('qcheck', args.qcheck),
+                                  ('qfix', args.epub)) if on]
+        sys.exit(serve(uni_dir, args, args.serve, workers=args.jobs,
+                       queue_size=args.queue_size,
+                       stages=stages or ['qcheck', 'qfix']))
+    if args.watch:
+        if args.individual is not None:
+            sys.exit('--watch cannot be used with -i. Giving up...')
+        watcher = DirectoryWatcher(uni_dir, args.debounce,
+                                   skip_dirs=[tmpSend2KindDir])
+        main()
+        sys.exit(watch(watcher))
     sys.exit(main())
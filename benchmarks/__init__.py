@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+'''
+Performance benchmarks of epubQTools.
+
+corpus.py generates a deterministic corpus of synthetic EPUB files and
+run.py times the processing stages on it and writes JSON results, so runs
+of different commits can be compared:
+
+    python -m benchmarks.run --books 20 -o before.json
+    python -m benchmarks.run --books 20 -o after.json --compare before.json
+
+The bench_*.py scripts compare single functions with their previous
+implementations.
+'''
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+'''
+Compare the old linear segment scan of get_bmp_glyph_ids with BMPCmap
+binary search. Every character of a text file (default: all code points
+of the BMP) is looked up in each font, so this is the cost of a whole
+book coverage check.
+
+    python benchmarks/bench_cmap.py FONT [FONT ...] [--text FILE]
+'''
+
+import argparse
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lib.fntutls  # noqa: E402
+
+
+def legacy_get_bmp_glyph_ids(table, bmp, codes):
+    (start_count, end_count, range_offset, id_delta, glyph_id_len,
+     glyph_id_map, array_len) = lib.fntutls.read_bmp_prefix(table, bmp)
+    for code in codes:
+        found = False
+        for i, ec in enumerate(end_count):
+            if ec >= code:
+                sc = start_count[i]
+                if sc <= code:
+                    found = True
+                    ro = range_offset[i]
+                    if ro == 0:
+                        glyph_id = id_delta[i] + code
+                    else:
+                        idx = ro // 2 + (code - sc) + i - array_len
+                        glyph_id = glyph_id_map[idx]
+                        if glyph_id != 0:
+                            glyph_id += id_delta[i]
+                    yield glyph_id % 0x10000
+                    break
+        if not found:
+            yield 0
+
+
+def load_fonts(paths):
+    fonts = []
+    for p in paths:
+        with open(p, 'rb') as f:
+            raw = f.read()
+        try:
+            table = lib.fntutls.get_table(raw, 'cmap')[0]
+            if table is None:
+                raise lib.fntutls.UnsupportedFont('no cmap table')
+            bmp = lib.fntutls.find_bmp_subtable(table)
+        except (lib.fntutls.UnsupportedFont, ValueError, struct.error) as e:
+            print('* Skipping %s: %s' % (p, e))
+            continue
+        fonts.append((raw, table, bmp))
+    return fonts
+
+
+def legacy(fonts, codes):
+    return [list(legacy_get_bmp_glyph_ids(table, bmp, codes))
+            for raw, table, bmp in fonts]
+
+
+def bisected(fonts, codes):
+    # cold cache: includes building BMPCmap once per font
+    lib.fntutls.get_bmp_cmap.cache_clear()
+    return [lib.fntutls.get_cmap(raw).glyph_ids(codes)
+            for raw, table, bmp in fonts]
+
+
+def best_of(func, fonts, codes, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(fonts, codes)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fonts', nargs='+', help='TrueType/OpenType files')
+    parser.add_argument('--text', help='UTF-8 text file with characters to '
+                        'look up (default: whole BMP)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs; the best one is reported')
+    args = parser.parse_args()
+    fonts = load_fonts(args.fonts)
+    if not fonts:
+        sys.exit('No usable fonts given.')
+    if args.text:
+        with open(args.text, encoding='utf-8') as f:
+            codes = sorted(set(map(ord, f.read())))
+    else:
+        codes = list(range(0x10000))
+    print('* %d font(s), %d code point(s), best of %d run(s)' % (
+        len(fonts), len(codes), args.repeat))
+    old, old_result = best_of(legacy, fonts, codes, args.repeat)
+    new, new_result = best_of(bisected, fonts, codes, args.repeat)
+    if old_result != new_result:
+        sys.exit('ERROR! Glyph ids differ between implementations.')
+    print('linear segment scan: %.4f s' % old)
+    print('BMPCmap bisect:      %.4f s' % new)
+    if new:
+        print('speedup: %.1fx' % (old / new))
+
+
+if __name__ == '__main__':
+    main()
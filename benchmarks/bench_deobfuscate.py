@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+'''
+Compare the old per-byte XOR of decrypt_font (itertools.cycle over the
+key) with deobfuscate_font for Adobe and IDPF font obfuscation. Every font
+is obfuscated and deobfuscated again and the results of both
+implementations are checked against the original bytes.
+
+    python benchmarks/bench_deobfuscate.py FONT [FONT ...] [--repeat N]
+'''
+
+import argparse
+import hashlib
+import os
+import sys
+import time
+import uuid
+from itertools import cycle
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.epubqfix import ADOBE_OBFUSCATION  # noqa: E402
+from lib.epubqfix import IDPF_OBFUSCATION  # noqa: E402
+from lib.epubqfix import OBFUSCATED_LENGTH  # noqa: E402
+from lib.epubqfix import deobfuscate_font  # noqa: E402
+
+BOOK_ID = 'urn:uuid:0b5e4c2e-63b4-4c5c-9f4f-2d1b9e0c7a11'
+KEYS = {
+    ADOBE_OBFUSCATION: uuid.UUID(BOOK_ID[9:]).bytes,
+    IDPF_OBFUSCATION: hashlib.sha1(BOOK_ID.encode('utf-8')).digest(),
+}
+NAMES = {ADOBE_OBFUSCATION: 'Adobe', IDPF_OBFUSCATION: 'IDPF'}
+
+
+def legacy_deobfuscate(raw, key, method):
+    crypt_len = OBFUSCATED_LENGTH[method]
+    crypt = bytearray(raw[:crypt_len])
+    key = cycle(iter(bytearray(key)))
+    decrypt = bytes(bytearray(x ^ next(key) for x in crypt))
+    return decrypt + raw[crypt_len:]
+
+
+def run(func, fonts, key, method, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = [func(raw, key, method) for raw in fonts]
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fonts', nargs='+', help='TrueType/OpenType files')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of runs; the best one is reported')
+    args = parser.parse_args()
+    plain = []
+    for p in args.fonts:
+        with open(p, 'rb') as f:
+            plain.append(f.read())
+    print('* %d font(s), best of %d run(s)' % (len(plain), args.repeat))
+    for method in (ADOBE_OBFUSCATION, IDPF_OBFUSCATION):
+        key = KEYS[method]
+        obfuscated = [deobfuscate_font(raw, key, method) for raw in plain]
+        if any(o[:4] == p[:4] for o, p in zip(obfuscated, plain)):
+            sys.exit('ERROR! %s obfuscation left signature intact.'
+                     % NAMES[method])
+        old, old_result = run(legacy_deobfuscate, obfuscated, key, method,
+                              args.repeat)
+        new, new_result = run(deobfuscate_font, obfuscated, key, method,
+                              args.repeat)
+        if old_result != plain or new_result != plain:
+            sys.exit('ERROR! %s round trip does not restore the fonts.'
+                     % NAMES[method])
+        print('%-5s per-byte cycle: %.4f s' % (NAMES[method], old))
+        print('%-5s integer XOR:    %.4f s' % (NAMES[method], new))
+        if new:
+            print('%-5s speedup: %.1fx' % (NAMES[method], old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+'''
+Compare reading EXTH metadata the old way (whole file in memory, one
+EXTH scan per record ID) with MobiHeader and its one-pass EXTH index.
+
+    python benchmarks/bench_exth.py DIR [--repeat N]
+'''
+
+import argparse
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.mobiheader import InvalidMobi  # noqa: E402
+from lib.mobiheader import MobiHeader  # noqa: E402
+
+EXTH_IDS = (100, 503, 101)
+
+
+def legacy_find_exth(search_id, content):
+    exth_begin = content.find(b'EXTH')
+    exth_header = content[exth_begin:]
+    count_items, = struct.unpack('>L', exth_header[8:12])
+    pos = 12
+    for _ in range(count_items):
+        id, size = struct.unpack('>LL', exth_header[pos:pos + 8])
+        if id == search_id:
+            return exth_header[pos + 8:pos + size]
+        pos += size
+    return None
+
+
+def legacy(paths):
+    for p in paths:
+        with open(p, 'rb') as f:
+            content = f.read()
+        for i in EXTH_IDS:
+            legacy_find_exth(i, content)
+
+
+def indexed(paths):
+    for p in paths:
+        header = MobiHeader(p)
+        for i in EXTH_IDS:
+            header.exth(i)
+
+
+def find_mobi_files(directory):
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        for f in files:
+            if os.path.splitext(f)[1].lower() not in ('.mobi', '.azw',
+                                                      '.azw3'):
+                continue
+            p = os.path.join(root, f)
+            try:
+                MobiHeader(p)
+            except (IOError, OSError, InvalidMobi):
+                continue
+            paths.append(p)
+    return paths
+
+
+def best_of(func, paths, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(paths)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', help='directory with MOBI files')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of runs; the best one is reported')
+    args = parser.parse_args()
+    paths = find_mobi_files(args.directory)
+    if not paths:
+        sys.exit('No valid MOBI files found in: ' + args.directory)
+    print('* %d MOBI file(s), best of %d run(s)' % (len(paths), args.repeat))
+    old = best_of(legacy, paths, args.repeat)
+    new = best_of(indexed, paths, args.repeat)
+    print('legacy full read + scan per ID: %.4f s' % old)
+    print('MobiHeader + EXTH index:        %.4f s' % new)
+    if new:
+        print('speedup: %.1fx' % (old / new))
+
+
+if __name__ == '__main__':
+    main()
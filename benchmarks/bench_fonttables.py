@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+'''
+Compare the old table lookup of fntutls (every get_table call walks the
+table directory and copies each table it passes) with the Font view for
+the work done by font listing: names, OS/2 characteristics, cmap and
+checksum verification. Reports time and bytes allocated.
+
+    python benchmarks/bench_fonttables.py FONT [FONT ...] [--repeat N]
+'''
+
+import argparse
+import os
+import struct
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lib.fntutls  # noqa: E402
+
+TABLES = ('name', 'os/2', 'cmap', 'head', 'glyf')
+
+
+def legacy_get_tables(raw):
+    num_tables = struct.unpack_from(b'>H', raw, 4)[0]
+    offset = 4*3
+    for i in range(num_tables):
+        tag, checksum, table_offset, length = struct.unpack_from(
+            b'>4s3L', raw, offset)
+        yield tag, raw[table_offset:table_offset+length], offset, \
+            table_offset, checksum
+        offset += 4*4
+
+
+def legacy_get_table(raw, name):
+    name = bytes(name.lower(), encoding='utf-8')
+    for tag, table, index, offset, checksum in legacy_get_tables(raw):
+        if tag.lower() == name:
+            return table
+    return None
+
+
+def legacy_checksum(raw):
+    extra = 4 - len(raw) % 4
+    raw += b'\0'*extra
+    return sum(struct.unpack(b'>%dI' % (len(raw)//4), raw)) % (1 << 32)
+
+
+def legacy(fonts):
+    result = []
+    for raw in fonts:
+        tables = [legacy_get_table(raw, name) for name in TABLES]
+        sums = [legacy_checksum(t) for tag, t, i, o, c in
+                legacy_get_tables(raw) if tag != b'head']
+        result.append(([len(t) for t in tables if t is not None], sums))
+    return result
+
+
+def view(fonts):
+    result = []
+    for raw in fonts:
+        font = lib.fntutls.Font(raw)
+        tables = [font.table(name) for name in TABLES]
+        sums = [lib.fntutls.checksum_of_block(t) for tag, t, i, o, c in
+                font.tables() if tag != b'head']
+        result.append(([len(t) for t in tables if t is not None], sums))
+    return result
+
+
+def measure(func, fonts, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(fonts)
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func(fonts)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(timings), peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fonts', nargs='+', help='TrueType/OpenType files')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of runs; the best one is reported')
+    args = parser.parse_args()
+    fonts = []
+    for p in args.fonts:
+        with open(p, 'rb') as f:
+            raw = f.read()
+        if not lib.fntutls.is_truetype_font(raw)[0]:
+            print('* Skipping %s: not a TrueType/OpenType font' % p)
+            continue
+        fonts.append(raw)
+    if not fonts:
+        sys.exit('No usable fonts given.')
+    print('* %d font(s), best of %d run(s)' % (len(fonts), args.repeat))
+    old, old_peak, old_result = measure(legacy, fonts, args.repeat)
+    new, new_peak, new_result = measure(view, fonts, args.repeat)
+    if old_result != new_result:
+        sys.exit('ERROR! Tables differ between implementations.')
+    print('copied tables: %.4f s, peak %d bytes allocated' % (old, old_peak))
+    print('Font view:     %.4f s, peak %d bytes allocated' % (new, new_peak))
+    if new:
+        print('speedup: %.1fx' % (old / new))
+
+
+if __name__ == '__main__':
+    main()
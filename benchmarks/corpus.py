@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+'''
+Generate a deterministic corpus of synthetic EPUB files. The same options
+and seed always give byte-identical files, so timings of different
+commits are comparable.
+
+    python -m benchmarks.corpus DIR [--books N] [--chapters N] ...
+'''
+
+import argparse
+import hashlib
+import os
+import random
+import struct
+import sys
+import uuid
+import zipfile
+import zlib
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lib.fntutls  # noqa: E402
+from lib.epubqfix import ADOBE_OBFUSCATION  # noqa: E402
+from lib.epubqfix import IDPF_OBFUSCATION  # noqa: E402
+from lib.epubqfix import deobfuscate_font  # noqa: E402
+
+# fixed zip timestamp, the default would make every corpus unique
+ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+
+WORDS = (
+    'i w z o a u że się nie na to jest jak ale tak już tylko przez był '
+    'była było może jeszcze wszystko bardzo kiedy gdzie dlaczego przecież '
+    'dom las pole rzeka droga miasto okno drzwi stół książka słowo zdanie '
+    'człowiek kobieta dziecko przyjaciel nauczyciel rzeczywistość '
+    'odpowiedzialność niebezpieczeństwo przedsiębiorstwo państwowe '
+    'nieprawdopodobny zażółć gęślą jaźń źdźbło chrząszcz brzmi trzcinie '
+    'współczesność najprawdopodobniej zainteresowanie porozumienie '
+    'wyobraźnia sprawiedliwość pięćdziesięciu niedźwiedź gwiazdozbiór '
+    'szczęśliwy dźwięk światło ciemność wieczór poranek spokojnie '
+    'powiedział zapytała odpowiedziała spojrzał uśmiechnęła zrozumiał '
+    'wrócili zobaczyła usłyszał pomyślała'
+).split()
+
+FIRST_NAMES = ('Jan', 'Anna', 'Piotr', 'Maria', 'Tomasz', 'Zofia', 'Paweł',
+               'Ewa', 'Łukasz', 'Małgorzata')
+SURNAMES = ('Kowalski', 'Nowak', 'Wiśniewska', 'Wójcik', 'Kamińska',
+            'Lewandowski', 'Zieliński', 'Szymańska', 'Woźniak', 'Dąbrowski')
+
+FONT_STYLES = (('Regular', False, False), ('Italic', False, True),
+               ('Bold', True, False), ('BoldItalic', True, True))
+FONT_CHARS = (
+    ''.join(chr(c) for c in range(0x20, 0x7F)) +
+    'ąćęłńóśźżĄĆĘŁŃÓŚŹŻ ­–—„”…'
+)
+OBFUSCATION = ('none', 'idpf', 'adobe', 'mixed')
+
+DEFECTS = {
+    'ds_store': '.DS_Store file in the content directory',
+    'calibre_bookmarks': 'META-INF/calibre_bookmarks.txt',
+    'xml_extension': 'last chapter stored with .xml extension',
+    'display_none': 'watermark paragraph hidden with display: none',
+    'broken_link': 'link to a file which is not in the book',
+    'missing_ncx_uid': 'NCX without dtb:uid',
+    'wrong_language': 'dc:language set to "en"',
+    'dl_toc': 'HTML table of contents built with dl',
+}
+
+CONTAINER = (
+    '<?xml version="1.0"?>\n<container version="1.0" xmlns="urn:oasis:names'
+    ':tc:opendocument:xmlns:container"><rootfiles><rootfile full-path="OEBPS'
+    '/content.opf" media-type="application/oebps-package+xml"/></rootfiles>'
+    '</container>'
+)
+
+
+# --- fonts ---
+
+def box_glyph():
+    ''' Simple glyph with one rectangular contour '''
+    return struct.pack(b'>5h', 1, 50, 0, 550, 700) + \
+        struct.pack(b'>HH', 3, 0) + bytes([0x01] * 4) + \
+        struct.pack(b'>4h', 50, 0, 500, 0) + \
+        struct.pack(b'>4h', 0, 700, 0, -700) + b'\0\0'
+
+
+def name_table(names):
+    records = []
+    strings = b''
+    for name_id in sorted(names):
+        data = names[name_id].encode('utf-16-be')
+        records.append(struct.pack(b'>6H', 3, 1, 0x409, name_id, len(data),
+                                   len(strings)))
+        strings += data
+    return struct.pack(b'>3H', 0, len(records), 6 + 12 * len(records)) + \
+        b''.join(records) + strings
+
+
+def make_font(family, style, bold, italic):
+    ''' Minimal valid TrueType font with a box glyph for every FONT_CHARS '''
+    num_glyphs = len(FONT_CHARS) + 1
+    glyph = box_glyph()
+    glyf = b''.join([glyph] * len(FONT_CHARS))
+    # glyph 0 (.notdef) is empty
+    loca = [0, 0] + [len(glyph) * (i + 1) for i in range(len(FONT_CHARS))]
+    mac_style = (1 if bold else 0) | (2 if italic else 0)
+    selection = (0x20 if bold else 0) | (0x01 if italic else 0)
+    if not bold and not italic:
+        selection = 0x40
+    ps_name = (family + '-' + style).replace(' ', '')
+    tables = {
+        b'head': struct.pack(b'>4I2H2q4h2H3h', 0x00010000, 0x00010000, 0,
+                             0x5F0F3CF5, 0x000B, 1000, 0, 0, 0, 0, 600, 800,
+                             mac_style, 8, 2, 0, 0),
+        b'hhea': struct.pack(b'>I3hH3h3h4hhH', 0x00010000, 800, -200, 0,
+                             600, 0, 0, 600, 1, 0, 0, 0, 0, 0, 0, 0,
+                             num_glyphs),
+        b'maxp': struct.pack(b'>IH13H', 0x00010000, num_glyphs, 4, 1, 0, 0,
+                             2, 0, 0, 0, 0, 0, 0, 0, 0),
+        b'OS/2': struct.pack(
+            b'>Hh3H11h10B4L4s3H3h2H2L2h3H', 4, 600, 700 if bold else 400, 5,
+            0, 650, 600, 0, 75, 650, 600, 0, 350, 50, 250, 0,
+            2, 2, 6, 3, 5, 4, 5, 2, 3, 4, 3, 0, 0, 0, b'EQTB', selection,
+            0x20, 0x2026, 800, -200, 0, 800, 200, 3, 0, 500, 700, 0, 0x20,
+            1),
+        b'hmtx': struct.pack(b'>Hh', 600, 0) * num_glyphs,
+        b'post': struct.pack(b'>Iihh5I', 0x00030000,
+                             -12 << 16 if italic else 0, -100, 50, 0, 0, 0,
+                             0, 0),
+        b'name': name_table({1: family, 2: style, 4: family + ' ' + style,
+                             6: ps_name}),
+        b'cmap': lib.fntutls.build_bmp_cmap(
+            dict((ord(c), i + 1) for i, c in enumerate(FONT_CHARS))),
+        b'loca': struct.pack(b'>%dH' % len(loca), *[x // 2 for x in loca]),
+        b'glyf': glyf,
+    }
+    return lib.fntutls.build_sfnt(b'\x00\x01\x00\x00', tables)
+
+
+# --- images ---
+
+def png_chunk(tag, data):
+    return struct.pack(b'>I', len(data)) + tag + data + \
+        struct.pack(b'>I', zlib.crc32(tag + data) & 0xffffffff)
+
+
+def make_png(rng, width, height):
+    ''' RGB PNG with random (hardly compressible) pixels '''
+    rows = b''.join(b'\0' + rng.randbytes(width * 3) for _ in range(height))
+    return b'\x89PNG\r\n\x1a\n' + \
+        png_chunk(b'IHDR', struct.pack(b'>2I5B', width, height, 8, 2, 0, 0,
+                                       0)) + \
+        png_chunk(b'IDAT', zlib.compress(rows, 6)) + png_chunk(b'IEND', b'')
+
+
+# --- text ---
+
+def sentence(rng):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(5, 16))]
+    return words[0].capitalize() + ' ' + ' '.join(words[1:]) + \
+        rng.choice(('.', '.', '.', '?', '!', '…'))
+
+
+def paragraph(rng, words):
+    text = []
+    count = 0
+    while count < words:
+        s = sentence(rng)
+        count += s.count(' ') + 1
+        text.append(s)
+    return escape(' '.join(text))
+
+
+def xhtml(title, body, lang='pl', css='style.css'):
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" '
+        '"http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="%s"><head>'
+        '<title>%s</title><link href="%s" rel="stylesheet" '
+        'type="text/css"/></head>\n<body>\n%s\n</body></html>\n'
+        % (lang, escape(title), css, body)
+    )
+
+
+def nav_points(entries, counter):
+    ''' NCX navPoints from nested list of (label, src, children) '''
+    out = []
+    for label, src, children in entries:
+        counter[0] += 1
+        out.append(
+            '<navPoint id="np%d" playOrder="%d"><navLabel><text>%s</text>'
+            '</navLabel><content src="%s"/>%s</navPoint>' % (
+                counter[0], counter[0], escape(label), src,
+                nav_points(children, counter))
+        )
+    return ''.join(out)
+
+
+def chapter_body(rng, number, href, words, ncx_depth, images):
+    '''
+    Return (body, toc entry) of chapter. Every level below the chapter
+    heading has two sections, down to ncx_depth levels.
+    '''
+    parts = ['<h1 id="ch%d">Rozdział %d</h1>' % (number, number)]
+    per_section = max(1, words // (2 ** (ncx_depth - 1)))
+
+    def sections(level, prefix):
+        children = []
+        if level > ncx_depth:
+            parts.append('<p>%s</p>' % paragraph(rng, per_section))
+            return children
+        for i in (1, 2):
+            anchor = '%s-%d' % (prefix, i)
+            label = 'Część %s' % anchor.split('-', 1)[1].replace('-', '.')
+            parts.append('<h%d id="%s">%s</h%d>' % (
+                min(level, 6), anchor, label, min(level, 6)))
+            children.append((label, '%s#%s' % (href, anchor),
+                             sections(level + 1, anchor)))
+        return children
+
+    children = sections(2, 'ch%d' % number)
+    for image in images:
+        parts.insert(rng.randint(1, len(parts)),
+                     '<div class="img"><img src="%s" alt=""/></div>' % image)
+    return '\n'.join(parts), ('Rozdział %d' % number, href + '#ch%d' % number,
+                              children)
+
+
+def make_book(rng, number, chapters=10, words=2000, images=2, fonts=0,
+              obfuscation='none', ncx_depth=2, defects=()):
+    ''' Return (file name, list of (member name, bytes)) of one book '''
+    first, surname = rng.choice(FIRST_NAMES), rng.choice(SURNAMES)
+    title = ' '.join(w.capitalize() for w in rng.sample(WORDS[20:], 3))
+    book_id = 'urn:uuid:' + str(uuid.UUID(int=rng.getrandbits(128),
+                                          version=4))
+    lang = 'en' if 'wrong_language' in defects else 'pl'
+    members = [('mimetype', b'application/epub+zip'),
+               ('META-INF/container.xml', CONTAINER.encode('utf-8'))]
+    items = []
+    spine = []
+    toc = []
+
+    cover = make_png(rng, 120, 180)
+    members.append(('OEBPS/images/cover.png', cover))
+    items.append(('cover-image', 'images/cover.png', 'image/png'))
+    members.append(('OEBPS/cover.xhtml', xhtml(
+        'Okładka', '<div><img src="images/cover.png" alt="Okładka"/></div>',
+        lang).encode('utf-8')))
+    items.append(('cover', 'cover.xhtml', 'application/xhtml+xml'))
+    spine.append('cover')
+
+    image_hrefs = []
+    for i in range(images):
+        href = 'images/img%03d.png' % (i + 1)
+        members.append(('OEBPS/' + href, make_png(rng, rng.randint(40, 200),
+                                                  rng.randint(40, 200))))
+        items.append(('img%d' % (i + 1), href, 'image/png'))
+        image_hrefs.append(href)
+
+    if obfuscation == 'mixed':
+        obfuscation = OBFUSCATION[number % 3]
+    encrypted = []
+    faces = []
+    family = 'Bench Serif'
+    for i, (style, bold, italic) in enumerate(FONT_STYLES[:fonts]):
+        href = 'fonts/BenchSerif-%s.ttf' % style
+        raw = make_font(family, style, bold, italic)
+        if obfuscation == 'idpf':
+            raw = deobfuscate_font(raw, hashlib.sha1(
+                book_id.encode('utf-8')).digest(), IDPF_OBFUSCATION)
+        elif obfuscation == 'adobe':
+            raw = deobfuscate_font(raw, uuid.UUID(book_id[9:]).bytes,
+                                   ADOBE_OBFUSCATION)
+        if obfuscation in ('idpf', 'adobe'):
+            encrypted.append('OEBPS/' + href)
+        members.append(('OEBPS/' + href, raw))
+        items.append(('font%d' % (i + 1), href, 'application/x-font-ttf'))
+        faces.append('@font-face { font-family: "%s"; font-weight: %s; '
+                     'font-style: %s; src: url(%s) }' % (
+                         family, 'bold' if bold else 'normal',
+                         'italic' if italic else 'normal', href))
+    css = faces + [
+        'body { font-family: %s; margin: 0 }' % (
+            '"%s", serif' % family if faces else 'serif'),
+        'p { text-indent: 1.5em; margin: 0; text-align: justify }',
+        'h1, h2, h3 { text-align: center }',
+        'div.img { text-align: center }',
+        '.hidden { display: none }',
+    ]
+
+    for n in range(1, chapters + 1):
+        ext = '.xml' if ('xml_extension' in defects and n == chapters) \
+            else '.xhtml'
+        href = 'text/chapter%03d%s' % (n, ext)
+        chapter_images = image_hrefs[n - 1::chapters]
+        body, entry = chapter_body(rng, n, href, words, ncx_depth,
+                                   ['../' + i for i in chapter_images])
+        if 'display_none' in defects and n == 1:
+            body += '\n<p class="hidden">Wydano dla: %s %s</p>' % (
+                first, surname)
+        if 'broken_link' in defects and n == 1:
+            body += '\n<p><a href="missing.xhtml">Przypisy</a></p>'
+        members.append(('OEBPS/' + href, xhtml(
+            'Rozdział %d' % n, body, lang, '../style.css').encode('utf-8')))
+        items.append(('chapter%d' % n, href, 'application/xhtml+xml'))
+        spine.append('chapter%d' % n)
+        toc.append(entry)
+
+    if 'dl_toc' in defects:
+        entries = ''.join('<dt><a href="%s">%s</a></dt>' % (src, label)
+                          for label, src, children in toc)
+        toc_body = '<h1>Spis treści</h1><dl>%s</dl>' % entries
+    else:
+        entries = ''.join('<li><a href="%s">%s</a></li>' % (src, label)
+                          for label, src, children in toc)
+        toc_body = '<h1>Spis treści</h1><ul>%s</ul>' % entries
+    members.append(('OEBPS/toc.xhtml', xhtml('Spis treści', toc_body,
+                                             lang).encode('utf-8')))
+    items.append(('toc', 'toc.xhtml', 'application/xhtml+xml'))
+    spine.append('toc')
+    members.append(('OEBPS/style.css', '\n'.join(css).encode('utf-8')))
+    items.append(('css', 'style.css', 'text/css'))
+
+    uid_meta = '' if 'missing_ncx_uid' in defects else \
+        '<meta name="dtb:uid" content="%s"/>' % book_id
+    ncx = (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+        '<head>%s<meta name="dtb:depth" content="%d"/></head><docTitle><text>'
+        '%s</text></docTitle><navMap>%s</navMap></ncx>\n' % (
+            uid_meta, ncx_depth, escape(title), nav_points(toc, [0]))
+    )
+    members.append(('OEBPS/toc.ncx', ncx.encode('utf-8')))
+    opf = (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<package xmlns="http://www.idpf.org/2007/opf" version="2.0" '
+        'unique-identifier="BookId"><metadata xmlns:dc="http://purl.org/dc/'
+        'elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">'
+        '<dc:title>%s</dc:title><dc:creator opf:role="aut" opf:file-as="%s, '
+        '%s">%s %s</dc:creator><dc:language>%s</dc:language>'
+        '<dc:identifier id="BookId" opf:scheme="UUID">%s</dc:identifier>'
+        '<meta name="cover" content="cover-image"/></metadata><manifest>'
+        '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"'
+        '/>%s</manifest><spine toc="ncx">%s</spine><guide><reference '
+        'type="cover" title="Okładka" href="cover.xhtml"/><reference '
+        'type="toc" title="Spis treści" href="toc.xhtml"/></guide>'
+        '</package>\n' % (
+            escape(title), surname, first, first, surname, lang, book_id,
+            ''.join('<item id="%s" href="%s" media-type="%s"/>' % i
+                    for i in items),
+            ''.join('<itemref idref="%s"/>' % i for i in spine))
+    )
+    members.insert(2, ('OEBPS/content.opf', opf.encode('utf-8')))
+    if encrypted:
+        members.append(('META-INF/encryption.xml', (
+            '<?xml version="1.0"?>\n<encryption xmlns="urn:oasis:names:tc:'
+            'opendocument:xmlns:container" xmlns:enc="http://www.w3.org/2001/'
+            '04/xmlenc#">%s</encryption>' % ''.join(
+                '<enc:EncryptedData><enc:EncryptionMethod Algorithm="%s"/>'
+                '<enc:CipherData><enc:CipherReference URI="%s"/>'
+                '</enc:CipherData></enc:EncryptedData>' % (
+                    IDPF_OBFUSCATION if obfuscation == 'idpf'
+                    else ADOBE_OBFUSCATION, uri) for uri in encrypted)
+        ).encode('utf-8')))
+    if 'ds_store' in defects:
+        members.append(('OEBPS/.DS_Store', b'\0\0\0\1Bud1' + bytes(64)))
+    if 'calibre_bookmarks' in defects:
+        members.append(('META-INF/calibre_bookmarks.txt',
+                        b'encoding=json+base64:\nW10='))
+    return '%s %s - %s.epub' % (surname, first, title), members
+
+
+def write_epub(path, members):
+    with zipfile.ZipFile(path, 'w') as z:
+        for name, data in members:
+            info = zipfile.ZipInfo(name, ZIP_DATE)
+            info.compress_type = zipfile.ZIP_STORED if name == 'mimetype' \
+                else zipfile.ZIP_DEFLATED
+            z.writestr(info, data)
+
+
+def generate_corpus(directory, books=10, seed=1, **options):
+    '''
+    Write books EPUB files to directory and return list of their paths.
+    options are passed to make_book(): chapters, words (per chapter),
+    images, fonts (0-4 styles), obfuscation (none, idpf, adobe or mixed),
+    ncx_depth and defects (names from DEFECTS).
+    '''
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for number in range(books):
+        rng = random.Random('%s-%d' % (seed, number))
+        name, members = make_book(rng, number, **options)
+        path = os.path.join(directory, '%03d %s' % (number + 1, name))
+        write_epub(path, members)
+        paths.append(path)
+    return paths
+
+
+def corpus_digest(paths):
+    ''' SHA-1 of file names and contents of the corpus '''
+    h = hashlib.sha1()
+    for path in sorted(paths):
+        h.update(os.path.basename(path).encode('utf-8'))
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def add_corpus_arguments(parser):
+    parser.add_argument('--books', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--chapters', type=int, default=10,
+                        help='chapters per book')
+    parser.add_argument('--words', type=int, default=2000,
+                        help='words of Polish text per chapter')
+    parser.add_argument('--images', type=int, default=2,
+                        help='images per book (besides the cover)')
+    parser.add_argument('--fonts', type=int, default=2, choices=range(5),
+                        help='embedded font styles per book')
+    parser.add_argument('--obfuscation', default='mixed', choices=OBFUSCATION,
+                        help='font obfuscation; mixed rotates none, IDPF and '
+                        'Adobe between books')
+    parser.add_argument('--ncx-depth', type=int, default=2,
+                        help='levels of the table of contents')
+    parser.add_argument('--defects', default=','.join(sorted(DEFECTS)),
+                        help='comma separated defects added to every book '
+                        '(%s) or "none"' % ', '.join(sorted(DEFECTS)))
+
+
+def corpus_options(args):
+    defects = [] if args.defects in ('', 'none') else \
+        args.defects.split(',')
+    unknown = set(defects) - set(DEFECTS)
+    if unknown:
+        sys.exit('Unknown defects: ' + ', '.join(sorted(unknown)))
+    return {'books': args.books, 'seed': args.seed,
+            'chapters': args.chapters, 'words': args.words,
+            'images': args.images, 'fonts': args.fonts,
+            'obfuscation': args.obfuscation, 'ncx_depth': args.ncx_depth,
+            'defects': sorted(defects)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', help='output directory')
+    add_corpus_arguments(parser)
+    args = parser.parse_args()
+    paths = generate_corpus(args.directory, **corpus_options(args))
+    print('* %d book(s), %d bytes, digest %s' % (
+        len(paths), sum(os.path.getsize(p) for p in paths),
+        corpus_digest(paths)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+'''
+Time processing stages on a generated corpus (see corpus.py) and write
+JSON results. Every run works on a fresh copy of the corpus; external
+tools (kindlegen, EpubCheck) are not needed.
+
+    python -m benchmarks.run [corpus options] [--repeat N] [-o FILE]
+                             [--compare OLD.json]
+'''
+
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.corpus import add_corpus_arguments  # noqa: E402
+from benchmarks.corpus import corpus_digest  # noqa: E402
+from benchmarks.corpus import corpus_options  # noqa: E402
+from benchmarks.corpus import generate_corpus  # noqa: E402
+from lxml import etree  # noqa: E402
+from lib import fontcache  # noqa: E402
+from lib.beautify_book import beautify_book  # noqa: E402
+from lib.epubqcheck import find_opf  # noqa: E402
+from lib.epubqcheck import qcheck  # noqa: E402
+import lib.epubqfix  # noqa: E402
+from lib.epubqfix import HYPHEN_MARK  # noqa: E402
+from lib.epubqfix import hyphenate_and_fix_conjunctions  # noqa: E402
+from lib.epubqfix import qfix  # noqa: E402
+from lib.epubqfix import rename_files  # noqa: E402
+
+RESULTS_VERSION = 1
+STAGES = ('hyphenation', 'qcheck', 'qfix', 'beautify_book', 'rename_files')
+
+
+def books_in(directory):
+    return sorted(f for f in os.listdir(directory)
+                  if f.endswith('.epub') and not f.endswith('_moh.epub'))
+
+
+def stage_hyphenation(work):
+    ''' Hyphenate every XHTML file, parsing is not timed '''
+    trees = []
+    for f in books_in(work):
+        with zipfile.ZipFile(os.path.join(work, f)) as z:
+            for name in z.namelist():
+                if name.endswith(('.xhtml', '.xml')) and '/text/' in name:
+                    trees.append(etree.fromstring(z.read(name)))
+    start = time.perf_counter()
+    for tree in trees:
+        hyphenate_and_fix_conjunctions(tree, HYPHEN_MARK, lib.epubqfix.hyph,
+                                       False, False)
+    return time.perf_counter() - start
+
+
+def stage_qcheck(work):
+    start = time.perf_counter()
+    for f in books_in(work):
+        qcheck(work, f, False, False, False, use_cache=False)
+    return time.perf_counter() - start
+
+
+def stage_qfix(work):
+    ''' Default -e run (fix, hyphenate and beautify) of every book '''
+    start = time.perf_counter()
+    for f in books_in(work):
+        qfix(work, f, True, False, False, None, False, False, False, None,
+             False, False, None, False, None, False, None)
+    return time.perf_counter() - start
+
+
+def stage_beautify_book(work):
+    ''' beautify_book on copies of the source books '''
+    copies = []
+    for f in books_in(work):
+        path = os.path.join(work, 'beautify', f)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(os.path.join(work, f), path)
+        copies.append((f, path))
+    start = time.perf_counter()
+    for f, path in copies:
+        beautify_book(work, f, None, None, path)
+    return time.perf_counter() - start
+
+
+def stage_rename_files(work):
+    start = time.perf_counter()
+    for f in books_in(work):
+        epub = zipfile.ZipFile(os.path.join(work, f))
+        opf_dir, opf_path = find_opf(epub)
+        rename_files(opf_path, work, epub, f, f)
+    return time.perf_counter() - start
+
+
+def run_stages(corpus, stages, repeat, scratch):
+    results = dict((s, []) for s in stages)
+    for i in range(repeat):
+        for stage in stages:
+            work = os.path.join(scratch, 'run-%d-%s' % (i, stage))
+            shutil.copytree(corpus, work)
+            with redirect_stdout(io.StringIO()):
+                elapsed = globals()['stage_' + stage](work)
+            results[stage].append(elapsed)
+            shutil.rmtree(work)
+            print('* run %d/%d %-14s %.3f s' % (i + 1, repeat, stage, elapsed),
+                  file=sys.stderr)
+    return dict((stage, {'runs': runs, 'best': min(runs),
+                         'median': statistics.median(runs)})
+                for stage, runs in results.items())
+
+
+def git_commit():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=root,
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+        dirty = bool(subprocess.check_output(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=root, stderr=subprocess.DEVNULL).strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def compare(old, new):
+    ''' Print best times of two result dicts side by side '''
+    if old['corpus'].get('digest') != new['corpus'].get('digest'):
+        print('* WARNING! Results come from different corpora.',
+              file=sys.stderr)
+    print('%-14s %10s %10s %8s' % ('stage', 'old', 'new', 'change'),
+          file=sys.stderr)
+    for stage, result in new['stages'].items():
+        if stage not in old['stages']:
+            continue
+        before = old['stages'][stage]['best']
+        after = result['best']
+        print('%-14s %9.3fs %9.3fs %+7.1f%%' % (
+            stage, before, after,
+            100.0 * (after - before) / before if before else 0.0),
+            file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_corpus_arguments(parser)
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help='comma separated stages to time (%s)'
+                        % ', '.join(STAGES))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs of every stage')
+    parser.add_argument('-o', '--output', help='write JSON results to FILE '
+                        '(default: standard output)')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='print change against earlier JSON results')
+    args = parser.parse_args()
+    stages = args.stages.split(',')
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        sys.exit('Unknown stages: ' + ', '.join(sorted(unknown)))
+    options = corpus_options(args)
+    # every run parses fonts again instead of reading earlier results
+    fontcache.use_disk = False
+    scratch = tempfile.mkdtemp(prefix='epubQTools-bench-')
+    try:
+        corpus = os.path.join(scratch, 'corpus')
+        paths = generate_corpus(corpus, **options)
+        commit, dirty = git_commit()
+        results = {
+            'version': RESULTS_VERSION,
+            'commit': commit,
+            'dirty': dirty,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'corpus': dict(options, digest=corpus_digest(paths),
+                           bytes=sum(os.path.getsize(p) for p in paths)),
+            'repeat': args.repeat,
+            'stages': run_stages(corpus, stages, args.repeat, scratch),
+        }
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    data = json.dumps(results, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+    else:
+        print(data)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
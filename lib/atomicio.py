@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import errno
+import os
+import shutil
+import uuid
+
+
+def fsync_dir(dirname):
+    ''' Make rename in directory durable (no-op where not supported) '''
+    try:
+        fd = os.open(dirname or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class AtomicOutput(object):
+    '''
+    Output file built under a hidden temporary name in the target
+    directory and renamed into place by commit(). The target path never
+    holds a partial file, so an existing output is always a complete one.
+
+        with AtomicOutput(path) as out:
+            write_file(out.path)
+    '''
+
+    def __init__(self, target, suffix='.part'):
+        self.target = target
+        dirname, basename = os.path.split(target)
+        self.path = os.path.join(dirname, '.%s.%s%s' % (
+            basename, uuid.uuid4().hex[:8], suffix))
+
+    def commit(self):
+        with open(self.path, 'r+b') as f:
+            os.fsync(f.fileno())
+        if os.path.exists(self.target):
+            # keep permissions of replaced file
+            shutil.copymode(self.target, self.path)
+        os.replace(self.path, self.target)
+        fsync_dir(os.path.dirname(self.target))
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+        return False
+
+
+def rename_no_replace(src, dst):
+    '''
+    Rename src to dst only if dst does not exist. Return False if it
+    does. Hard links make the check and the rename one atomic step where
+    the file system supports them.
+    '''
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        return False
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return False
+        # no hard links (e.g. FAT, some network shares)
+        if os.path.exists(dst):
+            return False
+        os.rename(src, dst)
+        return True
+    os.unlink(src)
+    return True
@@ -12,6 +12,9 @@ import re
 import shutil
 import logging
 from lib.epubqcheck import list_font_basic_properties
+from lib.fontindex import font_index
+from lib import csscache
+from lib import timings
 from urllib.parse import unquote
 
 try:
@@ -32,6 +35,7 @@ css_parser.log.setLevel(logging.CRITICAL)
 css_parser.ser.prefs.omitLastSemicolon = False
 
 
+@timings.timed
 def clean_meta_tags(opftree):
 
     def clean_meta_tag(meta):
@@ -131,35 +135,22 @@ def update_css_font_families(epub_dir, opftree):
         )(opftree)
         for c in css_items:
             css_file_path = os.path.join(epub_dir, c.get('href'))
-            sheet = css_parser.parseFile(css_file_path, validate=True)
-            for rule in sheet:
-                if rule.type == rule.FONT_FACE_RULE:
-                    css_font_family = None
-                    font_file_family = None
-                    for p in rule.style:
-                        if p.name == 'font-family' and css_font_family is None:
-                            try:
-                                css_font_family = p.value.split(
-                                    ',')[0].strip().strip('"').strip("'")
-                            except Exception:
-                                continue
-                            continue
-                        if p.name == 'src' and font_file_family is None:
-                            ffs = rule.style.getProperty(p.name).propertyValue
-                            ff_url = ffs.item(0).value
-                            with open(os.path.join(
-                                os.path.dirname(css_file_path), ff_url
-                            ), 'rb') as f:
-                                lfp = list_font_basic_properties(f.read())
-                                lfp = list(lfp)
-                                if 'subset of' in lfp[0]:
-                                    lfp[0] = re.sub(
-                                        r'\w+?\s-\ssubset\sof\s', '',
-                                        lfp[0]
-                                    )
-                                font_file_family = lfp[0]
-                                continue
-                    font_families.append([css_font_family, font_file_family])
+            info = csscache.read_info(css_file_path)
+            for css_font_family, ff_url in info.font_faces:
+                font_file_family = None
+                if ff_url is not None:
+                    with open(os.path.join(
+                        os.path.dirname(css_file_path), ff_url
+                    ), 'rb') as f:
+                        lfp = list_font_basic_properties(f.read())
+                        lfp = list(lfp)
+                        if 'subset of' in lfp[0]:
+                            lfp[0] = re.sub(
+                                r'\w+?\s-\ssubset\sof\s', '',
+                                lfp[0]
+                            )
+                        font_file_family = lfp[0]
+                font_families.append([css_font_family, font_file_family])
             return font_families
 
     print('* Updating font-family in all CSS files...')
@@ -168,7 +159,8 @@ def update_css_font_families(epub_dir, opftree):
                             namespaces=OPFNS)(opftree)
     for c in css_items:
         css_file_path = os.path.join(epub_dir, c.get('href'))
-        sheet = css_parser.parseFile(css_file_path, validate=True)
+        with open(css_file_path, 'rb') as f:
+            sheet = csscache.take_sheet(f.read())
 
         for ff in ff_list:
             fix_sheet(sheet, ff[0], ff[1], False)
@@ -177,6 +169,7 @@ def update_css_font_families(epub_dir, opftree):
             f.write(sheet.cssText)
 
 
+@timings.timed
 def replace_fonts(user_font_dir, epub_dir, ncxtree, opftree, pair_family):
 
     # TODO: replace also family-name in CSS
@@ -198,26 +191,14 @@ def replace_fonts(user_font_dir, epub_dir, ncxtree, opftree, pair_family):
                     family_font_list.append([furl] + lfp)
         return family_font_list
 
-    def find_new_family_fonts(user_font_dir, epub_dir, opftree, family_name,
-                              is_all):
-        family_font_list = []
-        for root, dirs, files in os.walk(user_font_dir):
-            for f in files:
-                furl = os.path.join(root, f)
-                if (
-                    furl.lower().endswith('.ttf') or
-                    furl.lower().endswith('.otf')
-                ):
-                    with open(os.path.join(furl), 'rb') as f:
-                        try:
-                            lfp = list_font_basic_properties(f.read())
-                        except Exception:
-                            continue
-                        if is_all:
-                            family_font_list.append([furl] + list(lfp))
-                        elif lfp[0] == family_name:
-                            family_font_list.append([furl] + list(lfp))
-        return family_font_list
+    def find_new_family_fonts(user_font_dir, family_name, is_all):
+        index = font_index(user_font_dir)
+        if is_all:
+            entries = index.entries
+        else:
+            entries = index.find(family_name)
+        return [[e.path, e.family, e.regular, e.bold, e.italic]
+                for e in entries]
 
     if pair_family is not None and user_font_dir is not None:
         if ',' in pair_family:
@@ -231,8 +212,7 @@ def replace_fonts(user_font_dir, epub_dir, ncxtree, opftree, pair_family):
             return None
     else:
         return None
-    new_font_files = find_new_family_fonts(user_font_dir, epub_dir, opftree,
-                                           nf, False)
+    new_font_files = find_new_family_fonts(user_font_dir, nf, False)
     old_font_files = find_old_family_fonts(epub_dir, opftree, of)
     if old_font_files == []:
         print('! No font with family name "%s" was found in EPUB file'
@@ -241,8 +221,7 @@ def replace_fonts(user_font_dir, epub_dir, ncxtree, opftree, pair_family):
         print('! No font with family name "%s" was found in provided '
               'directory "%s"...' % (nf, user_font_dir))
         print('* Choose from the below list of font family names:')
-        for i in find_new_family_fonts(user_font_dir, epub_dir, opftree,
-                                       nf, True):
+        for i in find_new_family_fonts(user_font_dir, nf, True):
             print(
                 '* Font info for %s, Family name: "%s", '
                 'isRegular: %s, isBold: %s, isItalic: %s' %
@@ -250,15 +229,16 @@ def replace_fonts(user_font_dir, epub_dir, ncxtree, opftree, pair_family):
                     os.path.basename(i[0]), i[1], i[2], i[3], i[4]
                 )
             )
+    index = font_index(user_font_dir)
     for o in old_font_files:
-        for n in new_font_files:
-            if o[2] == n[2] and o[3] == n[3] and o[4] == n[4]:
-                nfp = os.path.join(os.path.dirname(o[0]),
-                                   os.path.basename(n[0]))
-                rename_replace_files(opftree, ncxtree, epub_dir, o[0], nfp,
-                                     n[0])
+        for n in index.find(nf, o[2], o[3], o[4]):
+            nfp = os.path.join(os.path.dirname(o[0]),
+                               os.path.basename(n.path))
+            rename_replace_files(opftree, ncxtree, epub_dir, o[0], nfp,
+                                 n.path)
 
 
+@timings.timed
 def fix_body_id_links(opftree, epub_dir, ncxtree):
 
     def get_body_id_list(opftree, epub_dir):
@@ -273,6 +253,7 @@ def fix_body_id_links(opftree, epub_dir, ncxtree):
             try:
                 xhtree = etree.parse(os.path.join(epub_dir, xhtml_url),
                                      parser=etree.XMLParser(recover=False))
+                timings.count('files parsed')
             except etree.XMLSyntaxError as e:
                 print('* File skipped: ' + os.path.basename(xhtml_url) +
                       '. NOT well formed: "' + str(e) + '"')
@@ -315,6 +296,7 @@ def rename_replace_files(opftree, ncxtree, epub_dir, old_name_path,
             try:
                 xhtree = etree.parse(os.path.join(epub_dir, xhtml_url),
                                      parser=etree.XMLParser(recover=False))
+                timings.count('files parsed')
             except (etree.XMLSyntaxError, IOError):
                 continue
             urls = etree.XPath('//*[@href or @src or @xlink:href]',
@@ -385,8 +367,8 @@ def rename_replace_files(opftree, ncxtree, epub_dir, old_name_path,
             namespaces=OPFNS
         )(opftree)
         for c in css_items:
-            sheet = css_parser.parseFile(os.path.join(
-                epub_dir, c.get('href')), validate=True)
+            with open(os.path.join(epub_dir, c.get('href')), 'rb') as f:
+                sheet = csscache.take_sheet(f.read())
             old_css_path = os.path.relpath(
                 old_name_path,
                 os.path.dirname(c.get('href'))
@@ -448,12 +430,17 @@ def most_common(lst):
     return max(set(lst), key=lst.count)
 
 
+@timings.timed
 def write_file_changes_back(tree, file_path):
+    data = etree.tostring(tree.getroot(), pretty_print=True,
+                          standalone=False, xml_declaration=True,
+                          encoding='utf-8')
     with open(file_path, 'wb') as f:
-        f.write(etree.tostring(tree.getroot(), pretty_print=True,
-                standalone=False, xml_declaration=True, encoding='utf-8'))
+        f.write(data)
+    timings.count('files written')
 
 
+@timings.timed
 def rename_calibre_cover(opftree, ncxtree, epub_dir):
     for r in etree.XPath('//opf:reference[@type="cover"]',
                          namespaces=OPFNS)(opftree):
@@ -478,6 +465,7 @@ def rename_calibre_cover(opftree, ncxtree, epub_dir):
                 pass
 
 
+@timings.timed
 def rename_cover_img(opftree, ncxtree, epub_dir):
     try:
         meta_cover_id = opftree.xpath('//opf:meta[@name="cover"]',
@@ -510,6 +498,7 @@ def rename_cover_img(opftree, ncxtree, epub_dir):
                 break
 
 
+@timings.timed
 def make_cover_item_first(opftree):
     try:
         meta_cover_id = opftree.xpath('//opf:meta[@name="cover"]',
@@ -527,6 +516,7 @@ def make_cover_item_first(opftree):
         manifest.insert(0, cover_item)
 
 
+@timings.timed
 def make_content_src_list(ncxtree):
     contents = etree.XPath('//ncx:content[@src]', namespaces=NCXNS)(ncxtree)
     cont_src_list = []
@@ -535,6 +525,7 @@ def make_content_src_list(ncxtree):
     return cont_src_list
 
 
+@timings.timed
 def fix_display_none(opftree, epub_dir, cont_src_list):
     xhtml_items = etree.XPath(
         '//opf:item[@media-type="application/xhtml+xml"]',
@@ -546,6 +537,7 @@ def fix_display_none(opftree, epub_dir, cont_src_list):
         try:
             xhtree = etree.parse(os.path.join(epub_dir, xhtml_url),
                                  parser=etree.XMLParser(recover=False))
+            timings.count('files parsed')
         except etree.XMLSyntaxError as e:
             print('* File skipped: ' + os.path.basename(xhtml_url) +
                   '. NOT well formed: "' + str(e) + '"')
@@ -571,14 +563,16 @@ def fix_display_none(opftree, epub_dir, cont_src_list):
             write_file_changes_back(xhtree, os.path.join(epub_dir, xhtml_url))
 
 
-def beautify_book(root, f, user_font_dir, pair_family):
+def beautify_book(root, f, user_font_dir, pair_family, epub_path=None):
     from lib.epubqfix import pack_epub
     from lib.epubqfix import unpack_epub
     from lib.epubqfix import clean_temp
     from lib.epubqfix import find_roots
     f = f.replace('.epub', '_moh.epub')
+    if epub_path is None:
+        epub_path = os.path.join(root, f)
     print('START beautify for: ' + f)
-    tempdir = unpack_epub(os.path.join(root, f))
+    tempdir = unpack_epub(epub_path)
     opf_dir, opf_file, is_fixed = find_roots(tempdir)
     epub_dir = os.path.join(tempdir, opf_dir)
     opf_path = os.path.join(tempdir, opf_file)
@@ -590,6 +584,7 @@ def beautify_book(root, f, user_font_dir, pair_family):
     )(opftree)[0].get('href')
     ncx_path = os.path.join(epub_dir, ncxfile)
     ncxtree = etree.parse(ncx_path, parser)
+    timings.count('files parsed', 2)
 
     rename_calibre_cover(opftree, ncxtree, epub_dir)
     rename_cover_img(opftree, ncxtree, epub_dir)
@@ -605,6 +600,6 @@ def beautify_book(root, f, user_font_dir, pair_family):
 
     write_file_changes_back(opftree, opf_path)
     write_file_changes_back(ncxtree, ncx_path)
-    pack_epub(os.path.join(root, f), tempdir)
+    pack_epub(epub_path, tempdir, epub_path)
     clean_temp(tempdir)
     print('FINISH beautify for: ' + f)
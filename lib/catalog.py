@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+import zipfile
+
+try:
+    from lxml import etree
+except ImportError as e:
+    sys.exit('! CRITICAL! ' + str(e))
+
+HOME = os.path.expanduser("~")
+CATALOG_PATH = os.path.join(HOME, '.epubQTools', 'catalog.sqlite')
+SCHEMA_VERSION = 1
+# seconds to wait for other processes writing the catalog
+BUSY_TIMEOUT = 30.0
+
+OPFNS = {'opf': 'http://www.idpf.org/2007/opf'}
+DCNS = {'dc': 'http://purl.org/dc/elements/1.1/'}
+CRNS = {'cr': 'urn:oasis:names:tc:opendocument:xmlns:container'}
+
+recover_parser = etree.XMLParser(recover=True)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS books (
+    path TEXT PRIMARY KEY,
+    root TEXT NOT NULL,
+    name TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sha1 TEXT NOT NULL,
+    opf_path TEXT,
+    title TEXT,
+    creators TEXT,
+    language TEXT,
+    identifiers TEXT,
+    members TEXT,
+    error TEXT,
+    has_moh INTEGER NOT NULL DEFAULT 0,
+    has_mobi INTEGER NOT NULL DEFAULT 0,
+    scanned REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS listing (
+    library TEXT NOT NULL,
+    ordinal INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (library, ordinal)
+);
+'''
+
+
+def is_source_epub(f):
+    ''' EPUB files listed in individual mode (not generated _moh files) '''
+    f = f.lower()
+    return f.endswith('.epub') and not f.endswith('_moh.epub')
+
+
+def _file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_metadata(path):
+    '''
+    Return dict with OPF path, title, creators, language, identifiers and
+    archive member list of EPUB file. Problems are stored in "error".
+    '''
+    meta = {'opf_path': None, 'title': None, 'creators': [],
+            'language': None, 'identifiers': [], 'members': [],
+            'error': None}
+    try:
+        with zipfile.ZipFile(path) as z:
+            meta['members'] = z.namelist()
+            try:
+                cr_tree = etree.fromstring(z.read('META-INF/container.xml'))
+                opf_path = cr_tree.xpath('//cr:rootfile',
+                                         namespaces=CRNS)[0].get('full-path')
+            except Exception:
+                opf_path = None
+                for i in meta['members']:
+                    if i.endswith('.opf'):
+                        opf_path = i
+                        break
+            if opf_path is None:
+                meta['error'] = 'OPF file not found'
+                return meta
+            meta['opf_path'] = opf_path
+            opftree = etree.fromstring(z.read(opf_path), recover_parser)
+    except (zipfile.BadZipfile, KeyError, IOError, OSError,
+            etree.XMLSyntaxError) as e:
+        meta['error'] = str(e)
+        return meta
+    if opftree is None:
+        meta['error'] = 'OPF file is empty'
+        return meta
+
+    def texts(xp):
+        return [t.replace('\n', ' ').replace('\r', ' ').strip() for t in
+                etree.XPath(xp, namespaces=DCNS)(opftree)]
+
+    titles = texts('//dc:title/text()')
+    meta['title'] = titles[0] if titles else None
+    meta['creators'] = texts('//dc:creator/text()')
+    languages = texts('//dc:language/text()')
+    meta['language'] = languages[0] if languages else None
+    meta['identifiers'] = texts('//dc:identifier/text()')
+    return meta
+
+
+class Catalog(object):
+    '''
+    Persistent catalog of EPUB files: OPF metadata, archive member lists
+    and conversion state. Books are re-read only if their size, mtime and
+    content hash changed since the last scan.
+    '''
+
+    def __init__(self, path=CATALOG_PATH):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+        self.db.row_factory = sqlite3.Row
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self.db.executescript('DROP TABLE IF EXISTS books;'
+                                  'DROP TABLE IF EXISTS listing;')
+            self.db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        self.db.executescript(SCHEMA)
+        self.stats = {'scanned': 0, 'unchanged': 0, 'removed': 0}
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def update_book(self, root, name, has_moh=False, has_mobi=False):
+        ''' Refresh single book entry if the file changed '''
+        path = os.path.abspath(os.path.join(root, name))
+        st = os.stat(path)
+        row = self.db.execute('SELECT mtime_ns, size, sha1 FROM books '
+                              'WHERE path = ?', (path,)).fetchone()
+        if (row is not None and row['mtime_ns'] == st.st_mtime_ns and
+                row['size'] == st.st_size):
+            self.stats['unchanged'] += 1
+            self.db.execute('UPDATE books SET has_moh = ?, has_mobi = ? '
+                            'WHERE path = ?', (has_moh, has_mobi, path))
+            return
+        sha1 = _file_hash(path)
+        if row is not None and row['sha1'] == sha1:
+            # touched, but not changed
+            self.stats['unchanged'] += 1
+            self.db.execute('UPDATE books SET mtime_ns = ?, size = ?, '
+                            'has_moh = ?, has_mobi = ? WHERE path = ?',
+                            (st.st_mtime_ns, st.st_size, has_moh, has_mobi,
+                             path))
+            return
+        self.stats['scanned'] += 1
+        meta = read_metadata(path)
+        self.db.execute(
+            'INSERT OR REPLACE INTO books (path, root, name, mtime_ns, size, '
+            'sha1, opf_path, title, creators, language, identifiers, '
+            'members, error, has_moh, has_mobi, scanned) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (path, os.path.dirname(path), name, st.st_mtime_ns, st.st_size,
+             sha1, meta['opf_path'], meta['title'],
+             json.dumps(meta['creators']), meta['language'],
+             json.dumps(meta['identifiers']), json.dumps(meta['members']),
+             meta['error'], has_moh, has_mobi, time.time())
+        )
+
+    def refresh(self, library, scan=True):
+        '''
+        Walk library directory and store the individual mode numbering.
+        With scan changed books are updated and removed ones forgotten,
+        otherwise only file names are listed. Return list of paths in
+        individual mode order.
+        '''
+        library = os.path.abspath(library)
+        paths = []
+        for root, dirs, files in os.walk(library):
+            fileset = set(files)
+            for f in files:
+                if not is_source_epub(f):
+                    continue
+                if scan:
+                    base = os.path.splitext(f)[0]
+                    try:
+                        self.update_book(root, f,
+                                         base + '_moh.epub' in fileset,
+                                         base + '_moh.mobi' in fileset)
+                    except OSError:
+                        continue
+                paths.append(os.path.join(root, f))
+        if scan:
+            prefix = os.path.join(library, '')
+            known = set(r[0] for r in self.db.execute(
+                'SELECT path FROM books WHERE substr(path, 1, ?) = ?',
+                (len(prefix), prefix)
+            ))
+            removed = known - set(paths)
+            self.stats['removed'] += len(removed)
+            self.db.executemany('DELETE FROM books WHERE path = ?',
+                                [(p,) for p in removed])
+        self.db.execute('DELETE FROM listing WHERE library = ?', (library,))
+        self.db.executemany('INSERT INTO listing VALUES (?, ?, ?)',
+                            [(library, i, p) for i, p in enumerate(paths)])
+        self.db.commit()
+        return paths
+
+    def listing(self, library):
+        return [r[0] for r in self.db.execute(
+            'SELECT path FROM listing WHERE library = ? ORDER BY ordinal',
+            (os.path.abspath(library),)
+        )]
+
+    def select(self, library, ordinal):
+        '''
+        Return path of book number ordinal from the last listing of
+        library. The library is walked again only if the listing is
+        missing or the file is gone.
+        '''
+        library = os.path.abspath(library)
+        row = self.db.execute('SELECT path FROM listing WHERE library = ? '
+                              'AND ordinal = ?', (library, ordinal)).fetchone()
+        if row is not None and os.path.isfile(row[0]):
+            return row[0]
+        paths = self.refresh(library, scan=False)
+        if 0 <= ordinal < len(paths):
+            return paths[ordinal]
+        return None
+
+    def book(self, path):
+        ''' Return book metadata dict, refreshing it first if needed '''
+        path = os.path.abspath(path)
+        root, name = os.path.split(path)
+        base = os.path.splitext(path)[0]
+        self.update_book(root, name, os.path.isfile(base + '_moh.epub'),
+                         os.path.isfile(base + '_moh.mobi'))
+        return self._row(self.db.execute('SELECT * FROM books WHERE path = ?',
+                                         (path,)).fetchone())
+
+    def books(self, library):
+        ''' Book metadata dicts for library in individual mode order '''
+        return [self._row(r) for r in self.db.execute(
+            'SELECT books.* FROM listing JOIN books USING (path) '
+            'WHERE library = ? ORDER BY ordinal', (os.path.abspath(library),)
+        )]
+
+    def move(self, old_path, new_path):
+        ''' Update entry after the book file was renamed '''
+        old_path = os.path.abspath(old_path)
+        new_path = os.path.abspath(new_path)
+        self.db.execute('DELETE FROM books WHERE path = ?', (new_path,))
+        self.db.execute('UPDATE books SET path = ?, root = ?, name = ? '
+                        'WHERE path = ?', (new_path, os.path.dirname(new_path),
+                                           os.path.basename(new_path),
+                                           old_path))
+        self.db.execute('UPDATE listing SET path = ? WHERE path = ?',
+                        (new_path, old_path))
+
+    @staticmethod
+    def read_book(path):
+        '''
+        Return book metadata dict like book() read directly from the file,
+        without the catalog database
+        '''
+        path = os.path.abspath(path)
+        book = read_metadata(path)
+        book.update(path=path, root=os.path.dirname(path),
+                    name=os.path.basename(path))
+        return book
+
+    @staticmethod
+    def _row(row):
+        if row is None:
+            return None
+        book = dict(row)
+        for k in ('creators', 'identifiers', 'members'):
+            book[k] = json.loads(book[k]) if book[k] else []
+        return book
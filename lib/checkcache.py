@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import hashlib
+import io
+import json
+import os
+import tempfile
+
+HOME = os.path.expanduser("~")
+CACHE_DIR = os.path.join(HOME, '.epubQTools', 'cache')
+
+# counters for the current run: replayed books vs. re-validated books
+stats = {'hits': 0, 'checked': 0}
+
+
+class Tee(object):
+    ''' Write to a stream and remember everything written '''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buf = io.StringIO()
+
+    def write(self, message):
+        self.stream.write(message)
+        self.buf.write(message)
+
+    def flush(self):
+        self.stream.flush()
+
+    def getvalue(self):
+        return self.buf.getvalue()
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def result_key(path, version, *options):
+    ''' Key from the book content hash, rule-set version and options '''
+    h = hashlib.sha1(file_hash(path).encode('ascii'))
+    h.update(json.dumps([version] + list(options)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def result_path(kind, key):
+    return os.path.join(CACHE_DIR, kind, key[:2], key + '.json')
+
+
+def load_result(kind, key):
+    try:
+        with open(result_path(kind, key), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def store_result(kind, key, result):
+    path = result_path(kind, key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(result, f)
+        os.replace(tmp, path)
+    except (IOError, OSError) as e:
+        print('* WARNING! Unable to write cache file "%s": %s' % (path, e))
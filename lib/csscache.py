@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import hashlib
+import logging
+import re
+import sys
+from collections import OrderedDict
+from urllib.parse import unquote
+
+try:
+    import css_parser
+except ImportError as e:
+    sys.exit('! CRITICAL! ' + str(e))
+
+# maximum number of distinct stylesheets kept per process
+MAX_ENTRIES = 512
+
+FONT_PROPERTIES = ('font-family', 'font-weight', 'font-style')
+# values of font shorthand setting a system font (not an embedded one)
+SYSTEM_FONTS = {'caption', 'icon', 'menu', 'message-box', 'small-caption',
+                'status-bar'}
+
+# font shorthand: [style variant weight stretch] size[/line-height] family
+font_shorthand_re = re.compile(
+    r'^((?:[\w-]+\s+)*?)'
+    r'(?:\d*\.?\d+(?:[a-z]+|%)|0|(?:xx?-)?(?:small|large)|medium|smaller|'
+    r'larger)(?:\s*/\s*\S+)?\s+(\S.*)$', re.I
+)
+
+_cache = OrderedDict()
+stats = {'hits': 0, 'misses': 0, 'parsed': 0}
+
+
+class _RecordHandler(logging.Handler):
+    ''' Collect css_parser messages for the stylesheet being parsed '''
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.records = None
+
+    def emit(self, record):
+        if self.records is not None:
+            self.records.append((record.levelno, record.getMessage()))
+
+
+_handler = _RecordHandler()
+_log = logging.getLogger('epubQTools.csscache')
+_log.propagate = False
+_log.setLevel(logging.WARNING)
+_log.addHandler(_handler)
+
+
+def expand_font(value):
+    '''
+    Return dict of FONT_PROPERTIES set by font shorthand value or None if
+    the value is not understood
+    '''
+    value = value.strip()
+    if value.lower() in ('inherit', 'unset', 'revert'):
+        return {}
+    if value.lower() == 'initial' or value.lower() in SYSTEM_FONTS:
+        return {'font-family': value, 'font-weight': 'normal',
+                'font-style': 'normal'}
+    m = font_shorthand_re.match(value)
+    if m is None:
+        return None
+    decls = {'font-family': m.group(2), 'font-weight': 'normal',
+             'font-style': 'normal'}
+    for word in m.group(1).split():
+        word = word.lower()
+        if word in ('italic', 'oblique'):
+            decls['font-style'] = word
+        elif word in ('bold', 'bolder', 'lighter') or word.isdigit():
+            decls['font-weight'] = word
+    return decls
+
+
+def font_declarations(properties):
+    '''
+    Return dict of FONT_PROPERTIES set by (name, value) pairs in their
+    order, with font shorthand expanded. A shorthand value which is not
+    understood is kept under "font".
+    '''
+    decls = {}
+    for name, value in properties:
+        name = name.strip().lower()
+        if name == 'font':
+            expanded = expand_font(value)
+            if expanded is None:
+                decls['font'] = value
+            else:
+                decls.update(expanded)
+        elif name in FONT_PROPERTIES:
+            decls[name] = value.strip()
+    return decls
+
+
+def flat_rules(rules):
+    ''' Rules of rules with the ones nested in @media in place of them '''
+    for rule in rules:
+        if rule.type == rule.MEDIA_RULE:
+            for r in flat_rules(rule.cssRules):
+                yield r
+        else:
+            yield rule
+
+
+def _split_rules(text):
+    # split to rules keeping "}" at the end of each one
+    return [r for r in re.split(r'(?<=})', text) if r]
+
+
+class CSSInfo(object):
+    '''
+    Stylesheet parsed at most once, with facts derived from it used by
+    qcheck, qfix and beautify_book.
+    '''
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.text = raw.decode('utf-8', 'replace').replace(
+            '\r\n', '\n').replace('\r', '\n')
+        self._sheet = None
+        self._warnings = None
+        self._font_faces = None
+        self._font_rules = None
+        self._font_face_rules = None
+
+        self.is_calibre_class = False
+        self.body_font_family = None
+        self.font_families = []
+        for e in _split_rules(self.text):
+            if re.search(r'(^|,|\s+)\.calibre(\s+|,|{)', e):
+                self.is_calibre_class = True
+            if re.search(r'(^|,|\s+)body(\s+|,|{)', e):
+                m = re.search(r'font-family\s*:\s*(.*?)(;|})', e)
+                if m is not None:
+                    self.body_font_family = m.group(1)
+            if 'font-family' in e:
+                m = re.search(r'font-family\s*:\s*(.+?)(;|})', e)
+                if m is not None:
+                    self.font_families.append(m.group(1))
+
+        self.text_aligns = set(
+            re.findall(r'text-align\s*:\s*([-\w]+)', self.text)
+        )
+        self.urls = []
+        cl = re.sub(r'\/\*[^*]*\*+([^/*][^*]*\*+)*\/', '', self.text)
+        for line in cl.splitlines():
+            m = re.match(r'.+?url\([ ]?(\"|\')?(.+?)(\"|\')?[ ]?\)', line)
+            if m is not None:
+                self.urls.append(unquote(m.group(2)))
+
+    @property
+    def sheet(self):
+        if self._sheet is None:
+            _handler.records = records = []
+            # capture messages of this parse only, other users of
+            # css_parser keep their logger
+            previous = css_parser.log._log
+            css_parser.log.setLog(_log)
+            try:
+                self._sheet = css_parser.parseString(self.raw, validate=True)
+            finally:
+                css_parser.log.setLog(previous)
+                _handler.records = None
+            stats['parsed'] += 1
+            if self._warnings is None:
+                self._warnings = records
+        return self._sheet
+
+    @property
+    def warnings(self):
+        ''' List of (level, message) reported when parsing the sheet '''
+        if self._warnings is None:
+            self.sheet
+        return self._warnings
+
+    @property
+    def font_faces(self):
+        ''' List of (font-family, first src url) for @font-face rules '''
+        if self._font_faces is None:
+            self._font_faces = []
+            for rule in self.sheet:
+                if rule.type != rule.FONT_FACE_RULE:
+                    continue
+                css_font_family = font_url = None
+                for p in rule.style:
+                    if p.name == 'font-family' and css_font_family is None:
+                        css_font_family = p.value.split(
+                            ',')[0].strip().strip('"').strip("'")
+                    elif p.name == 'src' and font_url is None:
+                        font_url = rule.style.getProperty(
+                            p.name).propertyValue.item(0).value
+                self._font_faces.append((css_font_family, font_url))
+        return self._font_faces
+
+    @property
+    def font_rules(self):
+        '''
+        List of (selectors, declarations) for style rules (also in @media)
+        setting font-family, font-weight or font-style, see
+        font_declarations()
+        '''
+        if self._font_rules is None:
+            self._font_rules = []
+            for rule in flat_rules(self.sheet):
+                if rule.type != rule.STYLE_RULE:
+                    continue
+                decls = font_declarations((p.name, p.value)
+                                          for p in rule.style)
+                if decls:
+                    self._font_rules.append(
+                        ([sel.selectorText for sel in rule.selectorList],
+                         decls)
+                    )
+        return self._font_rules
+
+    @property
+    def font_face_rules(self):
+        ''' List of (font-family, font-weight, font-style, first src url) '''
+        if self._font_face_rules is None:
+            self._font_face_rules = []
+            for rule in flat_rules(self.sheet):
+                if rule.type != rule.FONT_FACE_RULE:
+                    continue
+                src = rule.style.getProperty('src')
+                if src is None:
+                    continue
+                self._font_face_rules.append((
+                    rule.style.getPropertyValue('font-family').split(
+                        ',')[0].strip().strip('"').strip("'"),
+                    rule.style.getPropertyValue('font-weight'),
+                    rule.style.getPropertyValue('font-style'),
+                    src.propertyValue.item(0).value
+                ))
+        return self._font_face_rules
+
+
+def get_info(raw):
+    ''' Return shared CSSInfo for the stylesheet bytes '''
+    key = hashlib.sha1(raw).digest()
+    info = _cache.get(key)
+    if info is not None:
+        stats['hits'] += 1
+        _cache.move_to_end(key)
+        return info
+    stats['misses'] += 1
+    info = CSSInfo(raw)
+    _cache[key] = info
+    if len(_cache) > MAX_ENTRIES:
+        _cache.popitem(last=False)
+    return info
+
+
+def read_info(path):
+    with open(path, 'rb') as f:
+        return get_info(f.read())
+
+
+def take_sheet(raw):
+    '''
+    Return parsed sheet for modification. The sheet is detached from the
+    cache, so other books never see the changes.
+    '''
+    info = get_info(raw)
+    sheet = info.sheet
+    info._sheet = None
+    return sheet
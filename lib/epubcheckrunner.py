@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import zipfile
+from lib.scheduler import Job
+from lib.scheduler import default_jobs
+from lib.scheduler import run_job
+from lib.scheduler import run_jobs
+
+HOME = os.path.expanduser("~")
+CACHE_DIR = os.path.join(HOME, '.epubQTools', 'cache', 'epubcheck')
+EPUBCHECK_JAR = 'epubcheck.jar'
+
+
+def find_epubcheck_zip(tools_dir):
+    ''' Return path to epubcheck-5.x zip in tools_dir or None '''
+    for e in sorted(os.listdir(tools_dir)):
+        if e.startswith('epubcheck-5.') and e.endswith('.zip'):
+            return os.path.join(tools_dir, e)
+    return None
+
+
+def extract_epubcheck(zip_path, cache_dir=CACHE_DIR):
+    '''
+    Extract EpubCheck zip once into a persistent cache directory and return
+    the path to epubcheck.jar. Later runs reuse the extracted files as long
+    as the zip file content is the same.
+    '''
+    h = hashlib.sha1()
+    with open(zip_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    name = os.path.splitext(os.path.basename(zip_path))[0]
+    target = os.path.join(cache_dir, name + '-' + h.hexdigest()[:12])
+    if not os.path.isdir(target):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix='.extract-', dir=cache_dir)
+        try:
+            with zipfile.ZipFile(zip_path) as z:
+                z.extractall(tmp)
+            os.rename(tmp, target)
+        except OSError:
+            # other process extracted the same zip in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.isdir(target):
+                raise
+    for root, dirs, files in os.walk(target):
+        if EPUBCHECK_JAR in files:
+            return os.path.join(root, EPUBCHECK_JAR)
+    raise IOError('%s not found in "%s"' % (EPUBCHECK_JAR, zip_path))
+
+
+def java_major_version(java='java'):
+    try:
+        proc = subprocess.Popen([java, '-version'], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        out, err = proc.communicate()
+    except OSError:
+        return None
+    m = re.search(r'version "(\d+)(?:\.(\d+))?', out + err)
+    if m is None:
+        return 0
+    major = int(m.group(1))
+    if major == 1 and m.group(2):
+        # old style version string: 1.8.0_292
+        major = int(m.group(2))
+    return major
+
+
+class EpubCheckRunner(object):
+    '''
+    Run EpubCheck for many files. The jar is extracted once into a
+    persistent cache directory, a bounded number of JVMs runs at the same
+    time, and on Java 13+ a class data sharing archive stored next to the
+    jar cuts JVM startup and class loading for every later run.
+    '''
+
+    def __init__(self, jar_path, java='java', jobs=None, timeout=None):
+        self.jar_path = jar_path
+        self.java = java
+        self.jobs = jobs or default_jobs()
+        self.timeout = timeout
+        self.java_version = java_major_version(java)
+        self.cds_archive = os.path.join(os.path.dirname(jar_path),
+                                        'epubcheck.jsa')
+
+    def command(self, epub_path, cds_flags=()):
+        return ([self.java, '-Djava.awt.headless=true'] + list(cds_flags) +
+                ['-jar', self.jar_path, epub_path])
+
+    def uses_cds(self):
+        return self.java_version is not None and self.java_version >= 13
+
+    def cds_flags(self):
+        '''
+        Flags for a JVM that should use the class data archive. The archive
+        is only read, so JVMs running at the same time never write it.
+        '''
+        if self.uses_cds() and os.path.exists(self.cds_archive):
+            return ['-XX:SharedArchiveFile=' + self.cds_archive]
+        return []
+
+    def dump_flags(self):
+        ''' Flags for the single JVM creating the class data archive '''
+        if self.java_version >= 19:
+            return ['-XX:+AutoCreateSharedArchive',
+                    '-XX:SharedArchiveFile=' + self.cds_archive]
+        return ['-XX:ArchiveClassesAtExit=' + self.cds_archive]
+
+    def job(self, epub_path, cds_flags=None):
+        if cds_flags is None:
+            cds_flags = self.cds_flags()
+        return Job(self.command(epub_path, cds_flags), epub_path, True)
+
+    def run_all(self, epub_paths):
+        '''
+        Yield (epub_path, JobResult) in input order. JVM warnings are
+        removed from stderr of the results.
+        '''
+        epub_paths = list(epub_paths)
+        if not epub_paths:
+            return
+        if self.uses_cds() and not os.path.exists(self.cds_archive):
+            # the first JVM dumps loaded classes for all the next ones,
+            # before any other JVM is started
+            first = epub_paths.pop(0)
+            yield first, without_jvm_warnings(
+                run_job(self.job(first, self.dump_flags()), self.timeout))
+        results = run_jobs([self.job(p) for p in epub_paths], self.jobs,
+                           self.timeout)
+        try:
+            for job, result in results:
+                yield job.data, without_jvm_warnings(result)
+        finally:
+            results.close()
+
+
+# messages printed by the JVM itself, e.g. "OpenJDK 64-Bit Server VM
+# warning: ..." or "[0.012s][warning][cds] ..." for an unusable archive
+jvm_warning_re = re.compile(
+    r'^(?:(?:OpenJDK|Java HotSpot\(TM\)) .*VM warning:|'
+    r'\[[^]]*\]\[(?:warning|error|info)\s*\]\[(?:cds|class))'
+)
+
+
+def without_jvm_warnings(result):
+    ''' Return result with JVM warning lines removed from stderr '''
+    if not result.stderr:
+        return result
+    lines = [ln for ln in result.stderr.splitlines(True)
+             if not jvm_warning_re.match(ln)]
+    stderr = ''.join(lines)
+    if not stderr.strip():
+        stderr = ''
+    return result._replace(stderr=stderr)
@@ -17,6 +17,11 @@ import io
 import struct
 from urllib.parse import unquote
 from lib.htmlconstants import entities
+from lib import checkcache
+from lib import csscache
+from lib import fontcache
+from lib.fontcoverage import CoverageCollector
+from lib.fontcoverage import format_missing
 
 try:
     from tidylib import tidy_document
@@ -63,6 +68,59 @@ NCXNS = {'ncx': 'http://www.daisy.org/z3986/2005/ncx/'}
 SVGNS = {'svg': 'http://www.w3.org/2000/svg'}
 CRNS = {'cr': 'urn:oasis:names:tc:opendocument:xmlns:container'}
 
+# bump whenever a check is added or changed to invalidate cached results
+QCHECK_RULES_VERSION = 3
+
+# named HTML entities translated in a single pass over raw member bytes
+entities_re = re.compile(b'|'.join(
+    re.escape(k.encode('utf-8')) for k in entities.keys()
+))
+entities_b = dict(
+    (k.encode('utf-8'), v.encode('utf-8')) for k, v in entities.items()
+)
+
+
+class MemberCache(object):
+    '''
+    Per-book cache of archive members. Every member is read from the zip,
+    translated (named HTML entities) and parsed at most once, so all checks
+    can share a single tree.
+    '''
+
+    def __init__(self, epub):
+        self.epub = epub
+        self._raw = {}
+        self._text = {}
+        self._trees = {}
+
+    def read(self, name):
+        if name not in self._raw:
+            self._raw[name] = self.epub.read(name)
+        return self._raw[name]
+
+    def text(self, name):
+        if name not in self._text:
+            self._text[name] = entities_re.sub(
+                lambda m: entities_b[m.group(0)], self.read(name)
+            )
+        return self._text[name]
+
+    def parse(self, name):
+        ''' Return (tree, error) for the entity translated member '''
+        if name not in self._trees:
+            try:
+                self._trees[name] = (etree.fromstring(
+                    self.text(name), etree.XMLParser(recover=False)
+                ), None)
+            except etree.XMLSyntaxError as e:
+                self._trees[name] = (None, e)
+        return self._trees[name]
+
+    def release(self, name):
+        self._raw.pop(name, None)
+        self._text.pop(name, None)
+        self._trees.pop(name, None)
+
 
 def check_font(path):
     with open(path, 'rb') as f:
@@ -85,17 +143,17 @@ def unquote_urls(tree):
     return tree
 
 
-def check_wm_info(singf, tree, epub, _file_dec):
+def check_wm_info(singf, tree, ctx):
     alltexts = etree.XPath('//xhtml:body//text()',
                            namespaces=XHTMLNS)(tree)
     alltext = ' '.join(alltexts)
     alltext = alltext.replace('\u00AD', '').strip()
     if (alltext == 'Plik jest zabezpieczony znakiem wodnym' or
             'Ten ebook jest chroniony znakiem wodnym' in alltext):
-        print('%sWM info file found "%s"' % (_file_dec, singf))
+        print('%sWM info file found "%s"' % (ctx['file_dec'], singf))
 
 
-def check_display_none(singf, tree, epub, _file_dec, cont_src_list):
+def check_display_none(singf, tree, ctx):
     styles = etree.XPath('//*[@style]',
                          namespaces=XHTMLNS)(tree)
     for s in styles:
@@ -104,28 +162,138 @@ def check_display_none(singf, tree, epub, _file_dec, cont_src_list):
                 ('display: none' in s.get('style')) or
                 ('display:none' in s.get('style'))
             ) and (os.path.basename(
-                   singf) + '#' + str(s.get('id'))) in cont_src_list
+                   singf) + '#' + str(s.get('id'))) in ctx['cont_src_list']
         ):
             print('%sElement with problematic (for kindlegen) '
                   'display:none style found in file "%s"'
-                  % (_file_dec, singf))
+                  % (ctx['file_dec'], singf))
+
+
+def check_body_id(singf, tree, ctx):
+    # build list with body tags with id attributes
+    try:
+        body_id = etree.XPath('//xhtml:body[@id]',
+                              namespaces=XHTMLNS)(tree)[0]
+    except IndexError:
+        return
+    ctx['body_id_list'].append(os.path.basename(singf) + '#' +
+                               body_id.get('id'))
+
+
+def check_watermarks(singf, tree, ctx):
+    if 'wm' in ctx['found']:
+        return
+    _watermarks = etree.XPath('//*[starts-with(text(),"===")]',
+                              namespaces=XHTMLNS)(tree)
+    if len(_watermarks) > 0:
+        print(ctx['file_dec'] + 'Potential problematic WM found ("===")...')
+        ctx['found'].add('wm')
+
+
+def check_meta_charset(singf, tree, ctx):
+    if 'metachar' in ctx['found']:
+        return
+    _metacharsets = etree.XPath('//xhtml:meta[@charset="utf-8"]',
+                                namespaces=XHTMLNS)(tree)
+    if len(_metacharsets) > 0:
+        print(ctx['file_dec'] + 'At least one xhtml file hase problematic'
+              ' <meta charset="utf-8" /> defined...')
+        ctx['found'].add('metachar')
+
+
+def check_toc_candidate(singf, tree, ctx):
+    if ctx['reftoccount'] != 0:
+        return
+    _alltexts = etree.XPath('//xhtml:body//text()',
+                            namespaces=XHTMLNS)(tree)
+    _alltext = ' '.join(_alltexts)
+    if _alltext.find('Spis treści') != -1:
+        print(ctx['file_dec'] + 'Html TOC candidate found: ' + singf)
+
+
+def check_fragments(singf, tree, ctx):
+    p_is = etree.XPath('//processing-instruction("fragment")')(tree)
+    for p in p_is:
+        print(ctx['file_dec'] + 'Useless ' + etree.tostring(
+            p).decode('utf-8') + ' processing instruction found...')
+
+
+def collect_font_chars(singf, tree, ctx):
+    if ctx['coverage'] is not None:
+        ctx['coverage'].collect(tree)
+
+
+def font_coverage_collector(opftree, folder, members):
+    '''
+    Return CoverageCollector with rules of all book stylesheets or None if
+    the book has no @font-face rules
+    '''
+    sheets = []
+    for item in etree.XPath('//opf:item[@media-type="text/css"]',
+                            namespaces=OPFNS)(opftree):
+        name = os.path.relpath(os.path.join(
+            folder, item.get('href'))).replace('\\', '/')
+        try:
+            sheets.append((name, members.read(name)))
+        except (KeyError, zipfile.BadZipfile):
+            continue
+    if not any(b'font-face' in raw for name, raw in sheets):
+        return None
+    collector = CoverageCollector()
+    for name, raw in sheets:
+        collector.add_stylesheet(name, csscache.get_info(raw))
+    return collector
+
+
+def check_font_coverage(ctx, members):
+    ''' Report characters of the text missing in embedded fonts '''
+    if ctx['coverage'] is None:
+        return
+
+    def read_font(path):
+        try:
+            raw = members.read(path)
+        except (KeyError, zipfile.BadZipfile):
+            return None
+        # obfuscated fonts are reported elsewhere
+        if raw[:4] not in {b'\x00\x01\x00\x00', b'OTTO'}:
+            return None
+        return raw
+
+    for path, family, missing in ctx['coverage'].missing(read_font):
+        print('%sFont file "%s" (font-family "%s") has no glyphs for %d '
+              'character(s) used in the text: %s' % (
+                  ctx['file_dec'], path, family, len(missing),
+                  format_missing(missing)))
+
+
+def check_links(singf, tree, ctx):
+    if 'link' in ctx['found']:
+        return
+    _links = etree.XPath('//xhtml:link', namespaces=XHTMLNS)(tree)
+    for _link in _links:
+        if _link.get('type') is None:
+            ctx['found'].add('link')
+            print(ctx['file_dec'] + 'At least one xhtml file has link tag '
+                  'without type attribute defined')
+            break
 
 
-def check_dl_in_html_toc(tree, dir, epub, _file_dec):
+def check_dl_in_html_toc(tree, dir, members, _file_dec):
     try:
         html_toc_path = os.path.relpath(os.path.join(
             dir,
             tree.xpath('//opf:reference[@type="toc"]',
-                       namespaces=OPFNS)[0].get('href')
+                       namespaces=OPFNS)[0].get('href').split('#')[0]
         )).replace('\\', '/')
-        raw = epub.read(html_toc_path)
-        if '<dl>' in raw:
+        raw = members.read(html_toc_path)
+        if b'<dl>' in raw:
             print(_file_dec + 'Problematic DL tag in HTML TOC found...')
     except Exception:
         pass
 
 
-def check_meta_html_covers(tree, dir, epub, _file_dec):
+def check_meta_html_covers(tree, dir, members, _file_dec):
     try:
         html_cover_path = etree.XPath('//opf:reference[@type="cover"]',
                                       namespaces=OPFNS)(tree)[0].get('href')
@@ -145,18 +313,19 @@ def check_meta_html_covers(tree, dir, epub, _file_dec):
     except IndexError:
         print(_file_dec + 'Meta cover is NOT properly defined.')
         return 0
-    parser = etree.XMLParser(recover=True)
+    html_cover_name = os.path.relpath(os.path.join(
+        dir, html_cover_path
+    )).replace('\\', '/')
     try:
-        html_cover_tree = etree.fromstring(
-            epub.read(os.path.relpath(os.path.join(
-                dir, html_cover_path
-            )).replace('\\', '/')),
-            parser
-        )
+        html_cover_tree = members.parse(html_cover_name)[0]
+        if html_cover_tree is None:
+            html_cover_tree = etree.fromstring(
+                members.read(html_cover_name),
+                etree.XMLParser(recover=True)
+            )
     except KeyError as e:
-        print(_file_dec + 'Problem with parsing HTML cover: ' + e)
+        print(_file_dec + 'Problem with parsing HTML cover: ' + str(e))
         html_cover_tree = None
-        pass
     try:
         cover_texts = etree.XPath(
             '//xhtml:body//text()',
@@ -222,7 +391,8 @@ def find_cover_image(_opftree, _file_dec):
         print(_file_dec + 'No images in an entire book found...')
 
 
-def qcheck_opf_file(opf_root, opf_path, _epubfile, _file_dec, alter):
+def qcheck_opf_file(opf_root, opf_path, _epubfile, members, _file_dec,
+                    alter):
 
     def check_orphan_files(epub, opftree, root, _file_dec):
         def is_exluded(name):
@@ -312,11 +482,11 @@ def qcheck_opf_file(opf_root, opf_path, _epubfile, _file_dec, alter):
     else:
         _folder = opf_root + '/'
     try:
-        opftree = etree.fromstring(_epubfile.read(opf_path))
+        opftree = etree.fromstring(members.read(opf_path))
     except etree.XMLSyntaxError as e:
         print('%sCRITICAL! XML file "%s" is not well '
               'formed: "%s"' % (_file_dec, os.path.basename(opf_path), e))
-        opfstring = io.StringIO(_epubfile.read(opf_path))
+        opfstring = io.BytesIO(members.read(opf_path))
         try:
             opftree = etree.parse(opfstring, recover_parser)
         except etree.XMLSyntaxError:
@@ -412,94 +582,42 @@ def qcheck_opf_file(opf_root, opf_path, _epubfile, _file_dec, alter):
     if len(_metacovers) == 0 and _refcovcount == 0:
         find_cover_image(opftree, _file_dec)
     else:
-        check_meta_html_covers(opftree, _folder, _epubfile, _file_dec)
+        check_meta_html_covers(opftree, _folder, members, _file_dec)
 
-    check_dl_in_html_toc(opftree, _folder, _epubfile, _file_dec)
+    check_dl_in_html_toc(opftree, _folder, members, _file_dec)
 
     _htmlfiletags = etree.XPath(
         '//opf:item[@media-type="application/xhtml+xml"]', namespaces=OPFNS
     )(opftree)
-    _linkfound = _unbfound = _ufound = _wmfound = metcharfound = False
-    body_id_list = []
+    ctx = {'file_dec': _file_dec, 'reftoccount': _reftoccount,
+           'body_id_list': [], 'found': set(),
+           'coverage': font_coverage_collector(opftree, _folder, members)}
     for _htmlfiletag in _htmlfiletags:
         _htmlfilepath = _htmlfiletag.get('href')
-        parser = etree.XMLParser(recover=False)
+        _htmlfilename = os.path.relpath(os.path.join(
+            _folder, _htmlfilepath
+        )).replace('\\', '/')
         try:
-            html_str = _epubfile.read(os.path.relpath(os.path.join(
-                _folder, _htmlfilepath
-            )).replace('\\', '/'))
-            for key, entity in entities.items():
-                key = key.encode('utf-8')
-                entity = entity.encode('utf-8')
-                html_str = html_str.replace(key, entity)
+            _xhtmlsoup, e = members.parse(_htmlfilename)
             if is_tidy:
-                document, errors = tidy_document(html_str)
+                document, errors = tidy_document(members.text(_htmlfilename))
                 if errors != '':
                     print(_file_dec + 'HTML Tidy problems '
                           'for: ' + _htmlfilepath)
                     for i in errors.split('\n'):
                         if i != '':
                             print('  ' + i)
-            _xhtmlsoup = etree.fromstring(html_str, parser)
         except (KeyError, zipfile.BadZipfile) as e:
-            print(_file_dec + 'Problem with a file: ' + e)
+            print(_file_dec + 'Problem with a file: ' + str(e))
             continue
-        except etree.XMLSyntaxError as e:
+        if _xhtmlsoup is None:
             print(_file_dec + 'XML file: ' + _htmlfilepath +
-                  ' not well formed: "' + e + '"')
+                  ' not well formed: "' + str(e) + '"')
             continue
-
-        # build list with body tags with id attributes
-        try:
-            body_id = etree.XPath('//xhtml:body[@id]',
-                                  namespaces=XHTMLNS)(_xhtmlsoup)[0]
-        except IndexError:
-            body_id = None
-        if body_id is not None:
-            body_id_list.append(os.path.basename(
-                _htmlfilepath
-            ) + '#' + body_id.get('id'))
-
-        if _wmfound is False:
-            _watermarks = etree.XPath('//*[starts-with(text(),"===")]',
-                                      namespaces=XHTMLNS)(_xhtmlsoup)
-            if len(_watermarks) > 0:
-                print(_file_dec + 'Potential problematic WM found ("===")...')
-                _wmfound = True
-
-        if metcharfound is False:
-            _metacharsets = etree.XPath('//xhtml:meta[@charset="utf-8"]',
-                                        namespaces=XHTMLNS)(_xhtmlsoup)
-            if len(_metacharsets) > 0:
-                print(_file_dec + 'At least one xhtml file hase problematic'
-                      ' <meta charset="utf-8" /> defined...')
-                metcharfound = True
-
-        _alltexts = etree.XPath('//xhtml:body//text()',
-                                namespaces=XHTMLNS)(_xhtmlsoup)
-        _alltext = ' '.join(_alltexts)
-
-        if _reftoccount == 0 and _alltext.find('Spis treści') != -1:
-            print(_file_dec + 'Html TOC candidate found: ' +
-                  _htmlfilepath)
-        check_hyphs = False
-        if check_hyphs:
-            if not _ufound and _alltext.find('\u00AD') != -1:
-                print(_file_dec + 'U+00AD hyphenate marks found.')
-                _ufound = True
-            if not _unbfound and _alltext.find('\u00A0') != -1:
-                print(_file_dec + 'U+00A0 non-breaking space found.')
-                _unbfound = True
-        p_is = etree.XPath('//processing-instruction("fragment")')(_xhtmlsoup)
-        for p in p_is:
-            print(_file_dec + 'Useless ' + etree.tostring(
-                p).decode('utf-8') + ' processing instruction found...')
-        _links = etree.XPath('//xhtml:link', namespaces=XHTMLNS)(_xhtmlsoup)
-        for _link in _links:
-            if not _linkfound and (_link.get('type') is None):
-                _linkfound = True
-                print(_file_dec + 'At least one xhtml file has link tag '
-                      'without type attribute defined')
+        for visitor in SPINE_VISITORS:
+            visitor(_htmlfilepath, _xhtmlsoup, ctx)
+    check_font_coverage(ctx, members)
+    body_id_list = ctx['body_id_list']
 
     # Check dtb:uid - should be identical go dc:identifier
     try:
@@ -507,17 +625,19 @@ def qcheck_opf_file(opf_root, opf_path, _epubfile, _file_dec, alter):
             '//opf:item[@media-type="application/x-dtbncx+xml"]',
             namespaces=OPFNS
         )(opftree)[0].get('href')
-        ncxstr = _epubfile.read(os.path.relpath(os.path.join(_folder,
-                                ncxfile)).replace('\\', '/'))
+        ncxname = os.path.relpath(os.path.join(_folder,
+                                  ncxfile)).replace('\\', '/')
+        ncxtree, e = members.parse(ncxname)
     except (IndexError, KeyError):
         print('%sCRITICAL! NCX file is missing...' % (_file_dec))
-        ncxstr = '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" />'
-    try:
-        ncxtree = etree.fromstring(ncxstr)
-    except etree.XMLSyntaxError as e:
+        ncxtree = etree.fromstring(
+            '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" />'
+        )
+    if ncxtree is None:
         print('%sCRITICAL! XML file "%s" is not well '
               'formed: "%s"' % (_file_dec, ncxfile, e))
-        ncxtree = etree.parse(io.StringIO(ncxstr), recover_parser)
+        ncxtree = etree.parse(io.BytesIO(members.text(ncxname)),
+                              recover_parser)
     contents = etree.XPath('//ncx:content[@src]', namespaces=NCXNS)(ncxtree)
     cont_src_list = []
     for c in contents:
@@ -630,17 +750,12 @@ def find_opf(epub):
     return os.path.dirname(opf_path), opf_path
 
 
-def check_urls_in_css(singf, epub, prepnl, _file_dec):
-    with epub.open(singf) as f:
-        cl = re.sub(r'\/\*[^*]*\*+([^/*][^*]*\*+)*\/',
-                    '', f.read().decode('utf-8')).splitlines()
-        for line in cl:
-            m = re.match(r'.+?url\([ ]?(\"|\')?(.+?)(\"|\')?[ ]?\)', line)
-            if m is not None:
-                check_url(unquote(m.group(2)), singf, prepnl, _file_dec)
+def check_urls_in_css(singf, members, prepnl, _file_dec):
+    for url in csscache.get_info(members.read(singf)).urls:
+        check_url(url, singf, prepnl, _file_dec)
 
 
-def check_urls(singf, tree, prepnl, _file_dec):
+def check_urls(singf, tree, ctx):
     exclude_urls = ('http://', 'https://', 'mailto:', 'tel:', 'data:', '#')
     for u in tree.xpath('//*[@href or @src]'):
         if u.get('src'):
@@ -652,7 +767,7 @@ def check_urls(singf, tree, prepnl, _file_dec):
         url = unquote(url)
         if '#' in url:
             url = url.split('#')[0]
-        check_url(url, singf, prepnl, _file_dec)
+        check_url(url, singf, ctx['prepnl'], ctx['file_dec'])
 
 
 def check_url(url, singf, nlist, _file_dec):
@@ -714,18 +829,50 @@ def check_body_font_family(singf, epub, _file_dec, is_body_family,
 
 
 def list_font_basic_properties(raw_file):
+    return fontcache.basic_properties(raw_file)
+
+
+# checks run over every spine XHTML tree from qcheck_opf_file
+SPINE_VISITORS = (check_body_id, check_watermarks, check_meta_charset,
+                  check_toc_candidate, check_fragments, check_links,
+                  collect_font_chars)
+
+# checks run over every parsed archive member in qcheck
+MEMBER_VISITORS = (check_urls, check_wm_info, check_display_none)
+
+
+def qcheck(root, _file, alter, mod, is_list_fonts, use_cache=True):
+    if not use_cache:
+        checkcache.stats['checked'] += 1
+        return _qcheck(root, _file, alter, mod, is_list_fonts)
+    try:
+        key = checkcache.result_key(os.path.join(root, _file),
+                                    QCHECK_RULES_VERSION, _file, alter, mod,
+                                    is_list_fonts, is_tidy)
+    except (IOError, OSError):
+        checkcache.stats['checked'] += 1
+        return _qcheck(root, _file, alter, mod, is_list_fonts)
+    result = checkcache.load_result('qcheck', key)
+    if result is not None:
+        checkcache.stats['hits'] += 1
+        sys.stdout.write(result['out'])
+        streamhandler.stream.write(result['err'])
+        return None
+    checkcache.stats['checked'] += 1
+    out = checkcache.Tee(sys.stdout)
+    err = checkcache.Tee(streamhandler.stream)
+    sys.stdout = out
+    streamhandler.setStream(err)
     try:
-        font_family = lib.fntutls.get_all_font_names(
-            raw_file)['family_name']
-    except KeyError:
-        font_family = 'NOT DEFINED'
-    italic = lib.fntutls.get_font_characteristics(raw_file)[1]
-    bold = lib.fntutls.get_font_characteristics(raw_file)[2]
-    regular = lib.fntutls.get_font_characteristics(raw_file)[3]
-    return font_family, regular, bold, italic
+        _qcheck(root, _file, alter, mod, is_list_fonts)
+    finally:
+        sys.stdout = out.stream
+        streamhandler.setStream(err.stream)
+    checkcache.store_result('qcheck', key, {'out': out.getvalue(),
+                                            'err': err.getvalue()})
 
 
-def qcheck(root, _file, alter, mod, is_list_fonts):
+def _qcheck(root, _file, alter, mod, is_list_fonts):
     if alter:
         _file_dec = _file + ': '
     else:
@@ -743,13 +890,16 @@ def qcheck(root, _file, alter, mod, is_list_fonts):
         if not alter:
             print('FINISH qcheck for: ' + _file)
         return None
-    cont_src_list = qcheck_opf_file(opf_root, opf_path, epubfile, _file_dec,
-                                    alter)
+    members = MemberCache(epubfile)
+    cont_src_list = qcheck_opf_file(opf_root, opf_path, epubfile, members,
+                                    _file_dec, alter)
     prepnl = []
     for n in epubfile.namelist():
         if not isinstance(n, str):
             n = n.decode('utf-8')
         prepnl.append(os.path.relpath(n).replace('\\', '/'))
+    ctx = {'file_dec': _file_dec, 'prepnl': prepnl,
+           'cont_src_list': cont_src_list}
     is_body_family = is_font_face = False
     ff = sfound = ''
     for singlefile in epubfile.namelist():
@@ -804,16 +954,17 @@ def qcheck(root, _file, alter, mod, is_list_fonts):
                               'rb') as f:
                         c = f.read()
                         try:
+                            lfp = list_font_basic_properties(c)
                             print(
                                 '%sFont info for %s, Family name: "%s", '
                                 'isRegular: %s, isBold: %s, isItalic: %s' %
                                 (
                                     _file_dec,
                                     singlefile,
-                                    list_font_basic_properties(c)[0],
-                                    list_font_basic_properties(c)[1],
-                                    list_font_basic_properties(c)[2],
-                                    list_font_basic_properties(c)[3]
+                                    lfp[0],
+                                    lfp[1],
+                                    lfp[2],
+                                    lfp[3]
                                 )
                             )
                         except (lib.fntutls.UnsupportedFont,
@@ -826,12 +977,13 @@ def qcheck(root, _file, alter, mod, is_list_fonts):
             if os.path.isdir(temp_font_dir):
                 shutil.rmtree(temp_font_dir)
         elif singlefile.lower().endswith('.css'):
-            with epubfile.open(singlefile) as f:
-                css_parser.log.setLog(logging.getLogger(singlefile))
-                css_parser.log.addHandler(streamhandler)
-                css_parser.log.setLevel(logging.WARNING)
-                css_parser.parseString(f.read(), validate=True)
-            check_urls_in_css(singlefile, epubfile, prepnl, _file_dec)
+            css_log = logging.getLogger(singlefile)
+            css_log.addHandler(streamhandler)
+            css_log.setLevel(logging.WARNING)
+            for level, message in csscache.get_info(
+                    members.read(singlefile)).warnings:
+                css_log.log(level, message)
+            check_urls_in_css(singlefile, members, prepnl, _file_dec)
             # TODO: not a real problem with file (make separate check for it)
             # is_body_family, is_font_face, ff, sfound\
             #     = check_body_font_family(
@@ -840,17 +992,13 @@ def qcheck(root, _file, alter, mod, is_list_fonts):
             #     )
         else:
             try:
-                c = epubfile.read(singlefile)
-                for key in entities.keys():
-                    c = c.replace(key, entities[key])
-                sftree = etree.fromstring(c)
+                sftree = members.parse(singlefile)[0]
             except Exception:
                 sftree = None
             if sftree is not None:
-                check_urls(singlefile, sftree, prepnl, _file_dec)
-                check_wm_info(singlefile, sftree, epubfile, _file_dec)
-                check_display_none(singlefile, sftree, epubfile, _file_dec,
-                                   cont_src_list)
+                for visitor in MEMBER_VISITORS:
+                    visitor(singlefile, sftree, ctx)
+        members.release(singlefile)
     if is_body_family:
         if not mod:
             print('%sfont-family for body: "%s" found in "%s"'
@@ -15,15 +15,23 @@ import subprocess
 import sys
 import zipfile
 import uuid
+import struct
+import copy
+import zlib
 import unicodedata
 import io
 
 from pkgutil import get_data
 from urllib.parse import unquote
-from itertools import cycle
 from lib.htmlconstants import entities
 from lib.hyphenator import Hyphenator
 from lib.beautify_book import beautify_book
+from lib.atomicio import AtomicOutput, rename_no_replace
+from lib.fontindex import find_substitute_font
+from lib.fontcoverage import CoverageCollector
+import lib.fntutls
+from lib import csscache
+from lib import timings
 from functools import reduce
 
 try:
@@ -54,6 +62,11 @@ MY_LANGUAGE2 = 'pl-PL'
 HYPHEN_MARK = '\u00AD'
 
 HOME = os.path.expanduser("~")
+
+# always kept in subsetted fonts: ASCII, spaces, hyphens, quotes, dashes
+SUBSET_EXTRA_CHARS = (''.join(chr(c) for c in range(0x20, 0x7F)) +
+                      '\u00a0\u00ad\u2010\u2011\u2013\u2014\u2018\u2019'
+                      '\u201a\u201c\u201d\u201e\u2026\u00ab\u00bb')
 DTD = ('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" '
        '"http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">')
 DTDN = '<!DOCTYPE html>'
@@ -66,6 +79,9 @@ MBPNS = {'mbp': 'https://kindlegen.s3.amazonaws.com/'
 SVGNS = {'svg': 'http://www.w3.org/2000/svg'}
 ADOBE_OBFUSCATION = 'http://ns.adobe.com/pdf/enc#RC'
 IDPF_OBFUSCATION = 'http://www.idpf.org/2008/embedding'
+# number of obfuscated bytes at the beginning of font file
+OBFUSCATED_LENGTH = {ADOBE_OBFUSCATION: 1024, IDPF_OBFUSCATION: 1040}
+FONT_SIGNATURES = {b'\x00\x01\x00\x00', b'OTTO'}
 CRNS = {'cr': 'urn:oasis:names:tc:opendocument:xmlns:container'}
 
 
@@ -79,8 +95,6 @@ def set_dtd(opftree):
 
 
 def rename_files(opf_path, _root, _epubfile, _filename, _file_dec):
-    import unicodedata
-
     if _filename.endswith('_moh.epub'):
         return 0
     try:
@@ -93,17 +107,28 @@ def rename_files(opf_path, _root, _epubfile, _filename, _file_dec):
             opftree = etree.parse(opfstring, recover_parser)
         except etree.XMLSyntaxError:
             return None
-    try:
-        tit = etree.XPath('//dc:title/text()', namespaces=DCNS)(opftree)[0]
-    except Exception:
+    tits = etree.XPath('//dc:title/text()', namespaces=DCNS)(opftree)
+    crs = etree.XPath('//dc:creator/text()', namespaces=DCNS)(opftree)
+    _epubfile.close()
+    return rename_book(tits[0] if tits else None, crs, _root, _filename,
+                       _file_dec)
+
+
+def rename_book(tit, crs, _root, _filename, _file_dec):
+    '''
+    Rename EPUB file to "author - title.epub" using title and list of
+    creators. Return new file name or None if the file was not renamed.
+    '''
+    import unicodedata
+
+    if tit is None:
         print('! ERROR! Renaming file "%s" failed - dc:title (book title) '
               'not found.' % _file_dec)
-        return 0
-    crs = etree.XPath('//dc:creator/text()', namespaces=DCNS)(opftree)
+        return None
     if len(crs) == 0:
         print('! ERROR! Renaming file "%s" failed - dc:creator (book author) '
               'not found.' % _file_dec)
-        return 0
+        return None
     else:
         cr = ''
         for c in crs:
@@ -118,61 +143,55 @@ def rename_files(opf_path, _root, _epubfile, _filename, _file_dec):
     if cr == '':
         print('! ERROR! Renaming file "%s" failed - dc:creator (book author) '
               'is empty.' % _file_dec)
-        return 0
+        return None
     if tit == '':
         print('! ERROR! Renaming file "%s" failed - dc:title (book title) '
               'is empty.' % _file_dec)
-        return 0
+        return None
     nfname = str(cr + ' - ' + tit)
     nfname = nfname.replace('\u2013', '-').replace('/', '_').replace(':', '_')
     nfname = "".join(x for x in nfname if (
         x.isalnum() or x.isspace() or x in ('_', '-', '.')
     ))
-    is_renamed = False
+    new_filename = None
     counter = 1
     if sys.platform == 'darwin':
         nfname = unicodedata.normalize('NFD', nfname)
     while True:
         if _filename == (nfname + '.epub'):
-            is_renamed = False
             break
         elif _filename == (nfname + ' (' + str(counter - 1) + ').epub'):
-            is_renamed = False
             break
-        elif not os.path.exists(os.path.join(_root, nfname + '.epub')):
-            _epubfile.close()
-            os.rename(os.path.join(_root, _filename),
-                      os.path.join(_root, nfname + '.epub'))
+        elif rename_no_replace(os.path.join(_root, _filename),
+                               os.path.join(_root, nfname + '.epub')):
             print('* Renamed file "%s" to "%s.epub".' % (
                 _file_dec, nfname
             ))
-            is_renamed = True
+            new_filename = nfname + '.epub'
             break
-        elif not os.path.exists(os.path.join(_root, nfname + ' (' +
-                                str(counter) + ').epub')):
-            _epubfile.close()
-            os.rename(os.path.join(_root, _filename),
-                      os.path.join(_root, nfname + ' (' + str(counter) +
-                                   ').epub'))
+        elif rename_no_replace(os.path.join(_root, _filename),
+                               os.path.join(_root, nfname + ' (' +
+                                            str(counter) + ').epub')):
             print('* Renamed file "%s" to "%s (%s).epub"' % (
                 _file_dec, nfname, str(counter)
             ))
-            is_renamed = True
+            new_filename = nfname + ' (' + str(counter) + ').epub'
             break
         else:
             counter += 1
-    if not is_renamed:
+    if new_filename is None:
         print('= Renaming file "%s" is not needed.' % _file_dec)
+    return new_filename
 
 
 def check_font(path):
     with open(path, 'rb') as f:
-        raw = f.read()
-    signature = raw[:4]
-    return (signature in {b'\x00\x01\x00\x00', b'OTTO'}, signature)
+        signature = f.read(4)
+    return (signature in FONT_SIGNATURES, signature)
 
 
 # based on calibri work
+@timings.timed
 def unquote_urls(tree):
     def get_href(item):
         raw = unquote(item.get('href', ''))
@@ -204,9 +223,11 @@ def remove_node(node):
 
 
 # based on calibri work
+@timings.timed
 def process_encryption(encfile, opftree, fontdir):
     print('* Font decrypting started...')
     root = etree.parse(encfile)
+    keys = {}
     for em in root.xpath(
             'descendant::*[contains(name(), "EncryptionMethod")]'
     ):
@@ -219,7 +240,10 @@ def process_encryption(encfile, opftree, fontdir):
         uri = cr.get('URI')
         font_path = os.path.abspath(os.path.join(os.path.dirname(encfile),
                                     '..', *uri.split('/')))
-        key = find_encryption_key(opftree, algorithm)
+        # the key depends only on the book and the method
+        if algorithm not in keys:
+            keys[algorithm] = find_encryption_key(opftree, algorithm)
+        key = keys[algorithm]
         if (key and os.path.exists(font_path)):
             decrypt_font(font_path, key, algorithm, fontdir)
     return True
@@ -260,50 +284,41 @@ def find_encryption_key(opftree, method):
     return uid
 
 
+def deobfuscate_font(raw, key, method):
+    '''
+    Return font bytes with obfuscated beginning XORed with key. The
+    operation is symmetric, so it obfuscates plain fonts too.
+    '''
+    crypt_len = min(OBFUSCATED_LENGTH[method], len(raw))
+    mask = (key * (crypt_len // len(key) + 1))[:crypt_len]
+    head = (int.from_bytes(raw[:crypt_len], 'big') ^
+            int.from_bytes(mask, 'big')).to_bytes(crypt_len, 'big')
+    return head + raw[crypt_len:]
+
+
 # based on calibri work
 def decrypt_font(path, key, method, fontdir):
     global qfixerr
-    if method == ADOBE_OBFUSCATION:
-        crypt_len = 1024
-    elif method == IDPF_OBFUSCATION:
-        crypt_len = 1040
     with open(path, 'rb') as f:
         raw = f.read()
-    crypt = bytearray(raw[:crypt_len])
-    key = cycle(iter(bytearray(key)))
-    decrypt = bytes(bytearray(x ^ next(key) for x in crypt))
+    decrypt = deobfuscate_font(raw, key, method)
     print('* Starting decryption of font file "%s"...'
           % os.path.basename(path), end=' ')
-    with open(path, 'wb') as f:
-        f.write(decrypt)
-        f.write(raw[crypt_len:])
-    is_font, signature = check_font(path)
+    is_font = decrypt[:4] in FONT_SIGNATURES
     if not is_font:
+        # keep the file untouched when the key does not match
         print('FAILED!')
     else:
+        with open(path, 'wb') as f:
+            f.write(decrypt)
         print('OK! Decrypted.')
     if not is_font and not ('.ttc' in path):
         print('* Starting replace procedure for encrypted file "%s" with font'
               ' from system directory...' % os.path.basename(path), end=' ')
-        if fontdir is None:
-            fontdir = ''
-        if sys.platform == 'win32':
-            font_paths = [
-                os.path.abspath(os.path.join(os.environ['WINDIR'], 'Fonts')),
-                fontdir
-            ]
-        else:
-            font_paths = [os.path.join(os.path.sep, 'Library', 'Fonts'),
-                          os.path.join(HOME, 'Library', 'Fonts'),
-                          fontdir]
-        for font_path in font_paths:
-            if os.path.exists(os.path.join(font_path,
-                              os.path.basename(path))):
-                os.remove(path)
-                shutil.copyfile(
-                    os.path.join(font_path, os.path.basename(path)),
-                    path
-                )
+        substitute = find_substitute_font(path, fontdir)
+        if substitute is not None:
+            os.remove(path)
+            shutil.copyfile(substitute, path)
         is_font, signature = check_font(path)
         if is_font:
             print('OK! Replaced.')
@@ -312,6 +327,7 @@ def decrypt_font(path, key, method, fontdir):
             print('FAILED! Substitute did NOT found.')
 
 
+@timings.timed
 def find_and_replace_fonts(opftree, rootepubdir, fontdir):
     items = etree.XPath('//opf:item[@href]', namespaces=OPFNS)(opftree)
     for item in items:
@@ -321,6 +337,7 @@ def find_and_replace_fonts(opftree, rootepubdir, fontdir):
             replace_font(actual_font_path, fontdir)
 
 
+@timings.timed
 def xml2html_extension(opftree, rootepubdir):
     is_xml_ext_fixed = False
     items = etree.XPath('//opf:item[@href]', namespaces=OPFNS)(opftree)
@@ -345,6 +362,7 @@ def xml2html_extension(opftree, rootepubdir):
     return opftree, is_xml_ext_fixed
 
 
+@timings.timed
 def xml2html_fix_references(tree, file_dir, ncx):
     if ncx:
         items = etree.XPath('//ncx:content', namespaces=NCXNS)(tree)
@@ -377,6 +395,7 @@ def xml2html_fix_references(tree, file_dir, ncx):
     return tree
 
 
+@timings.timed
 def fix_ncx(opftree, rootepubdir):
     try:
         toc_ncx_file = etree.XPath(
@@ -407,29 +426,10 @@ def fix_ncx(opftree, rootepubdir):
 
 def replace_font(actual_font_path, fontdir):
     global qfixerr
-    if fontdir is None:
-        fontdir = ''
-    if sys.platform == 'win32':
-        font_paths = [
-            os.path.abspath(os.path.join(os.environ['WINDIR'], 'Fonts')),
-            fontdir
-        ]
-    else:
-        font_paths = [os.path.join(os.path.sep, 'Library', 'Fonts'),
-                      os.path.join(HOME, 'Library', 'Fonts'),
-                      fontdir]
-    font_replaced = False
-    for font_path in font_paths:
-        if os.path.exists(
-                os.path.join(font_path, os.path.basename(actual_font_path))
-        ):
-            os.remove(actual_font_path)
-            shutil.copyfile(
-                os.path.join(font_path, os.path.basename(actual_font_path)),
-                actual_font_path
-            )
-            font_replaced = True
-    if font_replaced:
+    substitute = find_substitute_font(actual_font_path, fontdir)
+    if substitute is not None:
+        os.remove(actual_font_path)
+        shutil.copyfile(substitute, actual_font_path)
         print('* Font replaced: ' + os.path.basename(actual_font_path))
     else:
         qfixerr = True
@@ -437,6 +437,7 @@ def replace_font(actual_font_path, fontdir):
               % os.path.basename(actual_font_path))
 
 
+@timings.timed
 def unpack_epub(source_epub):
     epubzipfile = zipfile.ZipFile(source_epub)
     tempdir = tempfile.mkdtemp(suffix='', prefix='epubQTools-tmp-')
@@ -453,35 +454,134 @@ def unpack_epub(source_epub):
     return tempdir
 
 
-def pack_epub(output_filename, source_dir):
-    with zipfile.ZipFile(output_filename, "w") as z:
-        z.writestr("mimetype", "application/epub+zip")
+# already compressed media: deflating them again only costs time
+STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.woff',
+                     '.woff2', '.mp3', '.mp4', '.m4a', '.m4v', '.zip')
+
+
+def _file_crc(filename):
+    crc = 0
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def _is_unchanged(info, filename):
+    return (info.flag_bits & 0x1 == 0 and
+            info.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+            and os.path.getsize(filename) == info.file_size and
+            _file_crc(filename) == info.CRC)
+
+
+def _copy_raw(z, source, info):
+    ''' Copy member compressed data from source zip without recompression '''
+    source.seek(info.header_offset)
+    header = source.read(30)
+    if header[:4] != b'PK\x03\x04':
+        raise zipfile.BadZipfile('Bad local file header: ' + info.filename)
+    name_len, extra_len = struct.unpack('<HH', header[26:30])
+    source.seek(info.header_offset + 30 + name_len + extra_len)
+    zinfo = copy.copy(info)
+    # sizes are known, so no data descriptor is needed
+    zinfo.flag_bits &= ~0x08
+    zinfo.extra = b''
+    zinfo.header_offset = z.fp.tell()
+    z.fp.write(zinfo.FileHeader())
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = source.read(min(remaining, 1 << 20))
+        if not chunk:
+            raise zipfile.BadZipfile('Truncated member: ' + info.filename)
+        z.fp.write(chunk)
+        remaining -= len(chunk)
+    z.filelist.append(zinfo)
+    z.NameToInfo[zinfo.filename] = zinfo
+    z.start_dir = z.fp.tell()
+
+
+@timings.timed
+def pack_epub(output_filename, source_dir, source_epub=None):
+    '''
+    Pack source_dir to EPUB file. Members not changed since source_epub
+    was unpacked are copied from it without recompression, changed ones
+    are deflated, except already compressed media which are stored.
+    '''
+    infos = {}
+    source = None
+    if source_epub is not None:
+        try:
+            with zipfile.ZipFile(source_epub) as sz:
+                infos = dict((i.filename, i) for i in sz.infolist())
+            source = open(source_epub, 'rb')
+        except (zipfile.BadZipfile, IOError, OSError):
+            infos = {}
+    # output may be the source file itself
+    output = AtomicOutput(output_filename)
     relroot = source_dir
-    with zipfile.ZipFile(output_filename, "a", zipfile.ZIP_DEFLATED) as z:
-        for root, dirs, files in os.walk(source_dir):
-            for f in files:
-                filename = os.path.join(root, f)
-                if os.path.isfile(filename):
-                    arcname = os.path.join(os.path.relpath(root, relroot),
-                                           f)
+    try:
+        with zipfile.ZipFile(output.path, "w") as z:
+            z.writestr("mimetype", "application/epub+zip")
+            for root, dirs, files in os.walk(source_dir):
+                for f in files:
+                    filename = os.path.join(root, f)
+                    if not os.path.isfile(filename):
+                        continue
+                    arcname = os.path.join(os.path.relpath(root, relroot), f)
                     if sys.platform == 'darwin':
                         arcname = unicodedata.normalize('NFC', arcname)
-                    z.write(filename, arcname)
+                    info = infos.get(os.path.normpath(arcname).replace(
+                        os.sep, '/'))
+                    if info is not None and _is_unchanged(info, filename):
+                        _copy_raw(z, source, info)
+                    elif f.lower().endswith(STORED_EXTENSIONS):
+                        z.write(filename, arcname, zipfile.ZIP_STORED)
+                    else:
+                        z.write(filename, arcname, zipfile.ZIP_DEFLATED)
+    except BaseException:
+        output.discard()
+        raise
+    finally:
+        if source is not None:
+            source.close()
+    timings.count('archives written')
+    output.commit()
+
+
+def replace_members(epub_path, new_members):
+    '''
+    Rewrite EPUB file replacing only members from new_members dict
+    (arcname -> bytes). All other members are copied without
+    recompression and the original file is replaced when complete.
+    '''
+    with AtomicOutput(epub_path) as output:
+        with zipfile.ZipFile(epub_path) as sz, \
+                open(epub_path, 'rb') as source, \
+                zipfile.ZipFile(output.path, 'w') as z:
+            for info in sz.infolist():
+                if info.filename in new_members:
+                    z.writestr(info.filename, new_members[info.filename],
+                               zipfile.ZIP_DEFLATED)
+                elif info.flag_bits & 0x1 or info.compress_type not in (
+                        zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                    z.writestr(info, sz.read(info))
+                else:
+                    _copy_raw(z, source, info)
 
 
+@timings.timed
 def clean_temp(sourcedir):
-    for p in os.listdir(os.path.join(sourcedir, os.pardir)):
-        if 'epubQTools-tmp-' in p:
-            if os.path.isdir(os.path.join(sourcedir, os.pardir, p)):
-                try:
-                    shutil.rmtree(os.path.join(sourcedir, os.pardir, p))
-                except Exception:
-                    if sys.platform == 'win32':
-                        os.system('rmdir /S /Q \"{}\"'.format(
-                            os.path.join(sourcedir, os.pardir, p)
-                        ))
-                    else:
-                        raise
+    # remove only own temp directory: other epubQTools processes (e.g.
+    # --watch workers) may be using theirs at the same time
+    try:
+        shutil.rmtree(sourcedir)
+    except FileNotFoundError:
+        pass
+    except Exception:
+        if sys.platform == 'win32':
+            os.system('rmdir /S /Q \"{}\"'.format(sourcedir))
+        else:
+            raise
 
 
 def find_roots(tempdir):
@@ -528,6 +628,7 @@ def find_roots(tempdir):
     return os.path.dirname(opf_path), opf_path, False
 
 
+@timings.timed
 def find_xhtml_files(rootepubdir, opftree):
     global qfixerr
     try:
@@ -547,6 +648,7 @@ def find_xhtml_files(rootepubdir, opftree):
     return xhtml_files, xhtml_file_paths
 
 
+@timings.timed
 def hyphenate_and_fix_conjunctions(source_file, hyphen_mark, hyph,
                                    dont_hyph_headers, skip_hyph):
     # set correct xml:lang attribute for html tag
@@ -574,6 +676,7 @@ def hyphenate_and_fix_conjunctions(source_file, hyphen_mark, hyph,
         print('* No texts found...')
     # Tag list used to ignore hyphenation
     ignore_list = ['h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'title']
+    nodes = words = 0
     for t in texts:
         parent = t.getparent()
         if dont_hyph_headers:
@@ -606,12 +709,19 @@ def hyphenate_and_fix_conjunctions(source_file, hyphen_mark, hyph,
             for w in wlist:
                 newt += w.replace(HYPHEN_MARK, '')
         else:
+            nodes += 1
             for w in wlist:
-                newt += hyph.inserted(w, hyphen_mark)
+                hw = hyph.inserted(w, hyphen_mark)
+                if hw != w:
+                    words += 1
+                newt += hw
         fix_hanging_single_conjunctions_and_place_back(t, newt)
+    timings.count('nodes hyphenated', nodes)
+    timings.count('words hyphenated', words)
     return source_file
 
 
+@timings.timed
 def fix_styles(source_file):
     try:
         links = etree.XPath(
@@ -626,6 +736,7 @@ def fix_styles(source_file):
     return source_file
 
 
+@timings.timed
 def fix_nav_in_cover_file(opftree, tempdir):
 
     def move_nav_to_new_toc(tempdir, cover_href, toc_href):
@@ -693,6 +804,7 @@ def fix_nav_in_cover_file(opftree, tempdir):
     return opftree
 
 
+@timings.timed
 def fix_html_toc(soup, tempdir, xhtml_files, xhtml_file_paths):
     reftocs = etree.XPath('//opf:reference[@type="toc"]',
                           namespaces=OPFNS)(soup)
@@ -812,6 +924,7 @@ def fix_html_toc(soup, tempdir, xhtml_files, xhtml_file_paths):
     return soup
 
 
+@timings.timed
 def fix_mismatched_covers(opftree, tempdir):
     global qfixerr
     refcvs = opftree.xpath('//opf:reference[@type="cover"]', namespaces=OPFNS)
@@ -966,6 +1079,7 @@ def force_cover_find(_soup):
     return None, None
 
 
+@timings.timed
 def remove_fonts(opftree, rootepubdir):
     print('* Removing all fonts...')
     for i in opftree.xpath('//opf:item[@href]', namespaces=OPFNS):
@@ -976,6 +1090,65 @@ def remove_fonts(opftree, rootepubdir):
     return opftree
 
 
+@timings.timed
+def subset_embedded_fonts(opftree, rootepubdir, xhtml_files):
+    '''
+    Reduce every embedded TrueType font to the characters used with its
+    font family (plus generated content, SUBSET_EXTRA_CHARS and case
+    variants). Fonts which may be used for text not matched to them are
+    kept whole.
+    '''
+    collector = CoverageCollector()
+    for item in etree.XPath('//opf:item[@media-type="text/css"]',
+                            namespaces=OPFNS)(opftree):
+        try:
+            info = csscache.read_info(os.path.join(rootepubdir,
+                                                   item.get('href')))
+        except (IOError, OSError):
+            continue
+        collector.add_stylesheet(item.get('href'), info)
+    if not collector.families:
+        return
+    for xhtml_file in xhtml_files:
+        try:
+            collector.collect(etree.parse(xhtml_file).getroot())
+        except (etree.XMLSyntaxError, IOError, OSError):
+            collector.incomplete = True
+        if collector.incomplete:
+            print('* Fonts not subsetted: unable to read text of file: ' +
+                  os.path.basename(xhtml_file))
+            return
+    for path in sorted(collector.unresolved_fonts()):
+        print('* Font "%s" not subsetted: its font-family is set by CSS '
+              'rules not matched to the text' % path)
+    before = after = count = 0
+    for path, chars in sorted(collector.subset_chars().items()):
+        font_path = os.path.join(rootepubdir, path)
+        try:
+            with open(font_path, 'rb') as f:
+                raw = f.read()
+        except (IOError, OSError):
+            continue
+        codes = set(map(ord, SUBSET_EXTRA_CHARS))
+        for c in chars:
+            codes.update(map(ord, c + c.upper() + c.lower()))
+        try:
+            subset = lib.fntutls.subset_font(raw, codes)
+        except (lib.fntutls.UnsupportedFont, ValueError, struct.error) as e:
+            print('* Font "%s" not subsetted: %s' % (path, e))
+            continue
+        if len(subset) >= len(raw):
+            continue
+        with open(font_path, 'wb') as f:
+            f.write(subset)
+        count += 1
+        before += len(raw)
+        after += len(subset)
+    if count:
+        print('* Subsetting %d embedded font(s): %d -> %d bytes (saved %d '
+              'bytes)...' % (count, before, after, before - after))
+
+
 def correct_mime_types(_soup):
     _items = etree.XPath('//opf:item[@href]', namespaces=OPFNS)(_soup)
     for _item in _items:
@@ -992,6 +1165,7 @@ def correct_mime_types(_soup):
     return _soup
 
 
+@timings.timed
 def fix_various_opf_problems(soup, tempdir, xhtml_files,
                              xhtml_file_paths):
 
@@ -1165,6 +1339,7 @@ def fix_various_opf_problems(soup, tempdir, xhtml_files,
     return soup
 
 
+@timings.timed
 def fix_meta_cover_order(soup):
     # name='cover' should be before content attribute
     for cover in soup.xpath('//opf:meta[@name="cover" and @content]',
@@ -1173,6 +1348,7 @@ def fix_meta_cover_order(soup):
     return soup
 
 
+@timings.timed
 def fix_ncx_dtd_uid(opftree, tempdir):
     try:
         ncxfile = etree.XPath(
@@ -1253,6 +1429,7 @@ def fix_ncx_dtd_uid(opftree, tempdir):
     return opftree
 
 
+@timings.timed
 def append_reset_css(source_file, xhtml_file, opf_path, opftree):
     try:
         heads = etree.XPath(
@@ -1274,6 +1451,7 @@ def append_reset_css(source_file, xhtml_file, opf_path, opftree):
     return source_file
 
 
+@timings.timed
 def append_reset_css_file(opftree, tempdir, is_rm_family, del_fonts,
                           html_margin, skip_hyph):
 
@@ -1296,41 +1474,20 @@ def append_reset_css_file(opftree, tempdir, is_rm_family, del_fonts,
     try:
         for c in cssitems:
             if not is_body_family:
-                with open(os.path.join(tempdir, c.get('href')), mode='r', 
-                          encoding='utf-8') as f:
-                    # print(repr(f.read()))
-                    fs = f.read()
-                    lis = splitkeepsep(fs, '}')
-                    for e in lis:
-                        if re.search(r'(^|,|\s+)\.calibre(\s+|,|{)', e):
-                            is_calibre_class = True
-                        if re.search(r'(^|,|\s+)body(\s+|,|{)', e):
-                            try:
-                                ff = re.search(
-                                    r'font-family\s*:\s*(.*?)(;|})', e
-                                ).group(1)
-                                is_body_family = True
-                            except Exception:
-                                pass
-                        # if ff != '':
-                        #     break
+                info = csscache.read_info(os.path.join(tempdir,
+                                                       c.get('href')))
+                if info.is_calibre_class:
+                    is_calibre_class = True
+                if info.body_font_family is not None:
+                    ff = info.body_font_family
+                    is_body_family = True
         if not is_body_family:
             print('! Font-family for body or .calibre does not found. Trying '
                   'to find the best font...')
             fflist = []
             for c in cssitems:
-                with open(os.path.join(tempdir, c.get('href')), mode='r', 
-                          encoding='utf-8') as f:
-                    fs = f.read()
-                    lis = splitkeepsep(fs, '}')
-                    for e in lis:
-                        if 'font-family' in e:
-                            try:
-                                fflist.append(re.search(
-                                    r'font-family\s*:\s*(.+?)(;|})', e
-                                ).group(1))
-                            except Exception:
-                                continue
+                fflist += csscache.read_info(os.path.join(
+                    tempdir, c.get('href'))).font_families
             try:
                 ff = most_common(fflist)
             except Exception:
@@ -1428,6 +1585,7 @@ def append_reset_css_file(opftree, tempdir, is_rm_family, del_fonts,
     return opftree, is_reset_css
 
 
+@timings.timed
 def modify_problematic_styles(source_file):
     img_styles = etree.XPath('//xhtml:img[@style]',
                              namespaces=XHTMLNS)(source_file)
@@ -1449,6 +1607,7 @@ def modify_problematic_styles(source_file):
     return source_file
 
 
+@timings.timed
 def remove_text_from_html_cover(opftree, rootepubdir):
     try:
         html_cover_path = os.path.join(rootepubdir, opftree.xpath(
@@ -1490,6 +1649,7 @@ def remove_text_from_html_cover(opftree, rootepubdir):
         )
 
 
+@timings.timed
 def convert_dl_to_ul(opftree, rootepubdir):
     try:
         html_toc_path = os.path.join(rootepubdir, opftree.xpath(
@@ -1512,6 +1672,7 @@ def convert_dl_to_ul(opftree, rootepubdir):
             f.write(raw)
 
 
+@timings.timed
 def remove_wm_info(opftree, rootepubdir):
     wmfiles = ['watermark.', 'default-info.', 'generated.', 'platon_wm.',
                'cover-special.', 'default-info-epub3.']
@@ -1538,6 +1699,7 @@ def remove_wm_info(opftree, rootepubdir):
     return opftree
 
 
+@timings.timed
 def remove_jacket(opftree, rootepubdir):
     items = opftree.xpath('//opf:item', namespaces=OPFNS)
     for i in items:
@@ -1609,6 +1771,7 @@ def process_xhtml_file(xhfile, opftree, _resetmargins, skip_hyph, opf_path,
                   '. NOT well formed: "' + str(e) + '"')
             qfixerr = True
             return 1
+    timings.count('files parsed')
 
     # remove WM remainings
     for i in etree.XPath("//xhtml:body", namespaces=XHTMLNS)(xhtree):
@@ -1683,14 +1846,18 @@ def process_xhtml_file(xhfile, opftree, _resetmargins, skip_hyph, opf_path,
     for p in p_is:
         remove_node(p)
 
+    data = etree.tostring(xhtree, pretty_print=True, xml_declaration=True,
+                          standalone=False, encoding='utf-8',
+                          doctype=set_dtd(opftree))
     with open(xhfile, 'wb') as f:
-        f.write(etree.tostring(xhtree, pretty_print=True, xml_declaration=True,
-                standalone=False, encoding='utf-8', doctype=set_dtd(opftree)))
+        f.write(data)
+    timings.count('files written')
 
 
 def process_epub(_tempdir, _replacefonts, _resetmargins,
                  skip_hyph, arg_justify, arg_left, irmf, fontdir, del_colors,
-                 del_fonts, html_margin, dont_hyph_headers):
+                 del_fonts, html_margin, dont_hyph_headers,
+                 subset_fonts=False):
     global qfixerr
     qfixerr = False
     opf_dir, opf_file_path, is_fixed = find_roots(_tempdir)
@@ -1743,6 +1910,7 @@ def process_epub(_tempdir, _replacefonts, _resetmargins,
                                 str(e)))
         print('! Unable to proceed...')
         return True
+    timings.count('files parsed')
     titles = opftree.xpath('//dc:title', namespaces=DCNS)
     if len(titles) == 0:
         print('! CRITICAL! dc:title (book title) element is NOT '
@@ -1799,9 +1967,11 @@ def process_epub(_tempdir, _replacefonts, _resetmargins,
         if dont_hyph_headers:
             print('* ... except headers...')
     for s in _xhtml_files:
-        process_xhtml_file(s, opftree, _resetmargins, skip_hyph, opf_dir_abs,
-                           is_reset_css, opf_dir_abs, is_xml_ext_fixed,
-                           book_lang, dont_hyph_headers)
+        with timings.span('process_xhtml_file',
+                          os.path.relpath(s, opf_dir_abs)):
+            process_xhtml_file(s, opftree, _resetmargins, skip_hyph,
+                               opf_dir_abs, is_reset_css, opf_dir_abs,
+                               is_xml_ext_fixed, book_lang, dont_hyph_headers)
     opftree = remove_wm_info(opftree, opf_dir_abs)
     opftree = html_cover_first(opftree)
     opftree = fix_nav_in_cover_file(opftree, opf_dir_abs)
@@ -1816,10 +1986,15 @@ def process_epub(_tempdir, _replacefonts, _resetmargins,
         print('* Replacing "text-align: justify" with "text-align: left" in '
               'all CSS files...')
         modify_css_align(opftree, opf_dir_abs, 'left', del_colors)
+    if subset_fonts and not del_fonts:
+        subset_embedded_fonts(opftree, opf_dir_abs, _xhtml_files)
     # write all OPF changes back to file
+    data = etree.tostring(opftree.getroot(), pretty_print=True,
+                          standalone=False, xml_declaration=True,
+                          encoding='utf-8')
     with open(opf_file_path_abs, 'wb') as f:
-        f.write(etree.tostring(opftree.getroot(), pretty_print=True,
-                standalone=False, xml_declaration=True, encoding='utf-8'))
+        f.write(data)
+    timings.count('files written')
     return False
 
 
@@ -1857,6 +2032,7 @@ def process_corrupted_zip(e, root, f, zipbinf):
         return 1
 
 
+@timings.timed
 def modify_css_align(opftree, opfdir, mode, del_colors):
     global qfixerr
     if mode == 'justify':
@@ -1867,7 +2043,11 @@ def modify_css_align(opftree, opfdir, mode, del_colors):
                              namespaces=OPFNS)
     for c in cssitems:
         try:
-            with open(os.path.join(opfdir, c.get('href')), mode='r+', 
+            info = csscache.read_info(os.path.join(opfdir, c.get('href')))
+            if searchmode not in info.text_aligns and not del_colors:
+                # nothing to replace, leave the file untouched
+                continue
+            with open(os.path.join(opfdir, c.get('href')), mode='r+',
                       encoding='utf-8') as cf:
                 cc = cf.read()
                 cc = re.sub(r'text-align\s*:\s*' + searchmode,
@@ -1883,6 +2063,7 @@ def modify_css_align(opftree, opfdir, mode, del_colors):
             pass
 
 
+@timings.timed
 def html_cover_first(opftree):
     refcvs = opftree.xpath('//opf:reference[@type="cover"]', namespaces=OPFNS)
     if len(refcvs) != 1:
@@ -1907,7 +2088,7 @@ def html_cover_first(opftree):
 def qfix(root, f, _forced, _replacefonts, _resetmargins, zbf,
          skip_hyph, arg_justify, arg_left, irmf, del_colors, del_fonts,
          fontdir, fix_container_only, html_margin, dont_hyph_headers,
-         pair_family):
+         pair_family, subset_fonts=False):
     global qfixerr
     qfixerr = False
     newfile = os.path.splitext(f)[0] + '_moh.epub'
@@ -1916,43 +2097,59 @@ def qfix(root, f, _forced, _replacefonts, _resetmargins, zbf,
             print('* Skipping previously generated _moh file: ' +
                   newfile)
             return 0
+    source_epub = os.path.join(root, f)
+    timings.start_book(f)
     try:
-        _tempdir = unpack_epub(os.path.join(root, f))
-    except zipfile.BadZipfile as e:
-        fixed_pth = process_corrupted_zip(e, root, f, zbf)
-        if str(fixed_pth) == '1':
-            return 0
-        else:
-            _tempdir = unpack_epub(fixed_pth)
-            os.unlink(fixed_pth)
-    if fix_container_only:
-        print('')
-        print('* Checking for missing META-INF/container.xml in '
-              'original file: ' + f)
-        opf_dir, opf_file_path, is_fixed = find_roots(_tempdir)
-        if is_fixed:
-            print('* Repairing missing META-INF/container.xml done! '
-                  'Writing changes back to original file...')
-            pack_epub(os.path.join(root, f), _tempdir)
-        else:
-            print('* Repairing not needed...')
-    else:
-        print('')
-        print('START qfix for: ' + f)
-        if skip_hyph:
-            print('* Hyphenating is turned OFF...')
-        is_failed = process_epub(
-            _tempdir, _replacefonts, _resetmargins, skip_hyph,
-            arg_justify, arg_left, irmf, fontdir, del_colors,
-            del_fonts, html_margin, dont_hyph_headers)
-        if not is_failed:
-            pack_epub(os.path.join(root, newfile), _tempdir)
-        else:
-            qfixerr = True
-        if qfixerr:
-            print('FINISH (with PROBLEMS) qfix for: ' + f)
+        try:
+            _tempdir = unpack_epub(source_epub)
+        except zipfile.BadZipfile as e:
+            fixed_pth = process_corrupted_zip(e, root, f, zbf)
+            if str(fixed_pth) == '1':
+                return 0
+            else:
+                _tempdir = unpack_epub(fixed_pth)
+                os.unlink(fixed_pth)
+                source_epub = None
+        if fix_container_only:
+            print('')
+            print('* Checking for missing META-INF/container.xml in '
+                  'original file: ' + f)
+            opf_dir, opf_file_path, is_fixed = find_roots(_tempdir)
+            if is_fixed:
+                print('* Repairing missing META-INF/container.xml done! '
+                      'Writing changes back to original file...')
+                pack_epub(os.path.join(root, f), _tempdir, source_epub)
+            else:
+                print('* Repairing not needed...')
         else:
-            print('FINISH qfix for: ' + f)
-    clean_temp(_tempdir)
-    if not fix_container_only and not is_failed:
-        beautify_book(root, f, fontdir, pair_family)
+            print('')
+            print('START qfix for: ' + f)
+            if skip_hyph:
+                print('* Hyphenating is turned OFF...')
+            is_failed = process_epub(
+                _tempdir, _replacefonts, _resetmargins, skip_hyph,
+                arg_justify, arg_left, irmf, fontdir, del_colors,
+                del_fonts, html_margin, dont_hyph_headers, subset_fonts)
+            if not is_failed:
+                # _moh file appears only when beautify is finished too
+                output = AtomicOutput(os.path.join(root, newfile))
+                pack_epub(output.path, _tempdir, source_epub)
+            else:
+                qfixerr = True
+            if qfixerr:
+                print('FINISH (with PROBLEMS) qfix for: ' + f)
+            else:
+                print('FINISH qfix for: ' + f)
+        clean_temp(_tempdir)
+        if not fix_container_only and not is_failed:
+            try:
+                beautify_book(root, f, fontdir, pair_family, output.path)
+            except BaseException:
+                output.discard()
+                raise
+            output.commit()
+            # only the final _moh file, intermediate writes are counted apart
+            timings.count('output bytes',
+                          os.path.getsize(os.path.join(root, newfile)))
+    finally:
+        timings.finish_book()
@@ -6,16 +6,19 @@
 #
 
 
+import csv
 import zipfile
 import os
 from lxml import etree
 from lib.epubqfix import pack_epub
+from lib.epubqfix import replace_members
 from lib.epubqfix import unpack_epub
 from lib.epubqfix import clean_temp
 from lib.epubqfix import find_roots
 
 OPFNS = {'opf': 'http://www.idpf.org/2007/opf'}
 DCNS = {'dc': 'http://purl.org/dc/elements/1.1/'}
+CRNS = {'cr': 'urn:oasis:names:tc:opendocument:xmlns:container'}
 # OPF = 'http://www.idpf.org/2007/opf'
 # nsmap = {'opf': OPF}
 
@@ -77,24 +80,96 @@ def set_title(tree, title):
     print('* Setting new title to "%s"...' % title)
 
 
+def update_opf(opftree, author, title):
+    if author != 'no_author' and author is not None:
+        set_author(opftree, author)
+    if title != 'no_title' and title is not None:
+        set_title(opftree, title)
+    return etree.tostring(opftree.getroot(), pretty_print=True,
+                          standalone=False, xml_declaration=True,
+                          encoding='utf-8')
+
+
+def find_opf_path(epub):
+    ''' Return OPF path from META-INF/container.xml or None '''
+    try:
+        cr_tree = etree.fromstring(epub.read('META-INF/container.xml'))
+        opf_path = cr_tree.xpath('//cr:rootfile',
+                                 namespaces=CRNS)[0].get('full-path')
+    except (KeyError, IndexError, etree.XMLSyntaxError):
+        return None
+    if opf_path not in epub.namelist():
+        return None
+    return opf_path
+
+
 def fix_name_author(root, f, author, title):
     print('START work for: ' + f)
+    epub_path = os.path.join(root, f)
     try:
-        tempdir = unpack_epub(os.path.join(root, f))
+        with zipfile.ZipFile(epub_path) as epub:
+            opf_path = find_opf_path(epub)
+            if opf_path is not None:
+                parser = etree.XMLParser(remove_blank_text=True)
+                opftree = etree.ElementTree(
+                    etree.fromstring(epub.read(opf_path), parser)
+                )
     except zipfile.BadZipfile:
         print('Unable to process corrupted file...')
         return 0
+    if opf_path is None:
+        # broken container.xml: repair it while unpacking whole book
+        return fix_name_author_unpacked(root, f, author, title)
+    replace_members(epub_path, {opf_path: update_opf(opftree, author,
+                                                     title)})
+    print('FINISH work for: ' + f)
+
+
+def fix_name_author_unpacked(root, f, author, title):
+    tempdir = unpack_epub(os.path.join(root, f))
     opfd, opff, is_fixed = find_roots(tempdir)
     opff_abs = os.path.join(tempdir, opff)
     parser = etree.XMLParser(remove_blank_text=True)
     opftree = etree.parse(opff_abs, parser)
-    if author != 'no_author' and author is not None:
-        set_author(opftree, author)
-    if title != 'no_title' and title is not None:
-        set_title(opftree, title)
     with open(opff_abs, 'wb') as file:
-        file.write(etree.tostring(opftree.getroot(), pretty_print=True,
-                   standalone=False, xml_declaration=True, encoding='utf-8'))
-    pack_epub(os.path.join(root, f), tempdir)
+        file.write(update_opf(opftree, author, title))
+    pack_epub(os.path.join(root, f), tempdir, os.path.join(root, f))
     clean_temp(tempdir)
     print('FINISH work for: ' + f)
+
+
+def fix_name_author_csv(directory, csv_path):
+    '''
+    Set authors and titles of many books from CSV file with "file",
+    "author" and "title" columns. File paths are relative to directory,
+    empty author or title is left unchanged.
+    '''
+    with open(csv_path, 'r', encoding='utf-8-sig', newline='') as c:
+        sample = c.read(4096)
+        c.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        rows = list(csv.DictReader(c, dialect=dialect))
+    counter = failed = 0
+    for row in rows:
+        name = (row.get('file') or '').strip()
+        if not name:
+            continue
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            print('! ERROR! File "%s" not found...' % name)
+            failed += 1
+            continue
+        author = (row.get('author') or '').strip() or None
+        title = (row.get('title') or '').strip() or None
+        if author is None and title is None:
+            continue
+        print('')
+        fix_name_author(os.path.dirname(path), os.path.basename(path),
+                        author, title)
+        counter += 1
+    print('')
+    print('* Metadata updated in %d file(s), %d file(s) not found.' % (
+        counter, failed))
@@ -9,7 +9,9 @@ __docformat__ = 'restructuredtext en'
 
 import struct
 from io import BytesIO
+from bisect import bisect_left
 from collections import defaultdict
+from functools import lru_cache
 
 class UnsupportedFont(ValueError):
     pass
@@ -19,27 +21,81 @@ def get_printable_characters(text):
     return ''.join(x for x in unicodedata.normalize('NFC', text)
             if unicodedata.category(x)[0] not in {'C', 'Z', 'M'})
 
+class Font(object):
+    '''
+    Read-only view of sfnt font data. The table directory is parsed once,
+    on first table access, and tables are returned as memoryview slices
+    of the font data without copying. All functions of this module accept
+    either raw bytes or a Font, so one Font can be shared between them.
+    '''
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.data = memoryview(raw)
+        self._records = None
+        self._tags = None
+
+    @classmethod
+    def of(cls, raw):
+        return raw if isinstance(raw, cls) else cls(raw)
+
+    @property
+    def version(self):
+        return bytes(self.data[:4])
+
+    @property
+    def records(self):
+        '''
+        Dict of tag -> (record offset, table offset, table length, checksum)
+        in table directory order. The first record wins for repeated tags.
+        '''
+        if self._records is None:
+            num_tables = struct.unpack_from(b'>H', self.data, 4)[0]
+            records = {}
+            tags = {}
+            for i in range(num_tables):
+                index = 4*3 + 4*4*i  # table records follow the offset table
+                tag, checksum, offset, length = struct.unpack_from(b'>4s3L',
+                        self.data, index)
+                records.setdefault(tag, (index, offset, length, checksum))
+                tags.setdefault(tag.lower(), tag)
+            self._records, self._tags = records, tags
+        return self._records
+
+    def record(self, name):
+        ''' Directory record of table name (case insensitive) or None '''
+        if not isinstance(name, bytes):
+            name = name.encode('utf-8')
+        records = self.records
+        return records.get(self._tags.get(name.lower()))
+
+    def table(self, name):
+        rec = self.record(name)
+        if rec is None:
+            return None
+        index, offset, length, checksum = rec
+        return self.data[offset:offset+length]
+
+    def tables(self):
+        for tag, (index, offset, length, checksum) in self.records.items():
+            yield tag, self.data[offset:offset+length], index, offset, checksum
+
 def is_truetype_font(raw):
-    sfnt_version = raw[:4]
+    sfnt_version = Font.of(raw).version
     return (sfnt_version in {b'\x00\x01\x00\x00', b'OTTO'}, sfnt_version)
 
 def get_tables(raw):
-    num_tables = struct.unpack_from(b'>H', raw, 4)[0]
-    offset = 4*3  # start of the table record entries
-    for i in range(num_tables):
-        table_tag, table_checksum, table_offset, table_length = struct.unpack_from(
-                    b'>4s3L', raw, offset)
-        yield (table_tag, raw[table_offset:table_offset+table_length], offset,
-                table_offset, table_checksum)
-        offset += 4*4
+    return Font.of(raw).tables()
 
 def get_table(raw, name):
-    ''' Get the raw table bytes for the specified table in the font '''
-    name = bytes(name.lower(), encoding='utf-8')
-    for table_tag, table, table_index, table_offset, table_checksum in get_tables(raw):
-        if table_tag.lower() == name:
-            return table, table_index, table_offset, table_checksum
-    return None, None, None, None
+    ''' Get a view of the specified table in the font '''
+    font = Font.of(raw)
+    rec = font.record(name)
+    if rec is None:
+        return None, None, None, None
+    table_index, table_offset, table_length, table_checksum = rec
+    return (font.data[table_offset:table_offset+table_length], table_index,
+            table_offset, table_checksum)
 
 def get_font_characteristics(raw, raw_is_table=False, return_all=False):
     '''
@@ -179,7 +235,7 @@ def _get_font_names(raw, raw_is_table=False):
         except struct.error:
             break
         offset += string_offset
-        src = table[offset:offset+length]
+        src = bytes(table[offset:offset+length])
         records[name_id].append((platform_id, encoding_id, language_id,
             src))
 
@@ -240,14 +296,17 @@ def get_all_font_names(raw, raw_is_table=False):
     return ans
 
 def checksum_of_block(raw):
-    extra = 4 - len(raw)%4
-    raw += b'\0'*extra
-    num = len(raw)//4
-    return sum(struct.unpack(b'>%dI'%num, raw)) % (1<<32)
+    num, extra = divmod(len(raw), 4)
+    checksum = sum(struct.unpack_from(b'>%dI'%num, raw))
+    if extra:
+        checksum += struct.unpack(b'>I', bytes(raw[4*num:]) +
+                b'\0'*(4-extra))[0]
+    return checksum % (1<<32)
 
 def verify_checksums(raw):
+    font = Font.of(raw)
     head_table = None
-    for table_tag, table, table_index, table_offset, table_checksum in get_tables(raw):
+    for table_tag, table, table_index, table_offset, table_checksum in font.tables():
         if table_tag.lower() == b'head':
             version, fontrev, checksum_adj = struct.unpack_from(b'>ffL', table)
             head_table = table
@@ -257,14 +316,20 @@ def verify_checksums(raw):
             raise ValueError('The %r table has an incorrect checksum'%table_tag)
 
     if head_table is not None:
-        table = head_table
-        table = table[:8] + struct.pack(b'>I', 0) + table[12:]
-        raw = raw[:offset] + table + raw[offset+len(table):]
+        # checksums with checkSumAdjustment (a 32-bit word at offset 8 of
+        # head) set to 0, computed without copying the font
+        adj = checksum_adj if offset % 4 == 0 else None
         # Check the checksum of the head table
-        if checksum_of_block(table) != checksum:
+        if (checksum_of_block(head_table) - checksum_adj) % (1<<32) != checksum:
             raise ValueError('Checksum of head table not correct')
         # Check the checksum of the entire font
-        checksum = checksum_of_block(raw)
+        if adj is None:
+            table = bytes(head_table[:8]) + struct.pack(b'>I', 0) + \
+                    bytes(head_table[12:])
+            checksum = checksum_of_block(bytes(font.data[:offset]) + table +
+                    bytes(font.data[offset+len(table):]))
+        else:
+            checksum = (checksum_of_block(font.data) - adj) % (1<<32)
         q = (0xB1B0AFBA - checksum) & 0xffffffff
         if q != checksum_adj:
             raise ValueError('Checksum of entire font incorrect')
@@ -291,16 +356,17 @@ def remove_embed_restriction(raw):
     if not ok:
         raise UnsupportedFont('Not a supported font, sfnt_version: %r'%sig)
 
-    table, table_index, table_offset = get_table(raw, 'os/2')[:3]
+    font = Font.of(raw)
+    table, table_index, table_offset = get_table(font, 'os/2')[:3]
     if table is None:
         raise UnsupportedFont('Not a supported font, has no OS/2 table')
 
     fs_type_offset = struct.calcsize(b'>HhHH')
     fs_type = struct.unpack_from(b'>H', table, fs_type_offset)[0]
     if fs_type == 0:
-        return raw
+        return font.raw
 
-    f = BytesIO(raw)
+    f = BytesIO(font.data)
     f.seek(fs_type_offset + table_offset)
     f.write(struct.pack(b'>H', 0))
 
@@ -331,54 +397,247 @@ def read_bmp_prefix(table, bmp):
     return (start_count, end_count, range_offset, id_delta, glyph_id_len,
             glyph_id_map, array_len)
 
-def get_bmp_glyph_ids(table, bmp, codes):
-    (start_count, end_count, range_offset, id_delta, glyph_id_len,
-     glyph_id_map, array_len) = read_bmp_prefix(table, bmp)
+class BMPCmap(object):
+    '''
+    Format 4 cmap subtable prepared for repeated lookups. Segments are
+    found by binary search over end_count instead of a linear scan.
+    '''
+
+    def __init__(self, table, bmp):
+        (self.start_count, self.end_count, self.range_offset, self.id_delta,
+         glyph_id_len, self.glyph_id_map, self.array_len) = read_bmp_prefix(
+                 table, bmp)
+
+    def glyph_id(self, code):
+        i = bisect_left(self.end_count, code)
+        if i == len(self.end_count):
+            return 0
+        sc = self.start_count[i]
+        if sc > code:
+            return 0
+        ro = self.range_offset[i]
+        if ro == 0:
+            glyph_id = self.id_delta[i] + code
+        else:
+            idx = ro//2 + (code - sc) + i - self.array_len
+            glyph_id = self.glyph_id_map[idx]
+            if glyph_id != 0:
+                glyph_id += self.id_delta[i]
+        return glyph_id % 0x10000
+
+    def glyph_ids(self, codes):
+        return [self.glyph_id(code) for code in codes]
+
+    def missing(self, codes):
+        ''' Sorted list of code points without glyph in the font '''
+        return sorted(code for code in codes if self.glyph_id(code) == 0)
+
+@lru_cache(maxsize=256)
+def get_bmp_cmap(table, bmp):
+    ''' Shared BMPCmap for the cmap table bytes, built once per font '''
+    return BMPCmap(table, bmp)
 
+def get_bmp_glyph_ids(table, bmp, codes):
+    cmap = get_bmp_cmap(bytes(table), bmp)
     for code in codes:
-        found = False
-        for i, ec in enumerate(end_count):
-            if ec >= code:
-                sc = start_count[i]
-                if sc <= code:
-                    found = True
-                    ro = range_offset[i]
-                    if ro == 0:
-                        glyph_id = id_delta[i] + code
-                    else:
-                        idx = ro//2 + (code - sc) + i - array_len
-                        glyph_id = glyph_id_map[idx]
-                        if glyph_id != 0:
-                            glyph_id += id_delta[i]
-                    yield glyph_id % 0x10000
-                    break
-        if not found:
-            yield 0
+        yield cmap.glyph_id(code)
 
-def get_glyph_ids(raw, text, raw_is_table=False):
-    if not isinstance(text, str):
-        raise TypeError('%r is not a unicode object'%text)
-    if raw_is_table:
-        table = raw
-    else:
-        table = get_table(raw, 'cmap')[0]
-        if table is None:
-            raise UnsupportedFont('Not a supported font, has no cmap table')
+def find_bmp_subtable(table):
+    ''' Offset of the format 4 (3, 1) subtable in the cmap table '''
     version, num_tables = struct.unpack_from(b'>HH', table)
-    bmp_table = None
     for i in range(num_tables):
         platform_id, encoding_id, offset = struct.unpack_from(b'>HHL', table,
                 4 + (i*8))
         if platform_id == 3 and encoding_id == 1:
             table_format = struct.unpack_from(b'>H', table, offset)[0]
             if table_format == 4:
-                bmp_table = offset
-                break
-    if bmp_table is None:
-        raise UnsupportedFont('Not a supported font, has no format 4 cmap table')
+                return offset
+    raise UnsupportedFont('Not a supported font, has no format 4 cmap table')
 
-    for glyph_id in get_bmp_glyph_ids(table, bmp_table, list(map(ord, text))):
+def get_cmap(raw, raw_is_table=False):
+    ''' Return BMPCmap for the format 4 (3, 1) cmap subtable of font '''
+    if raw_is_table:
+        table = raw
+    else:
+        table = get_table(raw, 'cmap')[0]
+        if table is None:
+            raise UnsupportedFont('Not a supported font, has no cmap table')
+    return get_bmp_cmap(bytes(table), find_bmp_subtable(table))
+
+def get_glyph_ids(raw, text, raw_is_table=False):
+    if not isinstance(text, str):
+        raise TypeError('%r is not a unicode object'%text)
+    cmap = get_cmap(raw, raw_is_table)
+    for glyph_id in cmap.glyph_ids(list(map(ord, text))):
+        yield glyph_id
+
+# composite glyph flags
+ARG_1_AND_2_ARE_WORDS = 0x0001
+WE_HAVE_A_SCALE = 0x0008
+MORE_COMPONENTS = 0x0020
+WE_HAVE_AN_X_AND_Y_SCALE = 0x0040
+WE_HAVE_A_TWO_BY_TWO = 0x0080
+
+# tables invalidated by dropping glyphs: signature and glyph substitutions
+# (ligatures could point to removed glyphs)
+SUBSET_DROP_TABLES = {b'DSIG', b'GSUB', b'morx', b'mort'}
+
+def get_loca(raw_loca, num_glyphs, long_format):
+    if long_format:
+        return struct.unpack_from(b'>%dL'%(num_glyphs+1), raw_loca)
+    return tuple(2*x for x in struct.unpack_from(b'>%dH'%(num_glyphs+1),
+        raw_loca))
+
+def composite_components(glyph):
+    ''' Glyph ids used by composite glyph data '''
+    if len(glyph) < 10 or struct.unpack_from(b'>h', glyph)[0] >= 0:
+        return
+    offset = 10
+    while True:
+        flags, glyph_id = struct.unpack_from(b'>HH', glyph, offset)
         yield glyph_id
+        offset += 4
+        offset += 4 if flags & ARG_1_AND_2_ARE_WORDS else 2
+        if flags & WE_HAVE_A_SCALE:
+            offset += 2
+        elif flags & WE_HAVE_AN_X_AND_Y_SCALE:
+            offset += 4
+        elif flags & WE_HAVE_A_TWO_BY_TWO:
+            offset += 8
+        if not flags & MORE_COMPONENTS:
+            break
+
+def build_bmp_cmap(mapping):
+    '''
+    Build cmap table with one format 4 subtable (for platforms 0/3 and 3/1)
+    from dict of code point -> glyph id. Consecutive code points with
+    consecutive glyph ids share one segment.
+    '''
+    segments = []
+    for code in sorted(mapping):
+        gid = mapping[code]
+        if segments and segments[-1][1] == code - 1 and (
+                segments[-1][2] + code - segments[-1][0]) == gid:
+            segments[-1][1] = code
+        else:
+            segments.append([code, code, gid])
+    segments.append([0xFFFF, 0xFFFF, 0])
+    seg_count = len(segments)
+    entry_selector = seg_count.bit_length() - 1
+    search_range = 2 * (1 << entry_selector)
+    length = 16 + 8*seg_count
+    if length > 0xFFFF:
+        raise UnsupportedFont('Too many cmap segments for format 4')
+    array = b'>%dH'%seg_count
+    subtable = struct.pack(b'>7H', 4, length, 0, 2*seg_count, search_range,
+            entry_selector, 2*seg_count - search_range)
+    subtable += struct.pack(array, *[e for s, e, g in segments])
+    subtable += struct.pack(b'>H', 0)
+    subtable += struct.pack(array, *[s for s, e, g in segments])
+    subtable += struct.pack(array, *[(g - s) % 0x10000 if g else 1
+        for s, e, g in segments])
+    subtable += struct.pack(array, *([0]*seg_count))
+    return struct.pack(b'>HH', 0, 2) + struct.pack(b'>HHL', 0, 3, 20) + \
+            struct.pack(b'>HHL', 3, 1, 20) + subtable
+
+def build_sfnt(version, tables):
+    '''
+    Assemble font file from dict of tag -> table bytes and fix all table
+    checksums and head checkSumAdjustment
+    '''
+    tags = sorted(tables)
+    num_tables = len(tags)
+    entry_selector = num_tables.bit_length() - 1
+    search_range = 16 * (1 << entry_selector)
+    header = version + struct.pack(b'>4H', num_tables, search_range,
+            entry_selector, 16*num_tables - search_range)
+    offset = len(header) + 16*num_tables
+    records = []
+    data = []
+    for tag in tags:
+        table = tables[tag]
+        if tag == b'head':
+            head_offset = offset
+            table = bytes(table[:8]) + struct.pack(b'>I', 0) + \
+                    bytes(table[12:])
+        records.append(struct.pack(b'>4s3L', tag, checksum_of_block(table),
+            offset, len(table)))
+        padding = -len(table) % 4
+        data.append(table)
+        data.append(b'\0' * padding)
+        offset += len(table) + padding
+    raw = bytearray(header + b''.join(records) + b''.join(data))
+    if b'head' in tables:
+        q = (0xB1B0AFBA - checksum_of_block(raw)) & 0xffffffff
+        struct.pack_into(b'>I', raw, head_offset + 8, q)
+    return bytes(raw)
+
+def subset_font(raw, codes):
+    '''
+    Return TrueType font reduced to glyphs of given BMP code points (and
+    composite glyph components). Glyph ids are not renumbered: glyphs
+    outside the subset are emptied, so hmtx, kern and GPOS stay valid.
+    The cmap is rebuilt, so other characters fall back to another font.
+    CFF (OTTO) fonts are not supported.
+    '''
+    font = Font.of(raw)
+    ok, sig = is_truetype_font(font)
+    if not ok or sig == b'OTTO':
+        raise UnsupportedFont('Not a TrueType outline font, sfnt_version: %r'%sig)
+    tables = dict((tag, table) for tag, table, index, offset, checksum in
+            font.tables())
+    for name in (b'head', b'maxp', b'loca', b'glyf', b'cmap'):
+        if name not in tables:
+            raise UnsupportedFont('Not a supported font, has no %s table'%
+                    name.decode('ascii'))
+    cmap = get_cmap(tables[b'cmap'], raw_is_table=True)
+    mapping = {}
+    for code in codes:
+        if code <= 0xFFFF:
+            glyph_id = cmap.glyph_id(code)
+            if glyph_id:
+                mapping[code] = glyph_id
+    num_glyphs = struct.unpack_from(b'>H', tables[b'maxp'], 4)[0]
+    long_format = struct.unpack_from(b'>h', tables[b'head'], 50)[0] == 1
+    loca = get_loca(tables[b'loca'], num_glyphs, long_format)
+    glyf = tables[b'glyf']
+
+    keep = set()
+    todo = [0] + list(mapping.values())
+    while todo:
+        glyph_id = todo.pop()
+        if glyph_id in keep or glyph_id >= num_glyphs:
+            continue
+        keep.add(glyph_id)
+        todo.extend(composite_components(glyf[loca[glyph_id]:loca[glyph_id+1]]))
+
+    new_glyf = []
+    new_loca = [0]
+    offset = 0
+    for glyph_id in range(num_glyphs):
+        if glyph_id in keep:
+            glyph = glyf[loca[glyph_id]:loca[glyph_id+1]]
+            padding = -len(glyph) % 4
+            new_glyf.append(glyph)
+            new_glyf.append(b'\0' * padding)
+            offset += len(glyph) + padding
+        new_loca.append(offset)
+    if long_format:
+        tables[b'loca'] = struct.pack(b'>%dL'%len(new_loca), *new_loca)
+    else:
+        tables[b'loca'] = struct.pack(b'>%dH'%len(new_loca),
+                *[x//2 for x in new_loca])
+    tables[b'glyf'] = b''.join(new_glyf)
+    tables[b'cmap'] = build_bmp_cmap(mapping)
+    if b'OS/2' in tables and len(tables[b'OS/2']) >= 68 and mapping:
+        os2 = tables[b'OS/2']
+        tables[b'OS/2'] = bytes(os2[:64]) + struct.pack(b'>HH', min(mapping),
+                max(mapping)) + bytes(os2[68:])
+    for tag in SUBSET_DROP_TABLES:
+        tables.pop(tag, None)
+    raw = build_sfnt(sig, tables)
+    verify_checksums(raw)
+    return raw
 
 def supports_text(raw, text, has_only_printable_chars=False):
     if not isinstance(text, str):
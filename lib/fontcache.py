@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import hashlib
+import struct
+from collections import OrderedDict
+
+import lib.fntutls
+from lib import checkcache
+
+# bump when the stored font facts change
+FONT_INFO_VERSION = 1
+
+# maximum number of distinct fonts kept per process
+MAX_ENTRIES = 4096
+
+# read and write font facts in the on-disk cache too
+use_disk = True
+
+_cache = OrderedDict()
+stats = {'hits': 0, 'disk_hits': 0, 'parsed': 0}
+
+
+def parse_font(raw):
+    '''
+    Return dict with names and OS/2 characteristics of font. Problems are
+    stored in "error".
+    '''
+    info = {'version': FONT_INFO_VERSION, 'error': None}
+    # one table directory parse for both lookups
+    font = lib.fntutls.Font(raw)
+    try:
+        info['names'] = lib.fntutls.get_all_font_names(font)
+        info['characteristics'] = list(
+            lib.fntutls.get_font_characteristics(font))
+    except (lib.fntutls.UnsupportedFont, struct.error, ValueError) as e:
+        info['error'] = str(e) or e.__class__.__name__
+    return info
+
+
+def get_info(raw):
+    ''' Return shared font facts dict for the font file bytes '''
+    key = hashlib.sha1(raw).hexdigest()
+    info = _cache.get(key)
+    if info is not None:
+        stats['hits'] += 1
+        _cache.move_to_end(key)
+        return info
+    if use_disk:
+        info = checkcache.load_result('fonts', key)
+        if info is not None and info.get('version') != FONT_INFO_VERSION:
+            info = None
+    if info is not None:
+        stats['disk_hits'] += 1
+    else:
+        stats['parsed'] += 1
+        info = parse_font(raw)
+        if use_disk:
+            checkcache.store_result('fonts', key, info)
+    _cache[key] = info
+    if len(_cache) > MAX_ENTRIES:
+        _cache.popitem(last=False)
+    return info
+
+
+def basic_properties(raw):
+    '''
+    Return (family name, is regular, is bold, is italic) of font. Raise
+    UnsupportedFont for fonts which could not be parsed.
+    '''
+    info = get_info(raw)
+    if info['error'] is not None:
+        raise lib.fntutls.UnsupportedFont(info['error'])
+    ch = info['characteristics']
+    return (info['names'].get('family_name', 'NOT DEFINED'), ch[3], ch[2],
+            ch[1])
+
+
+def postscript_name(raw):
+    info = get_info(raw)
+    if info['error'] is not None:
+        return None
+    return info['names'].get('postscript_name')
+
+
+def summary():
+    ''' Hit-rate line for the current run or None if no font was read '''
+    lookups = stats['hits'] + stats['disk_hits'] + stats['parsed']
+    if not lookups:
+        return None
+    return ('font cache: %d lookup(s), %d in memory, %d on disk, %d parsed '
+            '(%.0f%% hit rate)' % (
+                lookups, stats['hits'], stats['disk_hits'], stats['parsed'],
+                100.0 * (lookups - stats['parsed']) / lookups))
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import posixpath
+import re
+import struct
+import unicodedata
+from collections import defaultdict
+from urllib.parse import unquote
+
+import lib.fntutls
+from lib.csscache import font_declarations
+
+XHTML = '{http://www.w3.org/1999/xhtml}'
+
+# user agent defaults
+BOLD_TAGS = {'b', 'strong', 'th', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+ITALIC_TAGS = {'i', 'em', 'cite', 'var', 'dfn', 'address'}
+
+# maximum number of missing characters listed per font
+MAX_LISTED = 20
+
+compound_re = re.compile(
+    r'^([a-zA-Z][\w-]*|\*)?((?:[.#][\w-]+)*)(:root)?$')
+# CSS generated content, e.g. content: counter(note) "\2022  "
+content_re = re.compile(r'(?<![\w-])content\s*:([^;}]*)')
+string_re = re.compile(r'"((?:[^"\\]|\\.)*)"|' r"'((?:[^'\\]|\\.)*)'")
+css_escape_re = re.compile(r'\\([0-9a-fA-F]{1,6})\s?|\\(.)')
+# font declaration using a custom property, css_parser may drop it
+font_var_re = re.compile(r'font(?:-family)?\s*:[^;}]*var\(')
+
+
+def family_names(value):
+    ''' Families of font-family value, normalized for comparison '''
+    return [f.strip().strip('"').strip("'").lower()
+            for f in value.split(',')]
+
+
+def inline_declarations(style):
+    ''' Font declarations of style attribute (see font_declarations) '''
+    return font_declarations(
+        (name, value.replace('!important', ''))
+        for name, sep, value in (d.partition(':') for d in style.split(';'))
+        if sep
+    )
+
+
+def is_unresolvable(decls):
+    '''
+    True if declarations set a font family we cannot tell (unknown font
+    shorthand value or custom property)
+    '''
+    return 'font' in decls or 'var(' in decls.get('font-family', '')
+
+
+def content_chars(text):
+    ''' Characters of strings in content declarations of CSS text '''
+    chars = set()
+    for m in content_re.finditer(text):
+        for m2 in string_re.finditer(m.group(1)):
+            chars.update(css_escape_re.sub(
+                lambda e: (chr(int(e.group(1), 16)) if e.group(1)
+                           else e.group(2)),
+                m2.group(1) if m2.group(1) is not None else m2.group(2)
+            ))
+    return chars
+
+
+def is_bold(value):
+    value = value.strip().lower()
+    if value in ('bold', 'bolder'):
+        return True
+    if value.isdigit():
+        return int(value) >= 600
+    return False
+
+
+def is_italic(value):
+    return value.strip().lower() in ('italic', 'oblique')
+
+
+def parse_selector(selector):
+    '''
+    Return (tag, id, classes, specificity) for the last compound of simple
+    selector or None if the selector is not supported. Ancestor parts are
+    ignored, so "div.note p" matches every p.
+    '''
+    last = re.split(r'\s*[\s>+~]\s*', selector.strip())[-1]
+    m = compound_re.match(last)
+    if m is None:
+        return None
+    tag = m.group(1)
+    if tag == '*':
+        tag = None
+    ids = re.findall(r'#([\w-]+)', m.group(2))
+    classes = frozenset(re.findall(r'\.([\w-]+)', m.group(2)))
+    if len(ids) > 1:
+        return None
+    pseudo = 0
+    if m.group(3):
+        # :root is the html element
+        if tag is not None and tag.lower() != 'html':
+            return None
+        tag = 'html'
+        pseudo = 1
+    return (tag.lower() if tag else None, ids[0] if ids else None, classes,
+            (len(ids), len(classes) + pseudo, 1 if m.group(1) else 0))
+
+
+class CoverageCollector(object):
+    '''
+    Collect characters used with every embedded font face of a book in
+    one pass over already parsed XHTML trees, then check them against the
+    fonts' cmap tables.
+
+    Font properties are resolved from rules with simple selectors (tag,
+    class, id, :root and their compounds) by specificity and order, also
+    in @media, inline style attributes (font shorthand too) and
+    inheritance from the html element.
+    '''
+
+    def __init__(self):
+        self.faces = {}
+        self.families = {}
+        self.rules = defaultdict(list)
+        self.order = 0
+        self.chars = defaultdict(set)
+        self.all_chars = set()
+        # characters of CSS generated content (::before, ::after)
+        self.content_chars = set()
+        # lowercase font-family/font values set where we cannot tell for
+        # which text: rules with selectors we do not match, unknown font
+        # shorthand values and custom properties
+        self.unresolved = []
+        # set when text of a document could not be collected
+        self.incomplete = False
+
+    def add_stylesheet(self, name, info):
+        ''' Register rules of parsed CSS file name (csscache.CSSInfo) '''
+        for family, weight, style, url in info.font_face_rules:
+            path = posixpath.normpath(posixpath.join(
+                posixpath.dirname(name), unquote(url)))
+            key = (family.lower(), is_bold(weight), is_italic(style))
+            self.faces.setdefault(key, path)
+            self.families.setdefault(family.lower(), family)
+        if 'content' in info.text:
+            self.content_chars.update(content_chars(info.text))
+        if font_var_re.search(info.text):
+            self.unresolved.append('var(')
+        for selectors, decls in info.font_rules:
+            self.order += 1
+            if is_unresolvable(decls):
+                self._unresolved(decls)
+            for selector in selectors:
+                parsed = parse_selector(selector)
+                if parsed is None:
+                    self._unresolved(decls)
+                    continue
+                tag, el_id, classes, specificity = parsed
+                rule = (specificity, self.order, tag, el_id, classes, decls)
+                if el_id is not None:
+                    self.rules['#' + el_id].append(rule)
+                elif classes:
+                    for c in classes:
+                        self.rules['.' + c].append(rule)
+                else:
+                    self.rules[tag or '*'].append(rule)
+
+    def _unresolved(self, decls):
+        for name in ('font-family', 'font'):
+            if name in decls:
+                self.unresolved.append(decls[name].lower())
+
+    def is_unresolved(self, family):
+        ''' True if family may be used for text not collected for it '''
+        for value in self.unresolved:
+            if 'var(' in value or family in value:
+                return True
+        return False
+
+    def _family(self, value, inherited):
+        '''
+        Family used for font-family value: the first one with @font-face
+        rules, as the other ones are usually not available on devices
+        '''
+        if value.strip().lower() in ('inherit', 'unset'):
+            return inherited
+        names = family_names(value)
+        for name in names:
+            if name in self.families:
+                return name
+        return names[0]
+
+    def _compute(self, el, inherited):
+        ''' (family, bold, italic) of element with inherited parent ones '''
+        family, bold, italic = inherited
+        tag = el.tag.rsplit('}', 1)[-1].lower()
+        if tag in BOLD_TAGS:
+            bold = True
+        if tag in ITALIC_TAGS:
+            italic = True
+        decls_list = self._declarations(el, tag)
+        style = el.get('style')
+        if style and 'font' in style:
+            decls = inline_declarations(style)
+            if is_unresolvable(decls):
+                self._unresolved(decls)
+            decls_list.append(decls)
+        for decls in decls_list:
+            if 'font-family' in decls:
+                family = self._family(decls['font-family'], family)
+            if 'font-weight' in decls:
+                bold = is_bold(decls['font-weight'])
+            if 'font-style' in decls:
+                italic = is_italic(decls['font-style'])
+        return family, bold, italic
+
+    def _declarations(self, el, tag):
+        ''' Declarations for element, by ascending priority '''
+        el_id = el.get('id')
+        el_classes = el.get('class')
+        el_classes = set(el_classes.split()) if el_classes else set()
+        keys = [tag, '*'] + ['.' + c for c in el_classes]
+        if el_id is not None:
+            keys.append('#' + el_id)
+        matched = {}
+        for key in keys:
+            for rule in self.rules.get(key, ()):
+                specificity, order, rtag, rid, rclasses, decls = rule
+                if rtag is not None and rtag != tag:
+                    continue
+                if rid is not None and rid != el_id:
+                    continue
+                if not rclasses <= el_classes:
+                    continue
+                matched[(specificity, order)] = decls
+        return [matched[k] for k in sorted(matched)]
+
+    def collect(self, tree):
+        ''' Add characters of XHTML tree to the sets of its font faces '''
+        if not self.families:
+            return
+        body = tree.find(XHTML + 'body')
+        if body is None:
+            body = tree.find('body')
+        if body is None:
+            self.incomplete = True
+            return
+        for style in tree.iter(XHTML + 'style', 'style'):
+            # rules of the document only, families they set are unresolved
+            if style.text and 'font' in style.text:
+                self.unresolved.append(style.text.lower())
+        html = body.getparent()
+        if html is None:
+            computed = {None: (None, False, False)}
+        else:
+            computed = {html: self._compute(html, (None, False, False))}
+        for el in body.iter():
+            if not isinstance(el.tag, str):
+                parent = computed[el.getparent()]
+                self._add(parent, el.tail)
+                continue
+            computed[el] = self._compute(el, computed[el.getparent()])
+            self._add(computed[el], el.text)
+            if el is not body:
+                self._add(computed[el.getparent()], el.tail)
+
+    def _add(self, props, text):
+        if text:
+            self.all_chars.update(text)
+            if props[0] in self.families:
+                self.chars[props].update(text)
+
+    def face_for(self, props):
+        ''' Font file used for (family, bold, italic) or None '''
+        family, bold, italic = props
+        for key in ((family, bold, italic), (family, bold, False),
+                    (family, False, italic), (family, False, False)):
+            if key in self.faces:
+                return self.faces[key]
+        return None
+
+    def used_chars(self):
+        ''' Return dict of font path -> set of characters used with it '''
+        used = defaultdict(set)
+        for props, chars in self.chars.items():
+            path = self.face_for(props)
+            if path is not None:
+                used[path].update(chars)
+        return used
+
+    def unresolved_fonts(self):
+        ''' Font paths of families which may be used for other text too '''
+        return set(path for key, path in self.faces.items()
+                   if self.is_unresolved(key[0]))
+
+    def subset_chars(self):
+        '''
+        Return dict of font path -> characters its subset has to keep:
+        the ones used with any face of its family (weight and style set by
+        unmatched selectors may pick another face) and generated content.
+        Fonts of unresolved_fonts() are not included.
+        '''
+        by_family = defaultdict(set)
+        for props, chars in self.chars.items():
+            if self.face_for(props) is not None:
+                by_family[props[0]].update(chars)
+        skipped = self.unresolved_fonts()
+        used = {}
+        for (family, bold, italic), path in self.faces.items():
+            if family in by_family and path not in skipped:
+                used.setdefault(path, set()).update(by_family[family],
+                                                    self.content_chars)
+        return used
+
+    def missing(self, read_font):
+        '''
+        Return list of (font path, family, sorted missing code points).
+        read_font(path) returns font bytes or None if not available.
+        '''
+        families = dict((path, self.families[key[0]])
+                        for key, path in self.faces.items())
+        used = self.used_chars()
+        result = []
+        for path in sorted(used):
+            raw = read_font(path)
+            if raw is None:
+                continue
+            try:
+                cmap = lib.fntutls.get_cmap(raw)
+            except (lib.fntutls.UnsupportedFont, ValueError, struct.error):
+                continue
+            codes = set(
+                ord(c) for c in used[path]
+                if unicodedata.category(c)[0] not in ('C', 'Z') and
+                ord(c) <= 0xFFFF
+            )
+            missing = cmap.missing(codes)
+            if missing:
+                result.append((path, families[path], missing))
+        return result
+
+
+def format_missing(codes):
+    listed = ', '.join('%s (U+%04X)' % (chr(c), c) for c in codes[:MAX_LISTED])
+    if len(codes) > MAX_LISTED:
+        listed += ', ... (%d more)' % (len(codes) - MAX_LISTED)
+    return listed
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import os
+import sqlite3
+import sys
+import time
+from collections import defaultdict
+from collections import namedtuple
+
+from lib import fontcache
+from lib import fontstore
+
+HOME = os.path.expanduser("~")
+FONT_INDEX_PATH = os.path.join(HOME, '.epubQTools', 'fontindex.sqlite')
+SCHEMA_VERSION = 1
+FONT_EXTENSIONS = ('.ttf', '.otf')
+
+# seconds after which long running processes (--watch, --serve) walk the
+# font directory again
+REFRESH_INTERVAL = 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS fonts (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    family TEXT,
+    regular INTEGER,
+    bold INTEGER,
+    italic INTEGER,
+    ps_name TEXT
+);
+'''
+
+# family is None for files which could not be parsed
+FontEntry = namedtuple('FontEntry', 'path family regular bold italic ps_name')
+
+
+def read_font_entry(path):
+    ''' Parse family, style flags and PostScript name of font file '''
+    with open(path, 'rb') as f:
+        raw = f.read()
+    try:
+        family, regular, bold, italic = fontcache.basic_properties(raw)
+    except Exception:
+        return FontEntry(path, None, None, None, None, None)
+    return FontEntry(path, family, regular, bold, italic,
+                     fontcache.postscript_name(raw))
+
+
+class FontIndex(object):
+    '''
+    Persistent index of font files in user font directory. Only new or
+    changed files (by size and mtime) are parsed again, lookups by family
+    and style or by file name use in-memory dicts.
+    '''
+
+    def __init__(self, path=FONT_INDEX_PATH):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30)
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self.db.execute('DROP TABLE IF EXISTS fonts')
+            self.db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        self.db.executescript(SCHEMA)
+        self.font_dir = None
+        self.refreshed = 0
+        self.entries = []
+        self.by_style = {}
+        self.by_family = {}
+        self.by_name = {}
+        self.stats = {'parsed': 0, 'unchanged': 0, 'removed': 0}
+
+    def close(self):
+        self.db.close()
+
+    def refresh(self, font_dir):
+        ''' Walk font_dir, parse changed files and rebuild lookup dicts '''
+        font_dir = os.path.abspath(font_dir)
+        prefix = os.path.join(font_dir, '')
+        known = dict(
+            (r[0], (r[1], r[2])) for r in self.db.execute(
+                'SELECT path, mtime_ns, size FROM fonts '
+                'WHERE substr(path, 1, ?) = ?', (len(prefix), prefix)
+            )
+        )
+        found = set()
+        for root, dirs, files in os.walk(font_dir):
+            for f in files:
+                if not f.lower().endswith(FONT_EXTENSIONS):
+                    continue
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                    found.add(path)
+                    if known.get(path) == (st.st_mtime_ns, st.st_size):
+                        self.stats['unchanged'] += 1
+                        continue
+                    entry = read_font_entry(path)
+                except (IOError, OSError):
+                    continue
+                self.stats['parsed'] += 1
+                self.db.execute(
+                    'INSERT OR REPLACE INTO fonts VALUES (?, ?, ?, ?, ?, ?, '
+                    '?, ?)', (path, st.st_mtime_ns, st.st_size) + entry[1:]
+                )
+        removed = set(known) - found
+        self.stats['removed'] += len(removed)
+        self.db.executemany('DELETE FROM fonts WHERE path = ?',
+                            [(p,) for p in removed])
+        self.db.commit()
+        self.font_dir = font_dir
+        self.refreshed = time.time()
+        self._load(prefix)
+
+    def _load(self, prefix):
+        self.entries = []
+        self.by_style = defaultdict(list)
+        self.by_family = defaultdict(list)
+        self.by_name = defaultdict(list)
+        for row in self.db.execute(
+                'SELECT path, family, regular, bold, italic, ps_name '
+                'FROM fonts WHERE substr(path, 1, ?) = ? ORDER BY path',
+                (len(prefix), prefix)):
+            entry = FontEntry(row[0], row[1],
+                              *[None if v is None else bool(v)
+                                for v in row[2:5]], ps_name=row[5])
+            self.by_name[os.path.basename(entry.path)].append(entry)
+            if entry.family is None:
+                continue
+            self.entries.append(entry)
+            self.by_family[entry.family].append(entry)
+            self.by_style[(entry.family, entry.regular, entry.bold,
+                           entry.italic)].append(entry)
+
+    def find(self, family, regular=None, bold=None, italic=None):
+        ''' Fonts of given family, all styles if style is not given '''
+        if regular is None and bold is None and italic is None:
+            return self.by_family.get(family, [])
+        return self.by_style.get((family, regular, bold, italic), [])
+
+    def find_file(self, name):
+        '''
+        Font file with given file name, preferring the one placed directly
+        in the font directory
+        '''
+        entries = self.by_name.get(name)
+        if not entries:
+            return None
+        for e in entries:
+            if os.path.dirname(e.path) == self.font_dir:
+                return e.path
+        return entries[0].path
+
+
+_indexes = {}
+
+
+def font_index(font_dir):
+    '''
+    Return process wide FontIndex for font_dir, refreshed on first use and
+    then at most every REFRESH_INTERVAL seconds
+    '''
+    font_dir = os.path.abspath(font_dir)
+    index = _indexes.get(font_dir)
+    if index is None:
+        index = _indexes[font_dir] = FontIndex()
+    if time.time() - index.refreshed > REFRESH_INTERVAL:
+        index.refresh(font_dir)
+    return index
+
+
+def find_substitute_font(path, fontdir):
+    '''
+    Return path of substitute for embedded font file path: file with the
+    same name from user font directory, matching font from the font store
+    (only with --font-store, see fontstore.find_font) or file with the same
+    name from system font directories. None if not found.
+    '''
+    name = os.path.basename(path)
+    if fontdir:
+        substitute = font_index(fontdir).find_file(name)
+        if substitute is not None:
+            return substitute
+    if fontstore.store_dir is not None:
+        try:
+            with open(path, 'rb') as f:
+                substitute = fontstore.find_font(f.read())
+        except (IOError, OSError):
+            substitute = None
+        if substitute is not None:
+            return substitute
+    if sys.platform == 'win32':
+        font_paths = [
+            os.path.abspath(os.path.join(os.environ['WINDIR'], 'Fonts'))
+        ]
+    else:
+        font_paths = [os.path.join(HOME, 'Library', 'Fonts'),
+                      os.path.join(os.path.sep, 'Library', 'Fonts')]
+    for font_path in font_paths:
+        if os.path.exists(os.path.join(font_path, name)):
+            return os.path.join(font_path, name)
+    return None
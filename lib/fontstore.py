@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import hashlib
+import json
+import os
+import zipfile
+from collections import defaultdict
+from collections import namedtuple
+
+from lib import fontcache
+from lib.atomicio import AtomicOutput
+from lib.catalog import is_source_epub
+
+HOME = os.path.expanduser("~")
+FONT_STORE_PATH = os.path.join(HOME, '.epubQTools', 'fonts')
+STORE_VERSION = 2
+FONT_EXTENSIONS = ('.ttf', '.otf')
+# font obfuscation changes at most the first 1040 bytes (IDPF), the rest
+# identifies a stored font even when the embedded copy cannot be decrypted
+OBFUSCATED_LENGTH = 1040
+
+# store used by find_font(), set from --font-store (not used if None)
+store_dir = None
+
+# font file embedded in a book
+FontUse = namedtuple('FontUse', 'book member size crc')
+
+
+def scan_library(library):
+    '''
+    Walk library and list fonts embedded in source EPUB files using only
+    the zip central directories. Return (dict (crc, size) -> list of
+    FontUse, number of books, list of (book, error) for unreadable books).
+    '''
+    groups = defaultdict(list)
+    books = 0
+    errors = []
+    for root, dirs, files in os.walk(library):
+        dirs.sort()
+        for f in sorted(files):
+            if not is_source_epub(f):
+                continue
+            path = os.path.join(root, f)
+            try:
+                with zipfile.ZipFile(path) as zf:
+                    infos = zf.infolist()
+            except (zipfile.BadZipfile, OSError) as e:
+                errors.append((path, str(e)))
+                continue
+            books += 1
+            for i in infos:
+                if i.filename.lower().endswith(FONT_EXTENSIONS):
+                    groups[(i.CRC, i.file_size)].append(
+                        FontUse(path, i.filename, i.file_size, i.CRC))
+    return groups, books, errors
+
+
+def read_member(use):
+    with zipfile.ZipFile(use.book) as zf:
+        return zf.read(use.member)
+
+
+def split_by_content(uses):
+    '''
+    Group font uses with equal CRC and size by SHA-1 of their contents.
+    Return list of (sha1, raw bytes of first use, list of FontUse).
+    '''
+    by_hash = {}
+    for use in uses:
+        try:
+            raw = read_member(use)
+        except (zipfile.BadZipfile, OSError, KeyError, RuntimeError):
+            continue
+        key = hashlib.sha1(raw).hexdigest()
+        if key not in by_hash:
+            by_hash[key] = (key, raw, [])
+        by_hash[key][2].append(use)
+    return list(by_hash.values())
+
+
+def font_family(raw):
+    try:
+        return fontcache.basic_properties(raw)[0]
+    except Exception:
+        return None
+
+
+def font_report(library, store=None):
+    '''
+    Print fonts embedded in more than one book with the books using them,
+    then all other fonts and totals. Only fonts with equal CRC and size
+    are read and hashed, unless store is given: then every font is hashed
+    and valid ones are copied to the content-addressed store.
+    '''
+    groups, books, errors = scan_library(library)
+    for path, error in errors:
+        print('* WARNING! Unable to read "%s": %s' % (path, error))
+    duplicates = []
+    singles = []
+    for key in sorted(groups):
+        uses = groups[key]
+        if len(uses) < 2 and store is None:
+            singles.append((None, None, uses))
+            continue
+        for sha1, raw, same in split_by_content(uses):
+            if store is not None:
+                add_to_store(store, sha1, raw, same)
+            if len(same) > 1:
+                duplicates.append((sha1, font_family(raw), same))
+            else:
+                singles.append((sha1, None, same))
+    duplicates.sort(key=lambda d: (-d[2][0].size * (len(d[2]) - 1), d[0]))
+    dup_bytes = 0
+    for sha1, family, uses in duplicates:
+        wasted = uses[0].size * (len(uses) - 1)
+        dup_bytes += wasted
+        print('* Font %s (family "%s", %d bytes) embedded in %d book(s), '
+              '%d bytes duplicated:' % (sha1[:12], family or 'NOT DEFINED',
+                                        uses[0].size, len(uses), wasted))
+        for use in uses:
+            print('    ' + os.path.relpath(use.book, library) + ': ' +
+                  use.member)
+    if singles:
+        print('* Fonts embedded in one book:')
+    for sha1, family, uses in sorted(singles, key=lambda s: s[2][0]):
+        use = uses[0]
+        print('    ' + os.path.relpath(use.book, library) + ': ' +
+              use.member + ' (%d bytes)' % use.size)
+    total = sum(len(u) for u in groups.values())
+    print('* Fonts: %d file(s) in %d book(s), %d distinct, %d duplicated, '
+          '%d bytes duplicated' % (total, books, len(duplicates) +
+                                   len(singles), len(duplicates), dup_bytes))
+    if store is not None:
+        save_store_index(store)
+        print('* Font store "%s": %d font(s), %d added in this run' % (
+            store, store_stats['fonts'], store_stats['added']))
+    return duplicates
+
+
+# --- content-addressed store ---
+#
+# <store>/<sha1[:2]>/<sha1><ext> holds font files, <store>/index.json maps
+# <sha1><ext> to the font's names, style, size, SHA-1 of the part after
+# the obfuscated header and number of books, so an embedded font can be
+# matched by its contents or by its names, never by its file name.
+
+store_stats = {'fonts': 0, 'added': 0}
+_pending = {}
+_index = {'path': None, 'mtime': None, 'fonts': {}}
+
+
+def store_path(store, sha1, ext):
+    return os.path.join(store, sha1[:2], sha1 + ext)
+
+
+def load_store_index(store):
+    try:
+        with open(os.path.join(store, 'index.json'), 'r') as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    if data.get('version') != STORE_VERSION:
+        return {}
+    return data.get('fonts', {})
+
+
+def tail_hash(raw):
+    return hashlib.sha1(raw[OBFUSCATED_LENGTH:]).hexdigest()
+
+
+def font_entry(raw):
+    ''' Index entry of valid font or None (e.g. obfuscated font) '''
+    try:
+        family, regular, bold, italic = fontcache.basic_properties(raw)
+    except Exception:
+        return None
+    return {'family': family, 'ps_name': fontcache.postscript_name(raw),
+            'bold': bold, 'italic': italic, 'size': len(raw),
+            'tail': tail_hash(raw), 'books': 0}
+
+
+def add_to_store(store, sha1, raw, uses):
+    ''' Copy font to store unless it is not a valid font (e.g. obfuscated) '''
+    entry = font_entry(raw)
+    if entry is None:
+        return
+    ext = os.path.splitext(uses[0].member)[1].lower()
+    path = store_path(store, sha1, ext)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with AtomicOutput(path) as out:
+            with open(out.path, 'wb') as f:
+                f.write(raw)
+        store_stats['added'] += 1
+    entry['books'] = len(set(use.book for use in uses))
+    _pending[sha1 + ext] = entry
+
+
+def save_store_index(store):
+    fonts = load_store_index(store)
+    fonts.update(_pending)
+    _pending.clear()
+    os.makedirs(store, exist_ok=True)
+    with AtomicOutput(os.path.join(store, 'index.json')) as out:
+        with open(out.path, 'w') as f:
+            json.dump({'version': STORE_VERSION, 'fonts': fonts}, f,
+                      indent=1, sort_keys=True)
+    store_stats['fonts'] = len(fonts)
+
+
+def find_font(raw, store=None):
+    '''
+    Return path of stored font for embedded font raw or None. A font which
+    cannot be parsed (e.g. obfuscated with unknown key) matches a stored
+    font of the same size and contents after the obfuscated header. A
+    valid font matches by PostScript name or else by family and style,
+    stored fonts smaller than it are skipped and the largest one is
+    preferred, so subsets are not used in place of complete fonts.
+    '''
+    store = store or store_dir
+    if store is None:
+        return None
+    index_path = os.path.join(store, 'index.json')
+    try:
+        mtime = os.stat(index_path).st_mtime_ns
+    except OSError:
+        return None
+    if _index['path'] != index_path or _index['mtime'] != mtime:
+        _index.update(path=index_path, mtime=mtime,
+                      fonts=load_store_index(store))
+    fonts = _index['fonts']
+    wanted = font_entry(raw)
+    if wanted is None:
+        tail = tail_hash(raw)
+        keys = [k for k, e in fonts.items()
+                if e['size'] == len(raw) and e['tail'] == tail]
+    else:
+        keys = []
+        if wanted['ps_name']:
+            keys = [k for k, e in fonts.items()
+                    if e['ps_name'] == wanted['ps_name']]
+        if not keys:
+            keys = [k for k, e in fonts.items()
+                    if e['family'] == wanted['family'] and
+                    e['bold'] == wanted['bold'] and
+                    e['italic'] == wanted['italic']]
+        # never a smaller (e.g. subset) copy of the font
+        keys = [k for k in keys if fonts[k]['size'] >= wanted['size']]
+    for key in sorted(keys, key=lambda k: (-fonts[k]['size'],
+                                           -fonts[k]['books'], k)):
+        path = store_path(store, key[:40], key[40:])
+        if os.path.isfile(path):
+            return path
+    return None
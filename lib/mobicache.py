@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import hashlib
+import os
+import re
+import subprocess
+from lib import checkcache
+
+KIND = 'kindlegen'
+
+stats = {'hits': 0, 'converted': 0}
+
+# report of a MOBI file found without record; kindlegen output is unknown
+ADOPTED_REPORT = {'lines': [], 'cover_html_found': True, 'error_found': False}
+
+
+def kindlegen_version(kgpath):
+    ''' Return kindlegen banner version string (e.g. "V2.9 build 1028") '''
+    try:
+        proc = subprocess.Popen([kgpath], stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        out = proc.communicate()[0]
+    except OSError:
+        return None
+    m = re.search(r'kindlegen.*?\b(V[\d.]+(?: build [-\w]+)?)',
+                  out.decode('utf-8', 'replace'), re.IGNORECASE)
+    if m is not None:
+        return m.group(1)
+    # unknown banner: use binary content, so every update invalidates cache
+    return 'sha1:' + checkcache.file_hash(kgpath)
+
+
+def parse_output(out):
+    '''
+    Return report of kindlegen output: lines worth printing and flags used
+    to detect problems with covers.
+    '''
+    report = {'lines': [], 'cover_html_found': False, 'error_found': False}
+    for ln in out.splitlines():
+        if 'Warning' in ln and 'W14029' not in ln:
+            report['lines'].append(ln)
+        if 'Error' in ln:
+            report['lines'].append(ln)
+            report['error_found'] = True
+        if 'I1052' in ln:
+            report['cover_html_found'] = True
+    return report
+
+
+def _key(mobi_path):
+    return hashlib.sha1(
+        os.path.abspath(mobi_path).encode('utf-8')
+    ).hexdigest()
+
+
+def lookup(epub_path, mobi_path, compression, version):
+    '''
+    Return stored report if mobi_path was generated by the same kindlegen
+    version from the same EPUB with the same compression and was not
+    changed since. Return None if the book has to be converted again.
+    A MOBI file without record (e.g. made before the cache existed) which
+    is newer than its EPUB is kept and recorded as it is.
+    '''
+    if version is None or not os.path.isfile(mobi_path):
+        return None
+    record = checkcache.load_result(KIND, _key(mobi_path))
+    if record is None:
+        # earlier versions skipped every existing MOBI file, so do not
+        # convert the whole library again after an upgrade
+        if os.path.getmtime(mobi_path) < os.path.getmtime(epub_path):
+            return None
+        report = dict(ADOPTED_REPORT)
+        store(epub_path, mobi_path, compression, version, report)
+        return report
+    if (record.get('compression') != compression or
+            record.get('version') != version or
+            record.get('input') != checkcache.file_hash(epub_path) or
+            record.get('output') != checkcache.file_hash(mobi_path)):
+        return None
+    return record.get('report')
+
+
+def store(epub_path, mobi_path, compression, version, report):
+    if version is None or not os.path.isfile(mobi_path):
+        return
+    checkcache.store_result(KIND, _key(mobi_path), {
+        'input': checkcache.file_hash(epub_path),
+        'compression': compression,
+        'version': version,
+        'output': checkcache.file_hash(mobi_path),
+        'report': report
+    })
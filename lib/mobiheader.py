@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import struct
+
+PALMDB_HEADER_LEN = 78
+NUMBER_OF_PDB_RECORDS = 76
+FIRST_PDB_RECORD = 78
+# record 0 is a few kB in real books; never trust a broken offset table
+MAX_RECORD0_LEN = 1 << 20
+
+
+class InvalidMobi(ValueError):
+    pass
+
+
+def parse_exth(record0):
+    '''
+    Build EXTH index (record ID -> list of values) from record 0. EXTH
+    block is located from MOBI header length and flags, so "EXTH" bytes
+    elsewhere (e.g. in the title) are never mistaken for it.
+    '''
+    index = {}
+    if len(record0) < 0x84 or record0[0x10:0x14] != b'MOBI':
+        return index
+    mobi_header_len, = struct.unpack_from('>L', record0, 0x14)
+    exth_flags, = struct.unpack_from('>L', record0, 0x80)
+    if not exth_flags & 0x40:
+        return index
+    pos = 0x10 + mobi_header_len
+    if record0[pos:pos + 4] != b'EXTH' or len(record0) < pos + 12:
+        return index
+    exth_len, count_items = struct.unpack_from('>LL', record0, pos + 4)
+    end = min(pos + exth_len, len(record0))
+    pos += 12
+    for _ in range(count_items):
+        if pos + 8 > end:
+            break
+        id, size = struct.unpack_from('>LL', record0, pos)
+        if size < 8 or pos + size > end:
+            break
+        index.setdefault(id, []).append(record0[pos + 8:pos + size])
+        pos += size
+    return index
+
+
+class MobiHeader(object):
+    '''
+    Header of MOBI/AZW/AZW3 file read with bounded reads: PalmDB header,
+    record list and record 0 (PalmDOC header, MOBI header and EXTH block)
+    only. Text and image records are never loaded, so memory use does not
+    depend on book size.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            palmdb = f.read(PALMDB_HEADER_LEN)
+            if len(palmdb) < PALMDB_HEADER_LEN:
+                raise InvalidMobi('file too short')
+            self.ident = palmdb[60:68]
+            if self.ident != b'BOOKMOBI':
+                raise InvalidMobi('not a BOOKMOBI file')
+            self.nsec, = struct.unpack_from('>H', palmdb,
+                                            NUMBER_OF_PDB_RECORDS)
+            if self.nsec == 0:
+                raise InvalidMobi('no PalmDB records')
+            # offset of record 0 and its end (start of record 1 or EOF)
+            n = min(self.nsec, 2)
+            f.seek(FIRST_PDB_RECORD)
+            table = f.read(n * 8)
+            if len(table) < n * 8:
+                raise InvalidMobi('truncated record list')
+            start, = struct.unpack_from('>L', table, 0)
+            if n > 1:
+                end, = struct.unpack_from('>L', table, 8)
+            else:
+                f.seek(0, 2)
+                end = f.tell()
+            if end < start:
+                raise InvalidMobi('invalid record 0 offsets')
+            f.seek(start)
+            self.record0 = f.read(min(end - start, MAX_RECORD0_LEN))
+            self.record0_offset = start
+        if len(self.record0) < 0x5c:
+            raise InvalidMobi('truncated record 0')
+        self._exth_index = None
+
+    @property
+    def mobi_type(self):
+        ''' Identifier at MOBI header start (b'MOBI') '''
+        return struct.unpack_from('4s', self.record0, 0x10)[0]
+
+    @property
+    def version(self):
+        return struct.unpack_from('>L', self.record0, 0x24)[0]
+
+    @property
+    def text_length(self):
+        return struct.unpack_from('>L', self.record0, 4)[0]
+
+    @property
+    def locations(self):
+        return self.text_length // 150 + 1
+
+    @property
+    def title(self):
+        toff, tlen = struct.unpack_from('>LL', self.record0, 0x54)
+        return self.record0[toff:toff + tlen]
+
+    @property
+    def exth_index(self):
+        ''' Dict of EXTH record ID -> list of record values '''
+        if self._exth_index is None:
+            self._exth_index = parse_exth(self.record0)
+        return self._exth_index
+
+    def exth(self, search_id):
+        ''' Return list of EXTH records with given ID '''
+        return self.exth_index.get(search_id, [])
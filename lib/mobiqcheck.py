@@ -8,11 +8,22 @@
 
 import os
 import sys
-import struct
 import codecs
 from datetime import datetime
 import unicodedata
 import csv
+import json
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+if __package__ in (None, ''):
+    # allow running as a script: python lib/mobiqcheck.py DIR
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+from lib.atomicio import AtomicOutput
+from lib.mobiheader import InvalidMobi
+from lib.mobiheader import MobiHeader
 
 
 class Logger(object):
@@ -27,50 +38,11 @@ class Logger(object):
         self.log.write(message)
 
 
-class PalmDB:
-    unique_id_seed = 68
-    number_of_pdb_records = 76
-    first_pdb_record = 78
-
-    def __init__(self, palmdata):
-        self.data = palmdata
-        self.nsec, = struct.unpack_from('>H', self.data,
-                                        PalmDB.number_of_pdb_records)
-
-    def getsecaddr(self, secno):
-        secstart, = struct.unpack_from('>L', self.data,
-                                       PalmDB.first_pdb_record + secno * 8)
-        if secno == self.nsec - 1:
-            secend = len(self.data)
-        else:
-            secend, = struct.unpack_from(
-                '>L', self.data,
-                PalmDB.first_pdb_record + (secno + 1) * 8
-            )
-        return secstart, secend
-
-    def readsection(self, secno):
-        if secno < self.nsec:
-            secstart, secend = self.getsecaddr(secno)
-            return self.data[secstart:secend]
-        return ''
-
-    def getnumsections(self):
-        return self.nsec
-
-
-def find_exth(search_id, content):
-    exth_begin = content.find('EXTH')
-    exth_header = content[exth_begin:]
-    count_items, = struct.unpack('>L', exth_header[8:12])
-    pos = 12
-    for _ in range(count_items):
-        id, size = struct.unpack('>LL', exth_header[pos:pos + 8])
-        exth_record = exth_header[pos + 8: pos + size]
-        if id == search_id:
-            return exth_record
-        pos += size
-    return '* NONE *'
+def find_exth(search_id, header):
+    records = header.exth(search_id)
+    if records:
+        return records[0]
+    return b'* NONE *'
 
 
 def strip_accents(text):
@@ -94,128 +66,198 @@ def rename_mobi(title, author):
     return nfname
 
 
-def mobi_header_fields(mobi_content):
-    pp = PalmDB(mobi_content)
-    header = pp.readsection(0)
-    id = struct.unpack_from('4s', header, 0x10)[0]
-    version = struct.unpack_from('>L', header, 0x24)[0]
-    # number of locations
-    text_length = struct.unpack('>I', header[4:8])[0]
-    locations = text_length / 150 + 1
-    # title
-    toff, tlen = struct.unpack('>II', header[0x54:0x5c])
-    tend = toff + tlen
-    title = header[toff:tend]
+def mobi_header_fields(header):
+    return header.mobi_type, header.version, header.title, header.locations
+
+
+def read_header(dirpath, file):
+    try:
+        return MobiHeader(os.path.join(dirpath, file))
+    except (IOError, OSError, InvalidMobi):
+        print(file + ': invalid file format. Skipping...')
+        return None
+
+
+def load_header(item):
+    ''' Worker: return (dirpath, file, MobiHeader or None) '''
+    dirpath, file = item
+    try:
+        return dirpath, file, MobiHeader(os.path.join(dirpath, file))
+    except (IOError, OSError, InvalidMobi):
+        return dirpath, file, None
 
-    return id, version, title, locations
+
+def iter_mobi_files(_documents, extensions=('.mobi', '.azw', '.azw3')):
+    for dirpath, dirs, files in os.walk(_documents):
+        for file in files:
+            if os.path.splitext(file)[1].lower() in extensions:
+                yield dirpath, file
+
+
+def bounded_map(func, items, workers):
+    '''
+    Like Executor.map, but submits at most a few tasks per worker ahead,
+    so huge libraries are streamed instead of queued at once.
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= workers * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class LocationsWriter(object):
+    '''
+    Locations report kept open for the whole run and written in batches,
+    as CSV or as a JSON list of objects.
+    '''
+    fields = ['pages', 'locations', 'author', 'title']
+
+    def __init__(self, path, fmt='csv', batch_size=500):
+        self.fmt = fmt
+        self.batch_size = batch_size
+        self.batch = []
+        self.count = 0
+        if fmt == 'json':
+            self.f = open(path, 'w', encoding='utf-8')
+            self.f.write('[')
+        else:
+            self.f = open(path, 'w', encoding='utf-8', newline='')
+            self.csvwrite = csv.writer(self.f, delimiter=';', quotechar='"',
+                                       quoting=csv.QUOTE_NONNUMERIC)
+            self.csvwrite.writerow(self.fields)
+
+    def write(self, row):
+        self.batch.append(row)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.fmt == 'json':
+            for row in self.batch:
+                self.f.write(',\n' if self.count else '\n')
+                json.dump(dict(zip(self.fields, row)), self.f,
+                          ensure_ascii=False)
+                self.count += 1
+        else:
+            self.csvwrite.writerows(self.batch)
+        self.batch = []
+        self.f.flush()
+
+    def close(self):
+        self.flush()
+        if self.fmt == 'json':
+            self.f.write('\n]\n')
+        self.f.close()
+
+
+def set_ebok(src, dst, header):
+    ''' Copy src to dst replacing PDOC with EBOK in record 0 only '''
+    with AtomicOutput(dst) as output:
+        shutil.copyfile(src, output.path)
+        with open(output.path, 'r+b') as f:
+            pos = header.record0.find(b'PDOC')
+            while pos != -1:
+                f.seek(header.record0_offset + pos)
+                f.write(b'EBOK')
+                pos = header.record0.find(b'PDOC', pos + 4)
 
 
 def mobi_check(_documents):
+    writer = None
     if args.locations:
-        with open(os.path.join('mobi-book-sizes.csv'), 'wb') as o:
-            csvwrite = csv.writer(o, delimiter=';', quotechar='"',
-                                  quoting=csv.QUOTE_NONNUMERIC)
-            csvwrite.writerow(['pages', 'locations', 'author', 'title'])
+        output = args.output or 'mobi-book-sizes.' + args.format
+        writer = LocationsWriter(output, args.format)
         print('pages', 'locations', 'author - title', sep='\t')
-    for dirpath, dirs, files in os.walk(_documents):
-        for file in files:
-            file_extension = os.path.splitext(file)[1].lower()
-            file_dec = file.decode(sys.getfilesystemencoding())
-            if file_extension not in ['.mobi', '.azw', '.azw3']:
+    try:
+        for dirpath, file, header in bounded_map(
+                load_header, iter_mobi_files(_documents),
+                args.jobs or os.cpu_count() or 1):
+            if header is None:
+                print(file + ': invalid file format. Skipping...')
                 continue
-            with open(os.path.join(dirpath, file), 'rb') as f:
-                mobi_content = f.read()
-            if mobi_content[60:68] != 'BOOKMOBI':
-                print(file_dec + ': invalid file format. Skipping...')
-                continue
-            id, ver, title, locations = mobi_header_fields(mobi_content)
-            author = find_exth(100, mobi_content)
-            if args.locations:
-                row = [
-                    locations / 15 + 1,
-                    locations,
-                    author,
-                    title
-                ]
-                with open(os.path.join('mobi-book-sizes.csv'), 'ab') as o:
-                    csvwrite = csv.writer(o, delimiter=';', quotechar='"',
-                                          quoting=csv.QUOTE_NONNUMERIC)
-                    csvwrite.writerow(row)
-                print(
-                    locations / 15 + 1,
-                    locations,
-                    str(author.decode(
-                        'utf8'
-                    )).encode(sys.stdout.encoding, 'replace'),
-                    str(title.decode(
-                        'utf8'
-                    )).encode(sys.stdout.encoding, 'replace'),
-                    sep='\t'
-                )
-            if ver == args.version:
-                print(
-                    id, ver, file_dec, title,
-                    author,
-                    find_exth(503, mobi_content),
-                    find_exth(101, mobi_content),
-                    sep='\t')
-            # experimental feature
-            if args.ebok:
-                mobi_content = mobi_content.replace('PDOC', 'EBOK')
-                with open(os.path.join(dirpath, 'mod_' + file), 'wb') as f:
-                    f.write(mobi_content)
-            # rename MOBI files
-            if args.rename:
-                nt = rename_mobi(title.decode('utf8'), author.decode('utf8'))
-                newfn = nt + file_extension
-                if (
-                    file == newfn or
-                    file.split(
-                        '('
-                    )[0][:-1] + file_extension == newfn
-                ):
-                    print('= Renaming file %s is not needed' % (file))
-                elif os.path.exists(os.path.join(dirpath,
-                                    newfn)):
-                    counter = 0
-                    while True:
-                        counter += 1
-                        if not os.path.exists(os.path.join(dirpath,
-                                              nt + ' (' +
-                                              str(counter) + ')' +
-                                              file_extension)):
-                            print('* Renaming file: %s to %s' % (
-                                file,
-                                nt + ' (' + str(counter) + ')' +
-                                file_extension
-                            ))
-                            os.rename(os.path.join(dirpath, file),
-                                      os.path.join(
-                                      dirpath,
-                                      nt + ' (' + str(counter) +
-                                      ')' + file_extension
-                                      ))
-                            break
-
-                else:
-                    print('* Renaming file: %s to %s' % (file, newfn))
+            process_header(dirpath, file, header, writer)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def process_header(dirpath, file, header, writer):
+    file_extension = os.path.splitext(file)[1].lower()
+    id, ver, title, locations = mobi_header_fields(header)
+    author = find_exth(100, header)
+    if writer is not None:
+        row = [
+            locations // 15 + 1,
+            locations,
+            author.decode('utf8', 'replace'),
+            title.decode('utf8', 'replace')
+        ]
+        writer.write(row)
+        print(*row, sep='\t')
+    if ver == args.version:
+        print(
+            id, ver, file, title,
+            author,
+            find_exth(503, header),
+            find_exth(101, header),
+            sep='\t')
+    # experimental feature
+    if args.ebok:
+        set_ebok(os.path.join(dirpath, file),
+                 os.path.join(dirpath, 'mod_' + file), header)
+    # rename MOBI files
+    if args.rename:
+        nt = rename_mobi(title.decode('utf8'), author.decode('utf8'))
+        newfn = nt + file_extension
+        if (
+            file == newfn or
+            file.split(
+                '('
+            )[0][:-1] + file_extension == newfn
+        ):
+            print('= Renaming file %s is not needed' % (file))
+        elif os.path.exists(os.path.join(dirpath,
+                            newfn)):
+            counter = 0
+            while True:
+                counter += 1
+                if not os.path.exists(os.path.join(dirpath,
+                                      nt + ' (' +
+                                      str(counter) + ')' +
+                                      file_extension)):
+                    print('* Renaming file: %s to %s' % (
+                        file,
+                        nt + ' (' + str(counter) + ')' +
+                        file_extension
+                    ))
                     os.rename(os.path.join(dirpath, file),
-                              os.path.join(dirpath, newfn))
+                              os.path.join(
+                              dirpath,
+                              nt + ' (' + str(counter) +
+                              ')' + file_extension
+                              ))
+                    break
+
+        else:
+            print('* Renaming file: %s to %s' % (file, newfn))
+            os.rename(os.path.join(dirpath, file),
+                      os.path.join(dirpath, newfn))
 
 
 def fix_extension(dir):
     for dirpath, dirs, files in os.walk(dir):
         for file in files:
             file_extension = os.path.splitext(file)[1].lower()
-            file_dec = file.decode(sys.getfilesystemencoding())
             if file_extension not in ['.azw', '.azw3']:
                 continue
-            with open(os.path.join(dirpath, file), 'rb') as f:
-                mobi_content = f.read()
-            if mobi_content[60:68] != 'BOOKMOBI':
-                print(file_dec + ': invalid file format. Skipping...')
+            header = read_header(dirpath, file)
+            if header is None:
                 continue
-            id, ver = mobi_header_fields(mobi_content)
+            ver = header.version
             if ver == 8:
                 new_ext = '.azw3'
             elif ver == 6:
@@ -230,11 +272,11 @@ def fix_extension(dir):
                           os.path.join(dirpath,
                                        os.path.splitext(file)[0] + new_ext))
                 print('* File extension for "%s" was changed to "%s"'
-                      % (file_dec, new_ext))
+                      % (file, new_ext))
             else:
                 print('* File extension was not changed for file "%s". '
                       'File with updated filename already exists...'
-                      % file_dec)
+                      % file)
 
 
 if __name__ == "__main__":
@@ -258,6 +300,16 @@ if __name__ == "__main__":
                         help="print list of books with number of pages "
                              "and locations",
                         action="store_true")
+    parser.add_argument("--format", choices=['csv', 'json'], default='csv',
+                        help="format of locations report (only with -l)")
+    parser.add_argument("-o", "--output", nargs='?', metavar="FILE",
+                        default=None,
+                        help="path to locations report (default: "
+                        "mobi-book-sizes.csv or .json) (only with -l)")
+    parser.add_argument("-j", "--jobs", nargs='?', type=int,
+                        metavar="NUMBER", default=None,
+                        help="number of files read at the same time "
+                        "(default: number of CPUs)")
     parser.add_argument("-b", "--ebok",
                         help="replace PDOC to EBOK (experimental)",
                         action="store_true")
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import os
+import signal
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# args may be a callable returning the argument list; it is called when the
+# job starts, so resources it creates (e.g. temp directories) exist only for
+# jobs which actually run
+Job = namedtuple('Job', 'args data universal_newlines')
+Job.__new__.__defaults__ = (None, False)
+
+JobResult = namedtuple('JobResult',
+                       'returncode stdout stderr timed_out error')
+
+
+def default_jobs():
+    return os.cpu_count() or 1
+
+
+def _kill(proc):
+    # kill the whole process group, so children of wrapper scripts do not
+    # keep the output pipes open
+    if os.name == 'posix':
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+            return
+        except OSError:
+            pass
+    proc.kill()
+
+
+def run_job(job, timeout=None):
+    ''' Run a single job and capture its output '''
+    try:
+        args = job.args() if callable(job.args) else job.args
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                universal_newlines=job.universal_newlines,
+                                start_new_session=(os.name == 'posix'))
+    except OSError as e:
+        return JobResult(None, None, None, False, e)
+    try:
+        out, err = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _kill(proc)
+        out, err = proc.communicate()
+        return JobResult(proc.returncode, out, err, True, None)
+    return JobResult(proc.returncode, out, err, False, None)
+
+
+def run_jobs(jobs, max_workers=None, timeout=None):
+    '''
+    Run jobs with at most max_workers processes at the same time and yield
+    (job, JobResult) pairs in input order. Every job is killed after
+    timeout seconds (no limit if None). Closing the generator cancels the
+    jobs which have not started yet.
+    '''
+    jobs = list(jobs)
+    if not jobs:
+        return
+    max_workers = max_workers or default_jobs()
+    pool = ThreadPoolExecutor(max_workers=min(max_workers, len(jobs)))
+    futures = [pool.submit(run_job, j, timeout) for j in jobs]
+    try:
+        for job, future in zip(jobs, futures):
+            yield job, future.result()
+    finally:
+        # when the caller stops early (e.g. giving up after an error) jobs
+        # not started yet are dropped, only the running ones are awaited
+        pool.shutdown(cancel_futures=True)
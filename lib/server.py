@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import queue
+import re
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+from lib import epubqcheck
+from lib.epubqfix import qfix
+
+STAGES = ('qcheck', 'qfix')
+# finished jobs kept for download; older ones are removed with their files
+MAX_FINISHED_JOBS = 100
+MAX_UPLOAD_SIZE = 512 * 1024 * 1024
+
+
+def _run_stage(func, *a):
+    ''' Run stage capturing stdout and qcheck log output '''
+    out = io.StringIO()
+    stream = epubqcheck.streamhandler.stream
+    epubqcheck.streamhandler.setStream(out)
+    start = time.perf_counter()
+    error = None
+    try:
+        with contextlib.redirect_stdout(out):
+            func(*a)
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            error = str(e.code)
+    except Exception as e:
+        error = repr(e)
+    finally:
+        epubqcheck.streamhandler.setStream(stream)
+    return {'output': out.getvalue(), 'error': error,
+            'seconds': time.perf_counter() - start}
+
+
+def process_job(job_dir, filename, stages, options):
+    '''
+    Worker: run selected stages for uploaded file and return dict with
+    per-stage output, errors and latency.
+    '''
+    report = {}
+    for stage in stages:
+        if stage == 'qcheck':
+            report[stage] = _run_stage(
+                epubqcheck.qcheck, job_dir, filename, options.alter, False,
+                options.list_fonts, False
+            )
+        elif stage == 'qfix':
+            report[stage] = _run_stage(
+                qfix, job_dir, filename, True, options.replace_font_files,
+                options.skip_reset_css, options.tools, options.skip_hyphenate,
+                options.skip_justify, options.left, options.myk_fix,
+                options.remove_colors, options.remove_fonts,
+                options.font_dir, options.fix_missing_container,
+                options.book_margin, options.skip_hyphenate_headers,
+                options.replace_font_family, options.subset_fonts
+            )
+    return report
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {'accepted': 0, 'rejected': 0, 'done': 0,
+                         'failed': 0}
+        self.latency = dict((s, [0, 0.0, 0.0]) for s in
+                            STAGES + ('queue', 'total'))
+        self.running = 0
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            m = self.latency[stage]
+            m[0] += 1
+            m[1] += seconds
+            m[2] = max(m[2], seconds)
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def render(self, queue_depth, queue_size):
+        ''' Metrics in Prometheus text format '''
+        lines = [
+            '# TYPE epubqtools_queue_depth gauge',
+            'epubqtools_queue_depth %d' % queue_depth,
+            '# TYPE epubqtools_queue_capacity gauge',
+            'epubqtools_queue_capacity %d' % queue_size,
+            '# TYPE epubqtools_jobs_running gauge',
+            'epubqtools_jobs_running %d' % self.running,
+            '# TYPE epubqtools_jobs_total counter',
+        ]
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append('epubqtools_jobs_total{state="%s"} %d' % (
+                    name, value))
+            lines.append('# TYPE epubqtools_stage_seconds summary')
+            for stage, (count, total, maximum) in sorted(
+                    self.latency.items()):
+                lines.append('epubqtools_stage_seconds_count{stage="%s"} %d'
+                             % (stage, count))
+                lines.append('epubqtools_stage_seconds_sum{stage="%s"} %.6f'
+                             % (stage, total))
+                lines.append('epubqtools_stage_seconds_max{stage="%s"} %.6f'
+                             % (stage, maximum))
+        return '\n'.join(lines) + '\n'
+
+
+class JobService(object):
+    '''
+    Bounded queue of uploaded books processed by a pool of warm worker
+    processes. When the queue is full new jobs are rejected, so callers
+    can retry later instead of piling up work.
+    '''
+
+    def __init__(self, spool_dir, options, workers=None, queue_size=16):
+        self.spool_dir = os.path.abspath(spool_dir)
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.options = options
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.metrics = Metrics()
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, initializer=signal.signal,
+            initargs=(signal.SIGINT, signal.SIG_IGN)
+        )
+        # with the fork start method all workers are started on the first
+        # submit: do it now, before the HTTP threads exist
+        self.pool.submit(os.getpid).result()
+        self.dispatchers = []
+        for _ in range(self.workers):
+            t = threading.Thread(target=self._dispatch, daemon=True)
+            t.start()
+            self.dispatchers.append(t)
+
+    def submit(self, filename, data, stages):
+        ''' Queue job and return its dict or None if the queue is full '''
+        job_id = uuid.uuid4().hex
+        job_dir = tempfile.mkdtemp(prefix='job-', dir=self.spool_dir)
+        with open(os.path.join(job_dir, filename), 'wb') as f:
+            f.write(data)
+        job = {'id': job_id, 'status': 'queued', 'filename': filename,
+               'stages': stages, 'report': None, 'result': None,
+               'queued': time.time(), 'dir': job_dir,
+               'done': threading.Event()}
+        with self.lock:
+            self.jobs[job_id] = job
+        try:
+            self.queue.put_nowait(job_id)
+        except queue.Full:
+            self.metrics.incr('rejected')
+            self.remove(job_id)
+            return None
+        self.metrics.incr('accepted')
+        return job
+
+    def _dispatch(self):
+        while True:
+            job_id = self.queue.get()
+            with self.lock:
+                job = self.jobs.get(job_id)
+                if job is not None:
+                    job['status'] = 'running'
+            if job is None:
+                continue
+            started = time.time()
+            self.metrics.observe('queue', started - job['queued'])
+            with self.metrics.lock:
+                self.metrics.running += 1
+            try:
+                report = self.pool.submit(
+                    process_job, job['dir'], job['filename'], job['stages'],
+                    self.options
+                ).result()
+            except Exception as e:
+                report = {'worker': {'output': '', 'error': repr(e),
+                                     'seconds': 0.0}}
+            finally:
+                with self.metrics.lock:
+                    self.metrics.running -= 1
+            for stage, r in report.items():
+                if stage in self.metrics.latency:
+                    self.metrics.observe(stage, r['seconds'])
+            self.metrics.observe('total', time.time() - job['queued'])
+            result = os.path.splitext(job['filename'])[0] + '_moh.epub'
+            if os.path.isfile(os.path.join(job['dir'], result)):
+                job['result'] = result
+            failed = any(r['error'] for r in report.values())
+            job['report'] = report
+            job['status'] = 'failed' if failed else 'done'
+            self.metrics.incr('failed' if failed else 'done')
+            job['done'].set()
+            self._expire()
+
+    def _expire(self):
+        with self.lock:
+            finished = [i for i, j in self.jobs.items()
+                        if j['done'].is_set()]
+        for job_id in finished[:-MAX_FINISHED_JOBS]:
+            self.remove(job_id)
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def remove(self, job_id):
+        with self.lock:
+            job = self.jobs.pop(job_id, None)
+        if job is not None:
+            shutil.rmtree(job['dir'], ignore_errors=True)
+        return job
+
+    def delete(self, job_id):
+        '''
+        Remove queued or finished job with its files. A running job is
+        kept, return False for it.
+        '''
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return True
+            if job['status'] == 'running':
+                return False
+            del self.jobs[job_id]
+        if not job['done'].is_set():
+            # the dispatcher skips it, release clients waiting for it
+            job['status'] = 'removed'
+            job['done'].set()
+        shutil.rmtree(job['dir'], ignore_errors=True)
+        return True
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        with self.lock:
+            job_ids = list(self.jobs)
+        for job_id in job_ids:
+            self.remove(job_id)
+
+
+def job_json(job):
+    return {
+        'id': job['id'],
+        'status': job['status'],
+        'filename': job['filename'],
+        'stages': job['stages'],
+        'report': job['report'],
+        'result': ('/jobs/%s/result' % job['id']) if job['result'] else None
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''
+    POST /jobs?stages=qcheck,qfix&wait=1  upload EPUB (request body)
+    GET /jobs/ID                          JSON report
+    GET /jobs/ID/result                   fixed _moh.epub
+    DELETE /jobs/ID                       remove job files
+    GET /metrics                          queue depth and stage latency
+    '''
+    service = None
+    server_version = 'epubQTools'
+
+    def log_message(self, format, *a):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *a)
+
+    def _send(self, code, body, content_type='application/json',
+              headers=None):
+        if isinstance(body, dict):
+            body = json.dumps(body, indent=1)
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _job(self, path):
+        m = re.match(r'^/jobs/([0-9a-f]{32})(/result)?$', path)
+        if m is None:
+            return None, False
+        return self.service.get(m.group(1)), bool(m.group(2))
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/metrics':
+            return self._send(200, self.service.metrics.render(
+                self.service.queue.qsize(), self.service.queue_size
+            ), 'text/plain; version=0.0.4')
+        job, result = self._job(url.path)
+        if job is None:
+            return self._send(404, {'error': 'not found'})
+        if not result:
+            return self._send(200, job_json(job))
+        if job['result'] is None:
+            return self._send(404, {'error': 'no result for job'})
+        with open(os.path.join(job['dir'], job['result']), 'rb') as f:
+            data = f.read()
+        self._send(200, data, 'application/epub+zip', {
+            'Content-Disposition': 'attachment; filename="%s"' %
+            job['result'].replace('"', '')
+        })
+
+    def do_DELETE(self):
+        job, result = self._job(urlsplit(self.path).path)
+        if job is None or result:
+            return self._send(404, {'error': 'not found'})
+        if not self.service.delete(job['id']):
+            return self._send(409, {'error': 'job is running'})
+        self._send(200, {'id': job['id'], 'status': 'removed'})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/jobs':
+            return self._send(404, {'error': 'not found'})
+        query = parse_qs(url.query)
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            return self._send(411, {'error': 'Content-Length required'})
+        if length > MAX_UPLOAD_SIZE:
+            return self._send(413, {'error': 'file too large'})
+        data = self.rfile.read(length)
+        if not data.startswith(b'PK'):
+            return self._send(400, {'error': 'not an EPUB (ZIP) file'})
+        filename = os.path.basename(query.get('filename', ['book.epub'])[0])
+        base = os.path.splitext(filename)[0]
+        if base.lower().endswith('_moh'):
+            # qfix skips generated files, fix the book under its source name
+            base = base[:-len('_moh')]
+        filename = (base or 'book') + '.epub'
+        if 'stages' in query:
+            stages = [s for s in query['stages'][0].split(',') if s]
+        else:
+            stages = list(self.server.default_stages)
+        if not stages or any(s not in STAGES for s in stages):
+            return self._send(400, {'error': 'stages must be any of: ' +
+                                    ','.join(STAGES)})
+        job = self.service.submit(filename, data, stages)
+        if job is None:
+            return self._send(503, {'error': 'queue is full'},
+                              headers={'Retry-After': '5'})
+        if query.get('wait', ['0'])[0] not in ('0', ''):
+            job['done'].wait()
+            return self._send(200, job_json(job))
+        self._send(202, job_json(job), headers={
+            'Location': '/jobs/' + job['id']
+        })
+
+
+def make_server(spool_dir, options, port=8765, host='127.0.0.1',
+                workers=None, queue_size=16, stages=STAGES, quiet=False):
+    ''' Return (HTTP server, JobService) ready for serve_forever() '''
+    service = JobService(spool_dir, options, workers, queue_size)
+    handler = type('BoundHandler', (Handler,), {'service': service})
+    try:
+        httpd = ThreadingHTTPServer((host, port), handler)
+    except OSError:
+        service.shutdown()
+        raise
+    httpd.daemon_threads = True
+    httpd.default_stages = stages
+    httpd.quiet = quiet
+    return httpd, service
+
+
+def serve(spool_dir, options, port=8765, host='127.0.0.1', workers=None,
+          queue_size=16, stages=STAGES, quiet=False):
+    httpd, service = make_server(spool_dir, options, port, host, workers,
+                                 queue_size, stages, quiet)
+    print('* Serving on http://%s:%d/ (%d worker(s), queue size %d). '
+          'Press Ctrl+C to stop.' % (host, httpd.server_address[1],
+                                     service.workers, queue_size))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print('')
+        print('* Server stopped.')
+    finally:
+        httpd.server_close()
+        service.shutdown()
+    return 0
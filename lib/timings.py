@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import functools
+import json
+import time
+from collections import defaultdict
+
+from lib.atomicio import AtomicOutput
+
+REPORT_VERSION = 1
+# number of slowest stages and XHTML files listed in the summary of a book
+# (the JSON report has all of them)
+SLOWEST_SPANS = 10
+SLOWEST_FILES = 5
+
+# set from --timings; when False every hook returns at once
+enabled = False
+
+books = []
+_book = None
+
+
+class _Span(object):
+    def __init__(self, name, detail):
+        self.name = name
+        self.detail = detail
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        add_time(self.name, time.perf_counter() - self.start, self.detail)
+        return False
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+def span(name, detail=None):
+    '''
+    Context manager timing a block under name. Times with detail (e.g.
+    XHTML file name) are listed separately too.
+    '''
+    if not enabled:
+        return _null_span
+    return _Span(name, detail)
+
+
+def timed(func):
+    ''' Decorator timing every call of func under its name '''
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            add_time(name, time.perf_counter() - start)
+    return wrapper
+
+
+def add_time(name, seconds, detail=None):
+    if _book is None:
+        return
+    s = _book['spans'][name]
+    s['seconds'] += seconds
+    s['calls'] += 1
+    if detail is not None:
+        _book['details'][detail] += seconds
+
+
+def count(name, n=1):
+    if enabled and _book is not None:
+        _book['counters'][name] += n
+
+
+def start_book(name):
+    global _book
+    if not enabled:
+        return
+    _book = {
+        'book': name,
+        'start': time.perf_counter(),
+        'spans': defaultdict(lambda: {'seconds': 0.0, 'calls': 0}),
+        'counters': defaultdict(int),
+        'details': defaultdict(float),
+    }
+
+
+def finish_book():
+    ''' Store timings of current book and print its summary '''
+    global _book
+    if not enabled or _book is None:
+        return
+    book = {
+        'book': _book['book'],
+        'seconds': time.perf_counter() - _book['start'],
+        'spans': dict(_book['spans']),
+        'counters': dict(_book['counters']),
+        'files': dict(_book['details']),
+    }
+    _book = None
+    books.append(book)
+    print_summary(book)
+
+
+def print_summary(book):
+    print('* Timings for: %s (total %.3f s)' % (book['book'],
+                                                book['seconds']))
+    spans = sorted(book['spans'].items(), key=lambda i: -i[1]['seconds'])
+    for name, s in spans[:SLOWEST_SPANS]:
+        print('    %-34s %8.3f s %6d call(s)' % (name, s['seconds'],
+                                                 s['calls']))
+    if book['counters']:
+        print('    ' + ', '.join('%s: %d' % i for i in
+                                 sorted(book['counters'].items())))
+    slowest = sorted(book['files'].items(), key=lambda i: -i[1])
+    if slowest:
+        print('    slowest XHTML files: ' + ', '.join(
+            '%s %.3f s' % i for i in slowest[:SLOWEST_FILES]))
+
+
+def aggregate():
+    ''' Totals of spans and counters over all books of the run '''
+    spans = defaultdict(lambda: {'seconds': 0.0, 'calls': 0})
+    counters = defaultdict(int)
+    for book in books:
+        for name, s in book['spans'].items():
+            spans[name]['seconds'] += s['seconds']
+            spans[name]['calls'] += s['calls']
+        for name, n in book['counters'].items():
+            counters[name] += n
+    return {'books': len(books),
+            'seconds': sum(b['seconds'] for b in books),
+            'spans': dict(spans), 'counters': dict(counters)}
+
+
+def write_report(path):
+    with AtomicOutput(path) as out:
+        with open(out.path, 'w') as f:
+            json.dump({'version': REPORT_VERSION, 'totals': aggregate(),
+                       'books': books}, f, indent=1, sort_keys=True)
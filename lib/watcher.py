@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+# inotify(7) flags
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+_event = struct.Struct('iIII')
+
+
+def is_source_epub(f):
+    ''' EPUB files delivered by users, not the ones generated by us '''
+    f = f.lower()
+    return (f.endswith('.epub') and not f.endswith('_moh.epub') and
+            not f.endswith('_org.epub'))
+
+
+class _Inotify(object):
+    ''' Minimal inotify binding: which directories had events '''
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {}
+
+    def add_watch(self, path):
+        wd = self._add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed: ' +
+                          path)
+        self.dirs[wd] = path
+
+    def read(self, timeout):
+        '''
+        Wait up to timeout seconds and return (set of changed directories,
+        overflow flag). New subdirectories are watched automatically.
+        '''
+        changed = set()
+        overflow = False
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed, overflow
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return changed, overflow
+        pos = 0
+        while pos + _event.size <= len(data):
+            wd, mask, cookie, length = _event.unpack_from(data, pos)
+            name = data[pos + _event.size:pos + _event.size + length]
+            pos += _event.size + length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            path = self.dirs.get(wd)
+            if path is None:
+                continue
+            changed.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                subdir = os.path.join(path, os.fsdecode(name.rstrip(b'\0')))
+                for root, dirs, files in os.walk(subdir):
+                    try:
+                        self.add_watch(root)
+                    except OSError:
+                        pass
+                    changed.add(root)
+        return changed, overflow
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirectoryWatcher(object):
+    '''
+    Report new or changed source EPUB files in directory tree. inotify is
+    used on Linux and a periodic stat-only rescan everywhere else. A file
+    is reported only after its size and mtime did not change for debounce
+    seconds, so files still being copied are never processed.
+    '''
+
+    def __init__(self, directory, debounce=2.0, interval=5.0,
+                 skip_dirs=(), use_inotify=True):
+        self.directory = os.path.abspath(directory)
+        self.debounce = debounce
+        self.interval = interval
+        self.skip_dirs = set(skip_dirs)
+        self.pending = {}
+        self.inotify = None
+        if use_inotify and hasattr(os, 'O_CLOEXEC'):
+            try:
+                self.inotify = _Inotify()
+            except (OSError, AttributeError):
+                self.inotify = None
+        self.known = {}
+        for path, stat in self._scan_tree():
+            self.known[path] = stat
+
+    @property
+    def mode(self):
+        return 'inotify' if self.inotify is not None else 'polling'
+
+    def _stat_dir(self, root, files):
+        for f in files:
+            if not is_source_epub(f):
+                continue
+            path = os.path.join(root, f)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            yield path, (st.st_size, st.st_mtime_ns)
+
+    def _scan_tree(self):
+        for root, dirs, files in os.walk(self.directory):
+            dirs[:] = [d for d in dirs if d not in self.skip_dirs]
+            if self.inotify is not None:
+                try:
+                    self.inotify.add_watch(root)
+                except OSError:
+                    pass
+            for item in self._stat_dir(root, files):
+                yield item
+
+    def _scan_dir(self, root):
+        try:
+            files = [f for f in os.listdir(root)
+                     if os.path.isfile(os.path.join(root, f))]
+        except OSError:
+            return
+        for item in self._stat_dir(root, files):
+            yield item
+
+    def _update(self, items, now):
+        for path, stat in items:
+            if self.known.get(path) == stat:
+                continue
+            previous = self.pending.get(path)
+            if previous is None or previous[0] != stat:
+                self.pending[path] = (stat, now)
+
+    def poll(self, timeout=None):
+        '''
+        Wait for changes and return list of paths ready for processing.
+        '''
+        if timeout is None:
+            timeout = self.debounce if self.pending else self.interval
+        now = time.time()
+        if self.inotify is not None:
+            changed, overflow = self.inotify.read(timeout)
+            now = time.time()
+            if overflow:
+                self._update(self._scan_tree(), now)
+            else:
+                for root in changed:
+                    if not (set(os.path.relpath(root, self.directory).split(
+                            os.sep)) & self.skip_dirs):
+                        self._update(self._scan_dir(root), now)
+            # files that stopped changing produce no more events
+            for path in list(self.pending):
+                self._update(self._stat_dir(os.path.dirname(path),
+                                            [os.path.basename(path)]), now)
+        else:
+            time.sleep(timeout)
+            now = time.time()
+            self._update(self._scan_tree(), now)
+        ready = []
+        for path, (stat, changed) in list(self.pending.items()):
+            if now - changed >= self.debounce:
+                del self.pending[path]
+                if not os.path.isfile(path):
+                    continue
+                self.known[path] = stat
+                ready.append(path)
+        return sorted(ready)
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from itertools import cycle
+from unittest import mock
+
+from lxml import etree
+
+from benchmarks.corpus import make_font
+from lib.epubqfix import ADOBE_OBFUSCATION
+from lib.epubqfix import IDPF_OBFUSCATION
+from lib.epubqfix import OBFUSCATED_LENGTH
+from lib.epubqfix import decrypt_font
+from lib.epubqfix import deobfuscate_font
+from lib.epubqfix import find_encryption_key
+
+OPF = b'''<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0"
+         unique-identifier="BookId">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="isbn">978-83-0000-000-0</dc:identifier>
+    <dc:identifier id="BookId">
+      urn:uuid:0b5e4c2e-63b4-4c5c-9f4f-2d1b9e0c7a11
+    </dc:identifier>
+  </metadata>
+</package>'''
+METHODS = (ADOBE_OBFUSCATION, IDPF_OBFUSCATION)
+
+
+def legacy_deobfuscate(raw, key, method):
+    ''' Per-byte XOR used by decrypt_font before deobfuscate_font '''
+    crypt = bytearray(raw[:OBFUSCATED_LENGTH[method]])
+    key = cycle(iter(bytearray(key)))
+    return bytes(bytearray(x ^ next(key) for x in crypt)) + \
+        raw[OBFUSCATED_LENGTH[method]:]
+
+
+class DeobfuscateFontTest(unittest.TestCase):
+
+    def setUp(self):
+        opftree = etree.fromstring(OPF)
+        self.keys = dict((m, find_encryption_key(opftree, m))
+                         for m in METHODS)
+        self.font = make_font('Foo', 'Regular', False, False)
+
+    def test_keys(self):
+        self.assertEqual(len(self.keys[ADOBE_OBFUSCATION]), 16)
+        self.assertEqual(len(self.keys[IDPF_OBFUSCATION]), 20)
+
+    def test_round_trip(self):
+        for method in METHODS:
+            key = self.keys[method]
+            obfuscated = deobfuscate_font(self.font, key, method)
+            n = OBFUSCATED_LENGTH[method]
+            self.assertNotEqual(obfuscated[:n], self.font[:n])
+            self.assertEqual(obfuscated[n:], self.font[n:])
+            self.assertEqual(deobfuscate_font(obfuscated, key, method),
+                             self.font)
+
+    def test_same_as_per_byte_xor(self):
+        for method in METHODS:
+            key = self.keys[method]
+            self.assertEqual(deobfuscate_font(self.font, key, method),
+                             legacy_deobfuscate(self.font, key, method))
+
+    def test_short_fonts(self):
+        for method in METHODS:
+            key = self.keys[method]
+            for size in (0, 1, 4, 1023, 1024, 1039, 1040, 1041):
+                raw = bytes(i % 251 for i in range(size))
+                obfuscated = deobfuscate_font(raw, key, method)
+                self.assertEqual(len(obfuscated), size)
+                self.assertEqual(obfuscated,
+                                 legacy_deobfuscate(raw, key, method))
+                self.assertEqual(deobfuscate_font(obfuscated, key, method),
+                                 raw)
+
+
+class DecryptFontTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.keys = dict((m, find_encryption_key(etree.fromstring(OPF), m))
+                         for m in METHODS)
+        self.font = make_font('Foo', 'Regular', False, False)
+        self.path = os.path.join(self.tmp, 'font.ttf')
+
+    def decrypt(self, raw, key, method):
+        with open(self.path, 'wb') as f:
+            f.write(raw)
+        with contextlib.redirect_stdout(io.StringIO()), \
+                mock.patch('lib.epubqfix.find_substitute_font',
+                           return_value=None):
+            decrypt_font(self.path, key, method, None)
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_decrypts_obfuscated_font(self):
+        for method in METHODS:
+            key = self.keys[method]
+            self.assertEqual(self.decrypt(
+                deobfuscate_font(self.font, key, method), key, method),
+                self.font)
+
+    def test_wrong_key_keeps_file(self):
+        for method in METHODS:
+            other = self.keys[ADOBE_OBFUSCATION if method == IDPF_OBFUSCATION
+                              else IDPF_OBFUSCATION]
+            obfuscated = deobfuscate_font(self.font, self.keys[method],
+                                          method)
+            self.assertEqual(self.decrypt(obfuscated, other, method),
+                             obfuscated)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+import zipfile
+
+from lib.epubcheckrunner import EpubCheckRunner
+from lib.epubcheckrunner import extract_epubcheck
+
+# stand-in for java: reports the version, logs every run, creates the
+# class data archive when asked to and checks "books" by their names
+FAKE_JAVA = r'''#!/bin/sh
+if [ "$1" = "-version" ]; then
+    echo 'openjdk version "%(version)s" 2024-01-16' >&2
+    exit 0
+fi
+echo "$*" >> "%(log)s"
+for a in "$@"; do
+    case "$a" in
+        -XX:ArchiveClassesAtExit=*) touch "${a#*=}" ;;
+        -XX:SharedArchiveFile=*)
+            echo 'OpenJDK 64-Bit Server VM warning: Sharing is only' \
+                 'supported for boot loader classes' >&2 ;;
+    esac
+    book="$a"
+done
+case "${book##*/}" in
+    *slow*) sleep 2 ;;
+    *bad*) echo "ERROR(RSC-005): $book: Error while parsing file" >&2 ;;
+esac
+echo "Messages: 0 fatals / 0 errors / 0 warnings"
+'''
+
+
+@unittest.skipIf(sys.platform == 'win32', 'needs a POSIX shell')
+class EpubCheckRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.log = os.path.join(self.tmp, 'java.log')
+        zip_path = os.path.join(self.tmp, 'epubcheck-5.1.0.zip')
+        with zipfile.ZipFile(zip_path, 'w') as z:
+            z.writestr('epubcheck-5.1.0/epubcheck.jar', b'fake jar')
+            z.writestr('epubcheck-5.1.0/lib/jing.jar', b'fake lib')
+        self.cache = os.path.join(self.tmp, 'cache')
+        self.jar = extract_epubcheck(zip_path, self.cache)
+
+    def fake_java(self, version):
+        path = os.path.join(self.tmp, 'java-%s' % version)
+        with open(path, 'w') as f:
+            f.write(FAKE_JAVA % {'version': version, 'log': self.log})
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+        return path
+
+    def runs(self):
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+    def test_extracts_once(self):
+        zip_path = os.path.join(self.tmp, 'epubcheck-5.1.0.zip')
+        self.assertTrue(self.jar.startswith(self.cache))
+        with open(self.jar, 'wb') as f:
+            f.write(b'kept')
+        # same zip: the extracted directory is reused as it is
+        self.assertEqual(extract_epubcheck(zip_path, self.cache), self.jar)
+        with open(self.jar, 'rb') as f:
+            self.assertEqual(f.read(), b'kept')
+
+    def test_results_per_file_in_order(self):
+        runner = EpubCheckRunner(self.jar, java=self.fake_java('17.0.2'),
+                                 jobs=3)
+        books = [os.path.join(self.tmp, name) for name in
+                 ('slow.epub', 'good.epub', 'bad.epub', 'other.epub')]
+        results = list(runner.run_all(books))
+        self.assertEqual([path for path, result in results], books)
+        errors = dict((os.path.basename(path), result.stderr)
+                      for path, result in results)
+        # JVM warnings are not reported as EpubCheck problems
+        self.assertEqual(errors['good.epub'], '')
+        self.assertEqual(errors['other.epub'], '')
+        self.assertEqual(errors['slow.epub'], '')
+        self.assertIn('RSC-005', errors['bad.epub'])
+        self.assertNotIn('VM warning', errors['bad.epub'])
+
+    def test_archive_created_by_first_jvm_only(self):
+        runner = EpubCheckRunner(self.jar, java=self.fake_java('17.0.2'),
+                                 jobs=3)
+        books = [os.path.join(self.tmp, 'book%d.epub' % i) for i in range(5)]
+        list(runner.run_all(books))
+        runs = self.runs()
+        dumps = [r for r in runs if 'ArchiveClassesAtExit' in r]
+        self.assertEqual(len(dumps), 1)
+        self.assertTrue(runs[0].endswith('book0.epub'))
+        self.assertIn('ArchiveClassesAtExit', runs[0])
+        for r in runs[1:]:
+            self.assertIn('-XX:SharedArchiveFile=' + runner.cds_archive, r)
+        # later runs only read the archive
+        os.remove(self.log)
+        list(runner.run_all(books[:2]))
+        self.assertFalse([r for r in self.runs()
+                          if 'ArchiveClassesAtExit' in r])
+
+    def test_new_java_never_writes_archive_concurrently(self):
+        runner = EpubCheckRunner(self.jar, java=self.fake_java('21.0.1'),
+                                 jobs=3)
+        books = [os.path.join(self.tmp, 'book%d.epub' % i) for i in range(4)]
+        list(runner.run_all(books))
+        auto = [r for r in self.runs() if 'AutoCreateSharedArchive' in r]
+        self.assertEqual(len(auto), 1)
+
+    def test_old_java_without_archive(self):
+        runner = EpubCheckRunner(self.jar, java=self.fake_java('1.8.0_292'),
+                                 jobs=2)
+        books = [os.path.join(self.tmp, 'book%d.epub' % i) for i in range(3)]
+        results = list(runner.run_all(books))
+        self.assertEqual(len(results), 3)
+        self.assertFalse([r for r in self.runs() if '-XX:' in r])
+
+    def test_closing_drops_queued_jobs(self):
+        runner = EpubCheckRunner(self.jar, java=self.fake_java('1.8.0_292'),
+                                 jobs=1)
+        books = [os.path.join(self.tmp, 'slow%d.epub' % i) for i in range(4)]
+        checks = runner.run_all(books)
+        next(checks)
+        checks.close()
+        # at most the job started while the first one was read
+        self.assertLessEqual(len(self.runs()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from lxml import etree
+
+import lib.fntutls
+from benchmarks.corpus import CONTAINER
+from benchmarks.corpus import make_font
+from lib import csscache
+from lib.epubqcheck import qcheck
+from lib.epubqfix import subset_embedded_fonts
+from lib.fontcoverage import CoverageCollector
+
+FACE = '@font-face { font-family: Foo; src: url(f/foo.ttf) }\n'
+BODY = '<h1>AB</h1><p>ąę</p>'
+
+
+def xhtml(body, head=''):
+    return etree.fromstring((
+        '<html xmlns="http://www.w3.org/1999/xhtml"><head>%s</head>'
+        '<body>%s</body></html>' % (head, body)).encode('utf-8'))
+
+
+def collector_for(css, body=BODY, head=''):
+    collector = CoverageCollector()
+    collector.add_stylesheet('style.css',
+                             csscache.CSSInfo((FACE + css).encode('utf-8')))
+    collector.collect(xhtml(body, head))
+    return collector
+
+
+def used(css, body=BODY, head=''):
+    return dict((path, ''.join(sorted(chars))) for path, chars in
+                collector_for(css, body, head).used_chars().items())
+
+
+class CoverageCollectorTest(unittest.TestCase):
+
+    def test_root_rules(self):
+        for css in ('html { font-family: Foo } h1 { font-family: Foo }',
+                    ':root { font-family: Foo }',
+                    'html:root { font-family: "Foo", serif }'):
+            self.assertEqual(used(css), {'f/foo.ttf': 'ABąę'}, css)
+
+    def test_font_shorthand(self):
+        self.assertEqual(used('p { font: 12px Foo }'), {'f/foo.ttf': 'ąę'})
+        self.assertEqual(used('p { font: italic bold 1em/1.2 "Foo" }'),
+                         {'f/foo.ttf': 'ąę'})
+        self.assertEqual(used('', '<p style="font: 12px/2 Foo">ąę</p>'),
+                         {'f/foo.ttf': 'ąę'})
+        # shorthand resets the family
+        self.assertEqual(used('body { font-family: Foo } p { font: 1em x }'),
+                         {'f/foo.ttf': 'AB'})
+
+    def test_media_rules(self):
+        self.assertEqual(used('@media amzn-kf8 { p { font-family: Foo } }'),
+                         {'f/foo.ttf': 'ąę'})
+
+    def test_first_embedded_family(self):
+        self.assertEqual(used('p { font-family: Missing, Foo, serif }'),
+                         {'f/foo.ttf': 'ąę'})
+
+    def test_unresolved_families(self):
+        for css, head in (('p:first-child { font-family: Foo }', ''),
+                          ('p { font: var(--book-font) }', ''),
+                          ('p { font-family: var(--f) }', ''),
+                          ('', '<style>p { font-family: Foo }</style>')):
+            collector = collector_for(css, head=head)
+            self.assertEqual(collector.unresolved_fonts(), {'f/foo.ttf'},
+                             css or head)
+            self.assertEqual(collector.subset_chars(), {})
+
+    def test_subset_chars(self):
+        collector = collector_for(
+            'h1 { font-family: Foo; font-weight: bold } '
+            'p::before { content: "\\2022  " }')
+        # the regular face keeps characters used with the bold one
+        self.assertEqual(collector.subset_chars(),
+                         {'f/foo.ttf': set('AB• ')})
+
+
+class SubsetEmbeddedFontsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        os.mkdir(os.path.join(self.tmp, 'f'))
+        self.font = os.path.join(self.tmp, 'f', 'foo.ttf')
+        with open(self.font, 'wb') as f:
+            f.write(make_font('Foo', 'Regular', False, False))
+        self.opf = etree.fromstring(
+            b'<package xmlns="http://www.idpf.org/2007/opf"><manifest>'
+            b'<item href="style.css" media-type="text/css"/>'
+            b'</manifest></package>')
+
+    def subset(self, css, body=BODY):
+        with open(os.path.join(self.tmp, 'style.css'), 'w') as f:
+            f.write(FACE + css)
+        path = os.path.join(self.tmp, 'text.xhtml')
+        with open(path, 'wb') as f:
+            f.write(etree.tostring(xhtml(body)))
+        subset_embedded_fonts(self.opf, self.tmp, [path])
+        with open(self.font, 'rb') as f:
+            return lib.fntutls.get_cmap(f.read())
+
+    def assert_kept(self, cmap, text):
+        self.assertEqual(cmap.missing(set(map(ord, text))), [])
+
+    def test_keeps_characters_of_root_shorthand_and_media_rules(self):
+        for css in ('html { font-family: Foo } h1 { font-family: Foo }',
+                    'p { font: 12px Foo }',
+                    '@media amzn-kf8 { p { font-family: Foo } }'):
+            cmap = self.subset(css)
+            self.assert_kept(cmap, 'ąę')
+            # not used characters are removed
+            self.assertEqual(cmap.missing([ord('ż')]), [ord('ż')])
+
+    def test_unresolved_font_is_kept_whole(self):
+        cmap = self.subset('p:first-child { font-family: Foo }')
+        self.assert_kept(cmap, 'ąężźŁ')
+
+
+OPF = '''<?xml version="1.0"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0"
+    unique-identifier="id"><metadata
+    xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>T</dc:title>
+<dc:language>pl</dc:language><dc:identifier id="id">x</dc:identifier>
+</metadata><manifest>
+<item id="css" href="style.css" media-type="text/css"/>
+<item id="font" href="f/foo.ttf" media-type="application/font-sfnt"/>
+<item id="text" href="text.xhtml" media-type="application/xhtml+xml"/>
+</manifest><spine><itemref idref="text"/></spine></package>'''
+
+
+class QcheckCoverageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        # font without Polish letters
+        self.font = lib.fntutls.subset_font(
+            make_font('Foo', 'Regular', False, False),
+            set(range(0x20, 0x7F)))
+
+    def check(self, css):
+        name = 'book.epub'
+        with zipfile.ZipFile(os.path.join(self.tmp, name), 'w') as z:
+            z.writestr('mimetype', 'application/epub+zip')
+            z.writestr('META-INF/container.xml', CONTAINER)
+            z.writestr('OEBPS/content.opf', OPF)
+            z.writestr('OEBPS/style.css', FACE + css)
+            z.writestr('OEBPS/f/foo.ttf', self.font)
+            z.writestr('OEBPS/text.xhtml', etree.tostring(xhtml(
+                BODY, '<title>T</title><link href="style.css" '
+                'rel="stylesheet" type="text/css"/>')))
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            qcheck(self.tmp, name, False, False, False, use_cache=False)
+        return out.getvalue()
+
+    def test_reports_missing_glyphs(self):
+        for css in ('html { font-family: Foo } h1 { font-family: Foo }',
+                    'p { font: 12px Foo }',
+                    '@media amzn-kf8 { p { font-family: Foo } }'):
+            out = self.check(css)
+            self.assertIn('Font file "OEBPS/f/foo.ttf" (font-family "Foo") '
+                          'has no glyphs for 2 character(s) used in the '
+                          'text: ą (U+0105), ę (U+0119)', out, css)
+
+    def test_covered_text(self):
+        out = self.check('h1 { font-family: Foo }')
+        self.assertNotIn('has no glyphs', out)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+import lib.fntutls
+from benchmarks.corpus import make_font
+from lib import fontcache
+from lib import fontstore
+from lib.epubqfix import IDPF_OBFUSCATION
+from lib.epubqfix import deobfuscate_font
+from lib.fontindex import find_substitute_font
+
+
+class FontStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        patcher = mock.patch.object(fontcache, 'use_disk', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = os.path.join(self.tmp, 'store')
+        self.regular = make_font('Foo', 'Regular', False, False)
+        self.bold = make_font('Foo', 'Bold', True, False)
+        library = os.path.join(self.tmp, 'library')
+        os.mkdir(library)
+        # fonts are stored under their contents, not the generic file name
+        for name, font in (('a.epub', self.regular), ('b.epub', self.bold)):
+            with zipfile.ZipFile(os.path.join(library, name), 'w') as z:
+                z.writestr('mimetype', 'application/epub+zip')
+                z.writestr('OEBPS/fonts/font.ttf', font)
+        with contextlib.redirect_stdout(io.StringIO()):
+            fontstore.font_report(library, self.store)
+
+    def embedded(self, raw):
+        path = os.path.join(self.tmp, 'font.ttf')
+        with open(path, 'wb') as f:
+            f.write(raw)
+        return path
+
+    def stored(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_store_not_used_without_option(self):
+        with mock.patch.object(fontstore, 'store_dir', None):
+            self.assertIsNone(fontstore.find_font(self.regular))
+            self.assertIsNone(find_substitute_font(
+                self.embedded(b'\0' * 2000), None))
+
+    def test_obfuscated_font_matched_by_contents(self):
+        key = bytes(range(20))
+        for font in (self.regular, self.bold):
+            obfuscated = deobfuscate_font(font, key, IDPF_OBFUSCATION)
+            self.assertNotEqual(obfuscated[:4], font[:4])
+            with mock.patch.object(fontstore, 'store_dir', self.store):
+                path = find_substitute_font(self.embedded(obfuscated), None)
+            self.assertEqual(self.stored(path), font)
+        # other font with the same file name is not used
+        other = deobfuscate_font(make_font('Bar', 'Regular', False, False),
+                                 key, IDPF_OBFUSCATION)
+        self.assertIsNone(fontstore.find_font(other, self.store))
+
+    def test_valid_font_matched_by_names(self):
+        path = fontstore.find_font(self.bold, self.store)
+        self.assertEqual(self.stored(path), self.bold)
+
+    def test_subset_never_replaces_complete_font(self):
+        subset = lib.fntutls.subset_font(self.regular, set(range(0x41, 0x5B)))
+        self.assertLess(len(subset), len(self.regular))
+        path = fontstore.find_font(subset, self.store)
+        self.assertEqual(self.stored(path), self.regular)
+        library = os.path.join(self.tmp, 'subsets')
+        os.mkdir(library)
+        with zipfile.ZipFile(os.path.join(library, 'c.epub'), 'w') as z:
+            z.writestr('OEBPS/fonts/font.ttf', subset)
+        store = os.path.join(self.tmp, 'subset-store')
+        with contextlib.redirect_stdout(io.StringIO()):
+            fontstore.font_report(library, store)
+        self.assertIsNone(fontstore.find_font(self.regular, store))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from lib import checkcache
+from lib import mobicache
+
+VERSION = 'V2.9 build 1028'
+
+
+class MobiCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        patcher = mock.patch.object(checkcache, 'CACHE_DIR',
+                                    os.path.join(self.tmp, 'cache'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.epub = self.write('book_moh.epub', b'epub', 1000)
+        self.mobi = self.write('book_moh.mobi', b'mobi', 2000)
+
+    def write(self, name, data, mtime):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def lookup(self, compression='-c1'):
+        return mobicache.lookup(self.epub, self.mobi, compression, VERSION)
+
+    def test_existing_mobi_without_record_is_kept(self):
+        self.assertEqual(self.lookup(), mobicache.ADOPTED_REPORT)
+        record = checkcache.load_result(mobicache.KIND,
+                                        mobicache._key(self.mobi))
+        self.assertEqual(record['input'], checkcache.file_hash(self.epub))
+        self.assertEqual(record['output'], checkcache.file_hash(self.mobi))
+        # from now on the record decides
+        self.assertIsNone(self.lookup('-c2'))
+        self.write('book_moh.epub', b'changed', 3000)
+        self.assertIsNone(self.lookup())
+
+    def test_mobi_older_than_epub_is_converted(self):
+        os.utime(self.mobi, (500, 500))
+        self.assertIsNone(self.lookup())
+        self.assertIsNone(checkcache.load_result(mobicache.KIND,
+                                                 mobicache._key(self.mobi)))
+
+    def test_stored_report(self):
+        report = {'lines': ['Warning(x): W1'], 'cover_html_found': False,
+                  'error_found': False}
+        mobicache.store(self.epub, self.mobi, '-c2', VERSION, report)
+        self.assertEqual(self.lookup('-c2'), report)
+        self.assertIsNone(self.lookup('-c1'))
+        self.write('book_moh.mobi', b'edited', 4000)
+        self.assertIsNone(self.lookup('-c2'))
+
+    def test_missing_mobi(self):
+        os.remove(self.mobi)
+        self.assertIsNone(self.lookup())
+
+
+if __name__ == '__main__':
+    unittest.main()
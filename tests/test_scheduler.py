@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import contextlib
+import io
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from lib import azkfix
+from lib.scheduler import Job
+from lib.scheduler import run_job
+from lib.scheduler import run_jobs
+
+# stand-in for kindlegen/azkcreator: marks itself as running, sleeps,
+# and writes its arguments to stdout and stderr
+TOOL = r'''#!/bin/sh
+mkdir "%(running)s/$$"
+ls "%(running)s" | wc -l >> "%(counts)s"
+sleep "$1"
+rmdir "%(running)s/$$"
+echo "out $*"
+echo "err $*" >&2
+exit "$2"
+'''
+
+
+@unittest.skipIf(sys.platform == 'win32', 'needs a POSIX shell')
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.running = os.path.join(self.tmp, 'running')
+        os.mkdir(self.running)
+        self.counts = os.path.join(self.tmp, 'counts')
+        self.tool = self.script('tool', TOOL % {'running': self.running,
+                                                'counts': self.counts})
+
+    def script(self, name, text):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+        return path
+
+    def started(self):
+        if not os.path.exists(self.counts):
+            return []
+        with open(self.counts) as f:
+            return [int(n) for n in f.read().split()]
+
+    def test_results_in_input_order(self):
+        delays = ['0.4', '0', '0.2', '0', '0.1', '0']
+        jobs = [Job([self.tool, d, str(i % 2)], i, True)
+                for i, d in enumerate(delays)]
+        results = list(run_jobs(jobs, 3))
+        self.assertEqual([job.data for job, result in results],
+                         list(range(len(delays))))
+        for job, result in results:
+            self.assertEqual(result.returncode, job.data % 2)
+            self.assertEqual(result.stdout.strip(), 'out ' +
+                             ' '.join(job.args[1:]))
+            self.assertEqual(result.stderr.strip(), 'err ' +
+                             ' '.join(job.args[1:]))
+            self.assertFalse(result.timed_out)
+            self.assertIsNone(result.error)
+
+    def test_concurrency_limit(self):
+        jobs = [Job([self.tool, '0.2', '0'], i) for i in range(8)]
+        list(run_jobs(jobs, 2))
+        started = self.started()
+        self.assertEqual(len(started), 8)
+        self.assertLessEqual(max(started), 2)
+
+    def test_timeout_kills_whole_process_group(self):
+        # the child of the wrapper script would keep the pipes open
+        wrapper = self.script('wrapper', '#!/bin/sh\n"%s" 30 0\n' % self.tool)
+        start = time.time()
+        job, result = next(run_jobs([Job([wrapper], None)], 1, 0.5))
+        self.assertLess(time.time() - start, 10)
+        self.assertTrue(result.timed_out)
+
+    def test_missing_program(self):
+        result = run_job(Job([os.path.join(self.tmp, 'missing')]))
+        self.assertIsInstance(result.error, OSError)
+
+    def test_lazy_arguments(self):
+        called = []
+
+        def args(i):
+            def f():
+                called.append(i)
+                return [self.tool, '0.3', '0']
+            return f
+        jobs = [Job(args(i), i) for i in range(6)]
+        self.assertEqual(called, [])
+        results = run_jobs(jobs, 1)
+        next(results)
+        results.close()
+        # jobs dropped by close() never built their arguments
+        self.assertLessEqual(len(called), 2)
+        self.assertEqual(len(self.started()), len(called))
+
+    def test_azk_temp_dirs_created_per_job(self):
+        azk = self.script('azkcreator', '#!/bin/sh\nsleep 30\n')
+        temp = os.path.join(self.tmp, 'temp')
+        os.mkdir(temp)
+        books = os.path.join(self.tmp, 'books')
+        os.mkdir(books)
+        names = ['book%d_moh.mobi' % i for i in range(4)]
+        for name in names:
+            open(os.path.join(books, name), 'wb').close()
+        with mock.patch.object(azkfix, 'AZKAPP', azk), \
+                mock.patch.object(tempfile, 'tempdir', temp):
+            jobs = [azkfix.prepare_azk(books, name, False) for name in names]
+            self.assertEqual(os.listdir(temp), [])
+            results = run_jobs(jobs, 2, 0.3)
+            for job, result in results:
+                self.assertTrue(result.timed_out)
+                self.assertTrue(os.path.isdir(job.data['tempdir']))
+                azkfix.finish_azk(job, result)
+                self.assertFalse(os.path.exists(job.data['tempdir']))
+        self.assertEqual(os.listdir(temp), [])
+        self.assertEqual(len(set(j.data['tempdir'] for j in jobs)), 4)
+
+    def test_azk_failure_is_reported(self):
+        books = os.path.join(self.tmp, 'books')
+        os.mkdir(books)
+        open(os.path.join(books, 'book_moh.mobi'), 'wb').close()
+        for text, message in (
+                ('#!/bin/sh\necho "cannot load library" >&2\nexit 3\n',
+                 'cannot load library'),
+                ('#!/bin/sh\nexit 3\n', 'failed with exit code 3'),
+                ('#!/bin/sh\nexit 0\n', 'did not create any output')):
+            azk = self.script('azkcreator', text)
+            with mock.patch.object(azkfix, 'AZKAPP', azk):
+                job = azkfix.prepare_azk(books, 'book_moh.mobi', False)
+                out = io.StringIO()
+                with contextlib.redirect_stdout(out):
+                    azkfix.finish_azk(job, run_job(job))
+            self.assertIn(message, out.getvalue())
+            self.assertIn('ERROR!', out.getvalue())
+            self.assertFalse(os.path.exists(job.data['tempdir']))
+        self.assertEqual(os.listdir(books), ['book_moh.mobi'])
+
+
+if __name__ == '__main__':
+    unittest.main()
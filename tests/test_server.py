@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import http.client
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from benchmarks.corpus import make_book
+from benchmarks.corpus import write_epub
+from lib.server import make_server
+
+# defaults of the command line options used by the server stages
+OPTIONS = SimpleNamespace(
+    alter=False, list_fonts=False, replace_font_files=False,
+    skip_reset_css=True, tools=None, skip_hyphenate=False,
+    skip_justify=True, left=False, myk_fix=False, remove_colors=False,
+    remove_fonts=False, font_dir=None, fix_missing_container=False,
+    book_margin=None, skip_hyphenate_headers=False,
+    replace_font_family=None, subset_fonts=False
+)
+
+
+class GatedPool(object):
+    ''' Stand-in for the worker pool running jobs only when opened '''
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def _run(self, func, *a):
+        self.gate.wait()
+        return func(*a)
+
+    def submit(self, func, *a):
+        return self.executor.submit(self._run, func, *a)
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.gate.set()
+        self.executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+
+class ServerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        path = os.path.join(cls.tmp, 'book.epub')
+        write_epub(path, make_book(random.Random(1), 0, chapters=2,
+                                   words=200, images=0)[1])
+        with open(path, 'rb') as f:
+            cls.book = f.read()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp)
+
+    def start(self, workers=1, queue_size=4):
+        spool = tempfile.mkdtemp(dir=self.tmp)
+        httpd, service = make_server(spool, OPTIONS, port=0,
+                                     workers=workers, queue_size=queue_size,
+                                     quiet=True)
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            httpd.shutdown()
+            httpd.server_close()
+            service.shutdown()
+        self.addCleanup(stop)
+        self.port = httpd.server_address[1]
+        return service
+
+    def request(self, method, path, body=None):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        try:
+            conn.request(method, path, body)
+            response = conn.getresponse()
+            data = response.read()
+        finally:
+            conn.close()
+        if response.getheader('Content-Type') == 'application/json':
+            data = json.loads(data.decode('utf-8'))
+        return response.status, data
+
+    def wait_for(self, job_id, status):
+        for _ in range(500):
+            code, job = self.request('GET', '/jobs/' + job_id)
+            if job['status'] == status:
+                return job
+            time.sleep(0.01)
+        self.fail('job %s never became %s' % (job_id, status))
+
+    def test_submit_wait_download(self):
+        self.start()
+        code, job = self.request(
+            'POST', '/jobs?filename=Book_moh.epub&stages=qcheck,qfix&wait=1',
+            self.book)
+        self.assertEqual(code, 200)
+        self.assertEqual(job['status'], 'done', job['report'])
+        # generated file name is fixed under its source name
+        self.assertEqual(job['filename'], 'Book.epub')
+        self.assertEqual(sorted(job['report']), ['qcheck', 'qfix'])
+        self.assertEqual(job['result'], '/jobs/%s/result' % job['id'])
+        code, data = self.request('GET', job['result'])
+        self.assertEqual(code, 200)
+        with zipfile.ZipFile(io.BytesIO(data)) as z:
+            self.assertEqual(z.namelist()[0], 'mimetype')
+            self.assertIsNone(z.testzip())
+        code, data = self.request('GET', '/jobs/' + job['id'])
+        self.assertEqual(data['status'], 'done')
+        code, data = self.request('DELETE', '/jobs/' + job['id'])
+        self.assertEqual(code, 200)
+        code, data = self.request('GET', '/jobs/' + job['id'])
+        self.assertEqual(code, 404)
+
+    def test_rejects_invalid_uploads(self):
+        self.start()
+        code, data = self.request('POST', '/jobs', b'not a zip')
+        self.assertEqual(code, 400)
+        code, data = self.request('POST', '/jobs?stages=kindlegen', self.book)
+        self.assertEqual(code, 400)
+
+    def test_backpressure_and_running_jobs(self):
+        service = self.start(queue_size=1)
+        service.pool = pool = GatedPool()
+        code, first = self.request('POST', '/jobs?stages=qcheck', self.book)
+        self.assertEqual(code, 202)
+        self.wait_for(first['id'], 'running')
+        code, second = self.request('POST', '/jobs?stages=qcheck', self.book)
+        self.assertEqual(code, 202)
+        self.assertEqual(second['status'], 'queued')
+        # the queue is full
+        code, data = self.request('POST', '/jobs?stages=qcheck', self.book)
+        self.assertEqual(code, 503)
+        code, metrics = self.request('GET', '/metrics')
+        self.assertEqual(code, 200)
+        metrics = metrics.decode('utf-8')
+        self.assertIn('epubqtools_queue_depth 1\n', metrics)
+        self.assertIn('epubqtools_jobs_running 1\n', metrics)
+        self.assertIn('epubqtools_jobs_total{state="rejected"} 1\n', metrics)
+        # a running job keeps its files, a queued one can be dropped
+        code, data = self.request('DELETE', '/jobs/' + first['id'])
+        self.assertEqual(code, 409)
+        code, data = self.request('DELETE', '/jobs/' + second['id'])
+        self.assertEqual(code, 200)
+        pool.gate.set()
+        job = self.wait_for(first['id'], 'done')
+        self.assertIsNone(job['result'])
+        code, metrics = self.request('GET', '/metrics')
+        metrics = metrics.decode('utf-8')
+        self.assertIn('epubqtools_stage_seconds_count{stage="qcheck"} 1\n',
+                      metrics)
+        self.assertIn('epubqtools_jobs_total{state="done"} 1\n', metrics)
+        self.assertIn('epubqtools_queue_depth 0\n', metrics)
+
+
+if __name__ == '__main__':
+    unittest.main()
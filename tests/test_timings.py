@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from benchmarks.corpus import generate_corpus
+from lib import fontcache
+from lib import timings
+from lib.epubqfix import qfix
+
+
+class QfixTimingsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        for module, name, value in ((timings, 'enabled', True),
+                                    (timings, 'books', []),
+                                    (timings, '_book', None),
+                                    (fontcache, 'use_disk', False)):
+            patcher = mock.patch.object(module, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def qfix(self, f):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return qfix(self.tmp, f, True, False, False, None, False, False,
+                        False, None, False, False, None, False, None, False,
+                        None)
+
+    def test_unrepairable_book_is_finished(self):
+        with open(os.path.join(self.tmp, 'broken.epub'), 'wb') as f:
+            f.write(b'not a zip file')
+        self.assertEqual(self.qfix('broken.epub'), 0)
+        self.assertEqual([b['book'] for b in timings.books], ['broken.epub'])
+        self.assertIsNone(timings._book)
+
+    def test_failed_book_is_finished(self):
+        with open(os.path.join(self.tmp, 'book.epub'), 'wb') as f:
+            f.write(b'PK\x05\x06' + b'\0' * 18)
+        with mock.patch('lib.epubqfix.process_epub',
+                        side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                self.qfix('book.epub')
+        self.assertEqual([b['book'] for b in timings.books], ['book.epub'])
+        self.assertIsNone(timings._book)
+
+    def test_output_bytes_is_size_of_moh_file(self):
+        path, = generate_corpus(self.tmp, books=1, chapters=3, words=200,
+                                images=0, fonts=2)
+        f = os.path.basename(path)
+        self.qfix(f)
+        book, = timings.books
+        moh = os.path.join(self.tmp, os.path.splitext(f)[0] + '_moh.epub')
+        self.assertEqual(book['counters']['output bytes'],
+                         os.path.getsize(moh))
+        self.assertEqual(book['counters']['archives written'], 2)
+        self.assertGreater(book['counters']['files written'], 3)
+        self.assertNotIn('bytes written', book['counters'])
+
+
+if __name__ == '__main__':
+    unittest.main()